@@ -1,18 +1,27 @@
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'TruView.settings')
 
+http_application = get_asgi_application()
+
 # Import routing after Django setup
-from myapp.routing import websocket_urlpatterns
+from django.conf import settings
+from myapp.assets import PrecompressedStaticFiles
+from myapp.routing import channel_routes, websocket_urlpatterns
+
+if settings.STATIC_SERVE:
+    # Collected static files straight from STATIC_ROOT, precompressed
+    http_application = PrecompressedStaticFiles(http_application)
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": http_application,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
     ),
+    "channel": ChannelNameRouter(channel_routes),
 })
@@ -121,6 +121,21 @@ STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_DIRS = (os.path.join(BASE_DIR, 'static'),)
 
+# Outside development, collectstatic writes minified, content-hashed assets with
+# gzip and brotli copies, and the ASGI app serves them with far-future caching
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': (
+            'django.contrib.staticfiles.storage.StaticFilesStorage' if DEVELOPMENT_MODE
+            else 'myapp.assets.CompressedManifestStaticFilesStorage'
+        ),
+    },
+}
+STATIC_SERVE = os.getenv("STATIC_SERVE", str(not DEVELOPMENT_MODE)) == "True"
+
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media/"
 
@@ -129,27 +144,191 @@ MEDIA_ROOT = BASE_DIR / "media/"
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-# For development ( LocMemCache )
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'rate-limit-cache',
-        'TIMEOUT': 300,  # 5 minutes
+# Shared state: cache, channel layer and rate limiter. With REDIS_URL set every
+# worker and Daphne instance shares them; without it they are per-process,
+# which is fine for development and tests.
+REDIS_URL = os.getenv("REDIS_URL", "")
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'truview',
+            'TIMEOUT': 300,  # 5 minutes
+        }
+    }
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        }
+    }
+    RATE_LIMIT_STORE = {
+        'BACKEND': 'myapp.ratelimit.RedisBucketStore',
+        'OPTIONS': {'url': REDIS_URL},
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'truview-cache',
+            'TIMEOUT': 300,  # 5 minutes
+            # Room for the metrics and analysis records besides everything
+            # else, past the limit LocMem drops the least recently used third
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+    # The in-memory layer only reaches consumers in the same process
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
+    }
+    RATE_LIMIT_STORE = {
+        'BACKEND': 'myapp.ratelimit.InMemoryBucketStore',
+        'OPTIONS': {},
     }
-}
 
-# For production ( Redis is recommended )
-# CACHES = {
-#     'default': {
-#         'BACKEND': 'django_redis.cache.RedisCache',
-#         'LOCATION': 'redis://127.0.0.1:6379/1',
-#         'OPTIONS': {
-#             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
-#         },
-#         'KEY_PREFIX': 'rate_limit',
-#         'TIMEOUT': 300,
-#     }
-# }
-
-# Configure django_ratelimit to use the cache
-RATELIMIT_USE_CACHE = 'default'
+# Upload rate limit per client, as a token bucket: N requests per s/m/h
+UPLOAD_RATE_LIMIT = os.getenv("UPLOAD_RATE_LIMIT", "3/m")
+
+# Analysis cache: finished analyses are reused for identical or near-identical photos
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "True") == "True"
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "5000"))
+ANALYSIS_CACHE_MAX_AGE = int(os.getenv("ANALYSIS_CACHE_MAX_AGE", str(30 * 24 * 60 * 60)))  # 30 days
+# Near-duplicate photos: max Hamming distance between perceptual hashes for a
+# candidate (0 means exact matches only, must be < 4), and the mean grey level
+# difference per 8x8 block a candidate may show in the pixel comparison
+ANALYSIS_CACHE_PHASH_DISTANCE = int(os.getenv("ANALYSIS_CACHE_PHASH_DISTANCE", "0"))
+ANALYSIS_CACHE_PIXEL_TOLERANCE = float(os.getenv("ANALYSIS_CACHE_PIXEL_TOLERANCE", "6"))
+
+# Replicate API, override the base URL to run against a local fake server
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "")
+REPLICATE_API_BASE_URL = os.getenv("REPLICATE_API_BASE_URL", "https://api.replicate.com")
+
+# Public base URL of this site, e.g. https://example.com. When set, predictions
+# report completion to /replicate-webhook/ instead of relying on polling alone.
+REPLICATE_WEBHOOK_BASE_URL = os.getenv("REPLICATE_WEBHOOK_BASE_URL", "")
+# Signing secret from https://api.replicate.com/v1/webhooks/default/secret (whsec_...)
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET", "")
+
+# Pooled async HTTP client for the Replicate API. HTTP/2 is used when the h2 package is installed.
+REPLICATE_HTTP2 = os.getenv("REPLICATE_HTTP2", "True") == "True"
+REPLICATE_HTTP_MAX_CONNECTIONS = int(os.getenv("REPLICATE_HTTP_MAX_CONNECTIONS", "100"))
+REPLICATE_HTTP_MAX_KEEPALIVE = int(os.getenv("REPLICATE_HTTP_MAX_KEEPALIVE", "20"))
+REPLICATE_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("REPLICATE_HTTP_KEEPALIVE_EXPIRY", "30"))  # Seconds
+REPLICATE_HTTP_TIMEOUT = float(os.getenv("REPLICATE_HTTP_TIMEOUT", "30"))  # Read/write, seconds
+REPLICATE_HTTP_CONNECT_TIMEOUT = float(os.getenv("REPLICATE_HTTP_CONNECT_TIMEOUT", "5"))
+REPLICATE_HTTP_POOL_TIMEOUT = float(os.getenv("REPLICATE_HTTP_POOL_TIMEOUT", "10"))  # Waiting for a free connection
+REPLICATE_HTTP_CONNECT_RETRIES = int(os.getenv("REPLICATE_HTTP_CONNECT_RETRIES", "2"))
+# 429 and 5xx responses are retried with full-jitter exponential backoff
+REPLICATE_HTTP_RETRY_ATTEMPTS = int(os.getenv("REPLICATE_HTTP_RETRY_ATTEMPTS", "4"))
+REPLICATE_HTTP_RETRY_BACKOFF = float(os.getenv("REPLICATE_HTTP_RETRY_BACKOFF", "0.5"))  # Seconds
+REPLICATE_HTTP_RETRY_MAX_BACKOFF = float(os.getenv("REPLICATE_HTTP_RETRY_MAX_BACKOFF", "10"))
+
+# Polling backoff in seconds. With a webhook configured polling is only a fallback.
+PREDICTION_POLL_INITIAL = float(os.getenv("PREDICTION_POLL_INITIAL", "1"))
+PREDICTION_POLL_BACKOFF = float(os.getenv("PREDICTION_POLL_BACKOFF", "1.5"))
+PREDICTION_POLL_MAX = float(os.getenv("PREDICTION_POLL_MAX", "10"))
+PREDICTION_WEBHOOK_FALLBACK_POLL = float(os.getenv("PREDICTION_WEBHOOK_FALLBACK_POLL", "10"))
+
+# Stream model output and push each finished section to the client as it completes
+ANALYSIS_STREAMING = os.getenv("ANALYSIS_STREAMING", "True") == "True"
+
+# Split the analysis into concurrent predictions, one per group in prompts.ANALYSIS_GROUPS.
+# An optional group that fails or runs past its timeout comes back as null sections.
+ANALYSIS_FAN_OUT = os.getenv("ANALYSIS_FAN_OUT", "True") == "True"
+ANALYSIS_REQUIRED_GROUP_TIMEOUT = float(os.getenv("ANALYSIS_REQUIRED_GROUP_TIMEOUT", "120"))  # Seconds
+ANALYSIS_OPTIONAL_GROUP_TIMEOUT = float(os.getenv("ANALYSIS_OPTIONAL_GROUP_TIMEOUT", "45"))  # Seconds
+
+# Check each photo before the analysis: preprocessing stats turn away blank and
+# blurry photos, then a short prediction rejects anything that isn't a readable
+# food label and picks the sections (and token budgets) the visible panels
+# support. Without an answer within the timeout the full analysis runs.
+ANALYSIS_TRIAGE = os.getenv("ANALYSIS_TRIAGE", "True") == "True"
+ANALYSIS_TRIAGE_TIMEOUT = float(os.getenv("ANALYSIS_TRIAGE_TIMEOUT", "8"))  # Seconds
+ANALYSIS_TRIAGE_MIN_SHARPNESS = float(os.getenv("ANALYSIS_TRIAGE_MIN_SHARPNESS", "10"))
+ANALYSIS_TRIAGE_MIN_CONTRAST = float(os.getenv("ANALYSIS_TRIAGE_MIN_CONTRAST", "8"))
+
+# Uploads are kept in memory until the consumer claims them, never written to disk
+FILE_UPLOAD_MAX_MEMORY_SIZE = 8 * 1024 * 1024 + 1024  # Matches the 8 MB upload limit
+UPLOAD_STORE_MAX_BYTES = int(os.getenv("UPLOAD_STORE_MAX_BYTES", str(256 * 1024 * 1024)))  # Per process
+UPLOAD_STORE_TTL = int(os.getenv("UPLOAD_STORE_TTL", "300"))  # Seconds before an unclaimed upload is dropped
+UPLOAD_STORE_SWEEP_INTERVAL = int(os.getenv("UPLOAD_STORE_SWEEP_INTERVAL", "30"))
+# Start the Replicate file upload from the upload view instead of waiting for the socket
+UPLOAD_EAGER_PREPARE = os.getenv("UPLOAD_EAGER_PREPARE", "True") == "True"
+# Hand uploads between processes through the shared cache, so the upload request
+# and the WebSocket may reach different ones. Without it (and without Redis)
+# both must reach the same process: run one, or route clients stickily.
+UPLOAD_SHARED = os.getenv("UPLOAD_SHARED", str(bool(REDIS_URL))) == "True"
+
+# Image preprocessing before upload to Replicate, runs in a process pool
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "True") == "True"
+PREPROCESS_MAX_EDGE = int(os.getenv("PREPROCESS_MAX_EDGE", "1600"))  # Pixels
+PREPROCESS_JPEG_QUALITY = int(os.getenv("PREPROCESS_JPEG_QUALITY", "85"))
+PREPROCESS_CROP_LABEL = os.getenv("PREPROCESS_CROP_LABEL", "False") == "True"
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "2"))
+
+# Admission control for predictions. Each worker process (or web process when
+# running inline) has at most ANALYSIS_MAX_CONCURRENCY predictions in flight,
+# counting every fan-out group, triage and repair. Analyses are started while
+# their predictions fit, up to ANALYSIS_MAX_QUEUE more wait; beyond that
+# requests are shed.
+ANALYSIS_MAX_CONCURRENCY = int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "8"))
+ANALYSIS_MAX_QUEUE = int(os.getenv("ANALYSIS_MAX_QUEUE", "50"))
+ANALYSIS_QUEUE_UPDATE_INTERVAL = float(os.getenv("ANALYSIS_QUEUE_UPDATE_INTERVAL", "2"))  # Seconds
+# Run predictions in `manage.py runworker analysis-worker` instead of the web
+# process. Needs a channel layer shared between processes.
+ANALYSIS_USE_WORKER = os.getenv("ANALYSIS_USE_WORKER", "False") == "True"
+ANALYSIS_WORKER_CHANNEL = "analysis-worker"
+
+# Analyses one WebSocket may have in flight at once, and how many request ids
+# (for how long) each socket remembers to drop duplicate messages
+ANALYSIS_MAX_PER_SOCKET = int(os.getenv("ANALYSIS_MAX_PER_SOCKET", "4"))
+ANALYSIS_DEDUP_MAX_IDS = int(os.getenv("ANALYSIS_DEDUP_MAX_IDS", "256"))
+ANALYSIS_DEDUP_TTL = int(os.getenv("ANALYSIS_DEDUP_TTL", "600"))  # Seconds
+
+# Analysis status and results are kept this long under the client's request id,
+# so a client that lost its socket can resume or fetch them
+ANALYSIS_RESULT_TTL = int(os.getenv("ANALYSIS_RESULT_TTL", "600"))  # Seconds
+# How long an analysis keeps running after its socket drops, waiting to be resumed
+ANALYSIS_RESUME_GRACE = float(os.getenv("ANALYSIS_RESUME_GRACE", "60"))  # Seconds
+
+# Prometheus metrics at /metrics. With a token set, scrapers must send
+# `Authorization: Bearer <token>`
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True") == "True"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Metrics are counted in memory and added to the shared cache this often
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))  # Seconds
+
+# Log lines carry the request id of the analysis they belong to
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {'()': 'myapp.log.RequestIdFilter'},
+    },
+    'formatters': {
+        'request': {
+            'format': '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'filters': ['request_id'],
+            'formatter': 'request',
+        },
+    },
+    'loggers': {
+        'myapp': {
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
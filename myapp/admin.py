@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import AnalysisCacheEntry
+
+
+@admin.register(AnalysisCacheEntry)
+class AnalysisCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'prompt_version', 'hit_count', 'created_at', 'last_hit_at')
+    list_filter = ('prompt_version',)
+    search_fields = ('content_hash', 'phash')
+    readonly_fields = ('created_at', 'last_hit_at')
@@ -0,0 +1,467 @@
+import asyncio
+import json
+import logging
+import uuid
+import weakref
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import analysis_cache, log, metrics, predictions, prompts, results, schema, triage
+from .scheduler import AnalysisJob, get_scheduler
+from .streaming import SectionParser
+
+logger = logging.getLogger(__name__)
+
+OUTPUTS = "analysis.outputs"
+REPAIRS = "analysis.repairs"
+REPAIR_FAILURES = "analysis.repair_failures"
+REPAIR_TOKENS_SAVED = "analysis.repair_tokens_saved"
+
+
+def lookup_cached(data):
+    """Image key for the analysis cache and the cached result for it, if any."""
+    with metrics.span("cache_lookup"):
+        cache_key = analysis_cache.image_key(data)
+        return cache_key, analysis_cache.lookup(cache_key, prompts.PROMPT_VERSION)
+
+
+def reply_emitter(job):
+    """Send client messages for a job to every socket following it, wherever they run.
+
+    Each message is also stored so a client that lost its socket can resume.
+    """
+    channel_layer = get_channel_layer()
+
+    async def emit(message):
+        await results.record_message(job["key"], message)
+        await channel_layer.group_send(results.group_name(job["key"]), {
+            "type": "analysis.message",
+            "request_id": job["request_id"],
+            "message": message,
+        })
+
+    return emit
+
+
+async def stream_sections(prediction, emit):
+    parser = SectionParser()
+
+    async def on_text(text):
+        for section, value in parser.feed(text):
+            await emit({
+                "section": section,
+                "data": value
+            })
+
+    try:
+        await predictions.stream_output(prediction, on_text)
+    except Exception as e:
+        # The complete result still arrives through the normal completion path
+        logger.warning("Streaming failed, waiting for the full result: %s", e)
+
+
+async def run_prediction(input_data, emit, waiter, stream=None):
+    """Create a prediction and wait for it to finish, streaming sections to `emit`.
+
+    `stream` defaults to ANALYSIS_STREAMING. If the caller is cancelled (a
+    group timeout or a closed socket) the prediction is cancelled on
+    Replicate too.
+    """
+    if stream is None:
+        stream = settings.ANALYSIS_STREAMING
+    async with prediction_slots():
+        prediction = await predictions.create_prediction(input_data, stream=stream)
+        logger.info("Created prediction %s", prediction.id)
+        try:
+            with metrics.PREDICTIONS_IN_FLIGHT.track():
+                # Push each section to the client as soon as it is generated
+                if stream:
+                    await stream_sections(prediction, emit)
+
+                # Wait for the webhook, falling back to polling
+                prediction = await waiter.wait_for_prediction(prediction)
+        except asyncio.CancelledError:
+            _background(predictions.cancel_prediction(prediction.id))
+            raise
+
+    logger.info("Prediction %s %s", prediction.id, prediction.status)
+    metrics.observe_prediction(prediction)
+    return prediction
+
+
+# Semaphores belong to the event loop that first waits on them, so each loop
+# gets its own, along with the limit it was made for
+_prediction_slots = weakref.WeakKeyDictionary()
+
+
+def prediction_slots():
+    # ANALYSIS_MAX_CONCURRENCY predictions per process, whichever job or
+    # catalog run they belong to; the scheduler admits jobs so they rarely wait
+    loop = asyncio.get_running_loop()
+    limit, slots = _prediction_slots.get(loop, (None, None))
+    if limit != settings.ANALYSIS_MAX_CONCURRENCY:
+        limit, slots = settings.ANALYSIS_MAX_CONCURRENCY, asyncio.Semaphore(settings.ANALYSIS_MAX_CONCURRENCY)
+        _prediction_slots[loop] = limit, slots
+    return slots
+
+
+def prediction_width():
+    # Most predictions a job has in flight: one per group when fanned out,
+    # triage and repairs run before or inside them
+    return len(prompts.ANALYSIS_GROUPS) if settings.ANALYSIS_FAN_OUT else 1
+
+
+_background_tasks = set()
+
+
+def _background(coro):
+    # Keep a reference so fire-and-forget tasks aren't garbage collected mid-flight
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def output_tokens(prediction):
+    # Replicate reports token counts in the metrics, estimate from the text otherwise
+    metrics = getattr(prediction, "metrics", None) or {}
+    if metrics.get("output_token_count"):
+        return int(metrics["output_token_count"])
+    output = prediction.output or ""
+    if isinstance(output, list):
+        output = "".join(output)
+    return len(output) // 4
+
+
+async def validated_output(job, prediction, sections, emit, waiter):
+    """Parse and validate a prediction's output, regenerating only the sections that fail.
+
+    Returns the sections and the keys that are still invalid after the repair,
+    which are set to null. Raises json.JSONDecodeError if no JSON object can be
+    recovered from the output at all.
+    """
+    try:
+        with metrics.span("parse"):
+            data = schema.extract_json(prediction.output)
+            result, invalid = schema.validate_sections(data, sections)
+    except json.JSONDecodeError:
+        logger.warning("Raw output: %s", prediction.output)
+        raise
+
+    metrics.MODEL_OUTPUTS.inc()
+    if not invalid:
+        return result, []
+
+    # A short follow-up prediction for just the broken sections, instead of
+    # making the user upload again and paying for the whole analysis twice
+    metrics.REPAIRS.inc()
+    logger.info("Repairing sections: %s", ", ".join(invalid))
+    try:
+        with metrics.span("repair"):
+            input_data = prompts.build_repair_input(job["file_url"], invalid)
+            repair = await run_prediction(input_data, emit, waiter)
+            if repair.status != "succeeded":
+                raise GroupFailed(f"prediction {repair.status}: {repair.error}")
+            repaired, invalid = schema.validate_sections(schema.extract_json(repair.output), invalid)
+    except Exception as e:
+        logger.warning("Repair failed: %s", e)
+        repaired = {}
+
+    result.update(repaired)
+    if invalid:
+        metrics.REPAIR_FAILURES.inc()
+        result.update({key: None for key in invalid})
+    else:
+        metrics.REPAIR_TOKENS_SAVED.inc(max(0, output_tokens(prediction) - output_tokens(repair)))
+    return result, invalid
+
+
+def repair_stats():
+    return {
+        OUTPUTS: metrics.MODEL_OUTPUTS.total(),
+        REPAIRS: metrics.REPAIRS.total(),
+        REPAIR_FAILURES: metrics.REPAIR_FAILURES.total(),
+        REPAIR_TOKENS_SAVED: metrics.REPAIR_TOKENS_SAVED.total(),
+    }
+
+
+def assemble(sections, degraded=(), skipped=()):
+    # Same key order as the single prompt's schema, followed by the lists of
+    # sections that failed and that triage left out
+    result = {section: sections.get(section) for section in prompts.SCHEMA}
+    if degraded:
+        result["degraded"] = [section for section in prompts.SCHEMA if section in degraded]
+    if skipped:
+        result["skipped"] = [section for section in prompts.SCHEMA if section in skipped]
+    return result
+
+
+async def finish_analysis(job, emit, result, cache=True):
+    await emit({"analysis_result": result})
+
+    if not cache:
+        return
+    try:
+        await database_sync_to_async(analysis_cache.store)(
+            job["cache_key"], prompts.PROMPT_VERSION, result
+        )
+    except Exception as e:
+        logger.warning("Failed to cache analysis: %s", e)
+
+
+async def run_analysis(job, emit, waiter):
+    """Run the analysis for a job whose image is already on Replicate.
+
+    `waiter` is the consumer hosting the job; it receives webhook wake-ups
+    through the channel layer.
+    """
+    # Scheduler tasks may be started from another job's task, set our own id
+    log.request_id.set(job["request_id"])
+    planned = await run_triage(job, emit, waiter)
+    if planned is None:
+        return
+
+    groups, skipped = planned
+    if settings.ANALYSIS_FAN_OUT:
+        await run_fan_out(job, emit, waiter, groups, skipped)
+    else:
+        await run_single(job, emit, waiter, groups, skipped)
+
+
+async def run_triage(job, emit, waiter):
+    """Plan the analysis from a quick, low-token look at the photo.
+
+    Returns the groups to run and the sections left out (see triage.plan()),
+    or None once the client has been told the photo was rejected. A triage
+    prediction that fails, times out or answers nonsense escalates to the
+    full analysis.
+    """
+    if not settings.ANALYSIS_TRIAGE:
+        return triage.full_plan()
+
+    try:
+        with metrics.span("triage"):
+            prediction = await asyncio.wait_for(
+                run_prediction(prompts.build_triage_input(job["file_url"]), emit, waiter, stream=False),
+                settings.ANALYSIS_TRIAGE_TIMEOUT,
+            )
+        if prediction.status != "succeeded":
+            raise GroupFailed(f"prediction {prediction.status}: {prediction.error}")
+        verdict = schema.parse_triage(prediction.output)
+    except asyncio.TimeoutError:
+        logger.warning("Triage timed out, running the full analysis")
+        metrics.TRIAGES.inc(verdict="escalated")
+        return triage.full_plan()
+    except Exception as e:
+        logger.warning("Triage failed, running the full analysis: %s", e)
+        metrics.TRIAGES.inc(verdict="escalated")
+        return triage.full_plan()
+
+    reason = triage.judge(verdict)
+    if reason is not None:
+        logger.info("Photo rejected by triage: %s", reason)
+        metrics.TRIAGES.inc(verdict="rejected")
+        await emit(triage.rejection(reason))
+        return None
+
+    groups, skipped = triage.plan(verdict)
+    logger.info(
+        "Triage saw %s, running %s",
+        ", ".join(triage.visible_panels(verdict)),
+        ", ".join(f"{group['name']} ({group['max_tokens']} tokens)" for group in groups),
+    )
+    metrics.TRIAGES.inc(verdict="reduced" if skipped else "full")
+    return groups, skipped
+
+
+async def run_single(job, emit, waiter, groups=None, skipped=()):
+    # The whole analysis (or the planned part of it) as one prediction
+    try:
+        # Prepare input for nutrition analysis model
+        if skipped:
+            sections = [section for section in prompts.SCHEMA if section not in skipped]
+            max_tokens = min(4096, sum(group["max_tokens"] for group in groups))
+            input_data = prompts.build_sections_input(job["file_url"], sections, max_tokens)
+        else:
+            sections = list(prompts.SCHEMA)
+            input_data = prompts.build_input(job["file_url"])
+
+        # Run prediction on Replicate
+        prediction = await run_prediction(input_data, emit, waiter)
+
+        if prediction.status != "succeeded":
+            logger.warning("Prediction failed: %s %s", prediction.status, prediction.error)
+            await emit({"error": "Analysis failed"})
+            return
+
+        try:
+            result, degraded = await validated_output(
+                job, prediction, sections, emit, waiter
+            )
+        except json.JSONDecodeError as e:
+            logger.warning("JSON parsing error: %s", e)
+            await emit({"error": metrics.PARSE_ERROR})
+            return
+        except Exception:
+            logger.exception("Unexpected error, raw output: %s", prediction.output)
+            await emit({"error": "An unexpected error occurred while processing the response"})
+            return
+
+        missing = [section for section in degraded if section in prompts.REQUIRED_SECTIONS]
+        if missing:
+            # Only optional sections may ship as null
+            logger.warning("Required sections still invalid after repair: %s", ", ".join(missing))
+            await emit({"error": "Analysis failed"})
+            return
+
+        await finish_analysis(job, emit, assemble(result, degraded, skipped), cache=not degraded)
+
+    except Exception:
+        logger.exception("Analysis failed")
+        await emit({"error": "An unexpected error occurred"})
+
+
+class GroupFailed(Exception):
+    pass
+
+
+async def run_group(job, group, emit, waiter):
+    """Run one analysis group, returns its sections and the ones that stayed invalid."""
+    input_data = prompts.build_group_input(job["file_url"], group)
+    prediction = await run_prediction(input_data, emit, waiter)
+
+    if prediction.status != "succeeded":
+        raise GroupFailed(f"prediction {prediction.status}: {prediction.error}")
+
+    result, invalid = await validated_output(job, prediction, group["sections"], emit, waiter)
+
+    if not settings.ANALYSIS_STREAMING:
+        # Nothing was streamed, so send the group's sections as it finishes
+        for section in group["sections"]:
+            await emit({"section": section, "data": result[section]})
+
+    return result, invalid
+
+
+async def _run_group_with_timeout(job, group, emit, waiter):
+    # Returns (group, run_group result, error) so one failure doesn't cancel the others
+    if group["required"]:
+        timeout = settings.ANALYSIS_REQUIRED_GROUP_TIMEOUT
+    else:
+        timeout = settings.ANALYSIS_OPTIONAL_GROUP_TIMEOUT
+
+    try:
+        outcome = await asyncio.wait_for(run_group(job, group, emit, waiter), timeout)
+        return group, outcome, None
+    except asyncio.TimeoutError:
+        return group, None, GroupFailed(f"timed out after {timeout:g}s")
+    except Exception as e:
+        return group, None, e
+
+
+async def run_fan_out(job, emit, waiter, groups=None, skipped=()):
+    """Run the analysis groups as concurrent predictions and merge their sections.
+
+    `groups` defaults to all of prompts.ANALYSIS_GROUPS; sections triage
+    left out are null and listed in `skipped`. A required group failing, or
+    keeping invalid sections after its repair, fails the analysis. Any other
+    group that fails or times out has its sections set to null and listed in
+    `degraded`, as do its sections that stay invalid after a repair.
+    Degraded results are not cached.
+    """
+    tasks = [
+        asyncio.create_task(_run_group_with_timeout(job, group, emit, waiter))
+        for group in (prompts.ANALYSIS_GROUPS if groups is None else groups)
+    ]
+    merged = {}
+    degraded = []
+
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            group, outcome, error = await next_done
+
+            if error is None:
+                sections, invalid = outcome
+                if not (invalid and group["required"]):
+                    merged.update(sections)
+                    degraded += invalid
+                    continue
+                error = GroupFailed(f"sections still invalid after repair: {', '.join(invalid)}")
+
+            logger.warning("Analysis group %s failed: %s", group["name"], error)
+            if group["required"]:
+                if isinstance(error, json.JSONDecodeError):
+                    await emit({"error": metrics.PARSE_ERROR})
+                else:
+                    await emit({"error": "Analysis failed"})
+                return
+
+            degraded += group["sections"]
+            for section in group["sections"]:
+                await emit({"section": section, "data": None})
+
+        await finish_analysis(job, emit, assemble(merged, degraded, skipped), cache=not degraded)
+
+    except Exception:
+        logger.exception("Analysis failed")
+        await emit({"error": "An unexpected error occurred"})
+
+    finally:
+        # Stops the remaining groups (and their predictions) on failure or cancellation
+        for task in tasks:
+            task.cancel()
+
+
+def new_job(request_id, file_url, cache_key, priority=0, key=None):
+    # Plain dict so it can travel to a worker over the channel layer. Client
+    # messages go to the group of the analysis `key` (see results.analysis_key()
+    # and reply_emitter()), they name the client's own `request_id`.
+    return {
+        "id": uuid.uuid4().hex,
+        "request_id": request_id,
+        "key": key or request_id,
+        "file_url": file_url,
+        "cache_key": cache_key,
+        "priority": priority,
+    }
+
+
+async def submit(job, waiter):
+    """Queue a job on this process's scheduler, telling the client if it was shed.
+
+    The stored state records which channel hosts the job so any socket
+    following it can cancel it there.
+    """
+    emit = reply_emitter(job)
+    scheduler = get_scheduler()
+
+    # Cancelled while it was waiting for a worker to pick it up
+    if (await results.summary(job["key"]) or {}).get("status") == "cancelled":
+        return
+
+    accepted = scheduler.submit(AnalysisJob(
+        job["id"],
+        run=lambda: run_analysis(job, emit, waiter),
+        emit=emit,
+        priority=job["priority"],
+        width=prediction_width(),
+    ))
+    if not accepted:
+        await emit({
+            "error": "Server is busy, please try again shortly",
+            "retry_after": scheduler.retry_after(prediction_width())
+        })
+        return
+
+    await results.update(
+        job["key"],
+        status="running" if job["id"] in scheduler.running else "queued",
+        job_id=job["id"],
+        host_channel=waiter.channel_name,
+    )
+
+
+def cancel(job_id):
+    """Cancel a job queued or running on this process, along with its predictions."""
+    return get_scheduler().cancel(job_id)
@@ -0,0 +1,215 @@
+import hashlib
+import io
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import counters
+from .models import AnalysisCacheEntry
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:  # Pillow is optional, exact-match caching still works without it
+    Image = None
+
+HITS = "analysis_cache.hits"
+NEAR_HITS = "analysis_cache.near_hits"
+MISSES = "analysis_cache.misses"
+
+# The band lookup only guarantees a candidate when the distance is below the number of bands
+PHASH_BANDS = 4
+
+# Greyscale size and block size of the pixel comparison behind a near-duplicate
+# match. Fine enough that one changed digit on a label stands out in its block.
+FINGERPRINT_SIZE = (384, 384)
+FINGERPRINT_BLOCK = 8
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data):
+    """64-bit difference hash of the image as 16 hex chars, or None if it can't be decoded."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # Let the JPEG decoder scale down while decoding, we only need 9x8 pixels
+            img.draft('L', (64, 64))
+            pixels = list(img.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return f"{value:016x}"
+
+
+def fingerprint(data):
+    """zlib-compressed greyscale pixels at FINGERPRINT_SIZE, or b'' if the image can't be decoded."""
+    if Image is None:
+        return b''
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft('L', FINGERPRINT_SIZE)
+            pixels = img.convert('L').resize(FINGERPRINT_SIZE, Image.LANCZOS).tobytes()
+    except Exception:
+        return b''
+    return zlib.compress(pixels)
+
+
+def same_pixels(a, b):
+    """Whether two fingerprints show the same picture, allowing for re-encoding noise.
+
+    Compares the mean difference of every FINGERPRINT_BLOCK square, so a
+    small change like one digit on a nutrition label isn't averaged away.
+    """
+    if not a or not b or Image is None:
+        return False
+    difference = ImageChops.difference(
+        Image.frombytes('L', FINGERPRINT_SIZE, zlib.decompress(a)),
+        Image.frombytes('L', FINGERPRINT_SIZE, zlib.decompress(b)),
+    )
+    # A box downscale leaves one pixel per block holding its mean difference
+    blocks = difference.resize(
+        (FINGERPRINT_SIZE[0] // FINGERPRINT_BLOCK, FINGERPRINT_SIZE[1] // FINGERPRINT_BLOCK), Image.BOX
+    )
+    return blocks.getextrema()[1] <= settings.ANALYSIS_CACHE_PIXEL_TOLERANCE
+
+
+def image_key(data):
+    """Everything the cache needs to know about an image, computed once per upload."""
+    near_matches = settings.ANALYSIS_CACHE_PHASH_DISTANCE > 0
+    return {
+        'content_hash': content_hash(data),
+        'phash': perceptual_hash(data) or '',
+        # Only needed (and stored) when near-duplicate matching is on
+        'fingerprint': fingerprint(data) if near_matches else b'',
+        'image_size': len(data),
+    }
+
+
+def _bands(phash):
+    if not phash:
+        return [None] * PHASH_BANDS
+    return [int(phash[i * 4:(i + 1) * 4], 16) for i in range(PHASH_BANDS)]
+
+
+def _distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def _expiry_cutoff():
+    return timezone.now() - timedelta(seconds=settings.ANALYSIS_CACHE_MAX_AGE)
+
+
+def lookup(key, prompt_version):
+    """Return a cached analysis for an image key from `image_key`, or None.
+
+    Exact content matches are tried first. With ANALYSIS_CACHE_PHASH_DISTANCE
+    set, near-duplicate photos (re-encoded or resized copies) follow: the
+    perceptual hash only picks candidates, which must then match pixel for
+    pixel within ANALYSIS_CACHE_PIXEL_TOLERANCE. The hash alone can't tell
+    two text-heavy labels apart. Only entries produced with the same prompt
+    version count.
+    """
+    if not settings.ANALYSIS_CACHE_ENABLED:
+        return None
+
+    live = AnalysisCacheEntry.objects.filter(
+        prompt_version=prompt_version,
+        created_at__gte=_expiry_cutoff(),
+    )
+
+    entry = live.filter(content_hash=key['content_hash']).first()
+    counter = HITS
+
+    if entry is None:
+        phash = key['phash']
+        max_distance = settings.ANALYSIS_CACHE_PHASH_DISTANCE
+        if phash and max_distance > 0:
+            band_match = Q()
+            for i, band in enumerate(_bands(phash)):
+                band_match |= Q(**{f'phash_band{i}': band})
+            for candidate in live.filter(band_match).order_by('-last_hit_at')[:50]:
+                if (_distance(candidate.phash, phash) <= max_distance
+                        and same_pixels(candidate.fingerprint, key['fingerprint'])):
+                    entry = candidate
+                    counter = NEAR_HITS
+                    break
+
+    if entry is None:
+        counters.incr(MISSES)
+        return None
+
+    AnalysisCacheEntry.objects.filter(pk=entry.pk).update(
+        hit_count=F('hit_count') + 1,
+        last_hit_at=timezone.now(),
+    )
+    counters.incr(counter)
+    return entry.analysis_result
+
+
+def store(key, prompt_version, result):
+    """Save a finished analysis and evict whatever falls outside the size and age limits."""
+    if not settings.ANALYSIS_CACHE_ENABLED:
+        return
+
+    phash = key['phash']
+    bands = _bands(phash)
+    try:
+        AnalysisCacheEntry.objects.update_or_create(
+            content_hash=key['content_hash'],
+            prompt_version=prompt_version,
+            defaults={
+                'analysis_result': result,
+                'image_size': key['image_size'],
+                'phash': phash,
+                'fingerprint': key.get('fingerprint', b''),
+                **{f'phash_band{i}': band for i, band in enumerate(bands)},
+            },
+        )
+    except IntegrityError:
+        # Another worker stored the same image first
+        pass
+
+    evict()
+
+
+def evict():
+    AnalysisCacheEntry.objects.filter(created_at__lt=_expiry_cutoff()).delete()
+
+    max_entries = settings.ANALYSIS_CACHE_MAX_ENTRIES
+    stale_ids = (
+        AnalysisCacheEntry.objects
+        .order_by('-last_hit_at')
+        .values_list('pk', flat=True)[max_entries:]
+    )
+    stale_ids = list(stale_ids)
+    if stale_ids:
+        AnalysisCacheEntry.objects.filter(pk__in=stale_ids).delete()
+
+
+def invalidate(keep_prompt_version=None):
+    """Delete cached analyses, optionally keeping the ones for the current prompt version."""
+    entries = AnalysisCacheEntry.objects.all()
+    if keep_prompt_version:
+        entries = entries.exclude(prompt_version=keep_prompt_version)
+    deleted, _ = entries.delete()
+    return deleted
+
+
+def stats():
+    return {
+        **counters.snapshot(HITS, NEAR_HITS, MISSES),
+        'entries': AnalysisCacheEntry.objects.count(),
+    }
@@ -0,0 +1,212 @@
+import asyncio
+import gzip
+import json
+import mimetypes
+import os
+
+import brotli
+import rcssmin
+import rjsmin
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+# Worth storing compressed; images and fonts are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.svg', '.json', '.txt', '.html', '.xml', '.ico', '.map'}
+
+# Precompressed variants, in order of preference, by Content-Encoding
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Hashed names never change content, anything else may on the next deploy
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = 'public, max-age=300'
+
+CHUNK_SIZE = 64 * 1024
+
+
+def minify(name, content):
+    """Minified JS or CSS, other files (and ones already minified) as they are."""
+    if '.min.' in name:
+        return content
+    if name.endswith('.js'):
+        return rjsmin.jsmin(content.decode('utf-8')).encode('utf-8')
+    if name.endswith('.css'):
+        return rcssmin.cssmin(content.decode('utf-8')).encode('utf-8')
+    return content
+
+
+def compress(content):
+    """gzip and brotli variants of `content`, leaving out any that don't save at least 5%."""
+    variants = {
+        '.gz': gzip.compress(content, compresslevel=9, mtime=0),
+        '.br': brotli.compress(content, quality=11),
+    }
+    return {suffix: data for suffix, data in variants.items() if len(data) < len(content) * 0.95}
+
+
+class _MinifyingSource:
+    # Source storage for post_process that hands out minified JS and CSS, so
+    # the content hash and the hashed copy are both of the minified file
+    def __init__(self, storage):
+        self.storage = storage
+
+    def open(self, path):
+        with self.storage.open(path) as source:
+            content = source.read()
+        return ContentFile(minify(path, content), name=path)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """collectstatic storage writing minified, content-hashed files with .gz and .br variants.
+
+    Compression happens once at build time, the ASGI handler below only
+    picks the variant the client accepts.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            paths = {name: (_MinifyingSource(storage), path) for name, (storage, path) in paths.items()}
+        yield from super().post_process(paths, dry_run, **options)
+
+        if not dry_run:
+            for name in set(self.hashed_files.values()):
+                self.compress_file(name)
+
+    def compress_file(self, name):
+        if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+            return
+        with self.open(name) as f:
+            content = f.read()
+        for suffix, data in compress(content).items():
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            self._save(name + suffix, ContentFile(data))
+
+
+def accepted_encodings(header):
+    """Content codings an Accept-Encoding header allows, ignoring ones with q=0."""
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticFile:
+    def __init__(self, path, content_type, cache_control):
+        self.path = path
+        self.content_type = content_type
+        self.cache_control = cache_control
+        # Content-Encoding -> path and size, including None for the file itself
+        stat = os.stat(path)
+        self.variants = {None: (path, stat.st_size)}
+        self.etag = f'{stat.st_size:x}-{int(stat.st_mtime):x}'
+
+    def variant(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, _ in ENCODINGS:
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return None
+
+
+class PrecompressedStaticFiles:
+    """ASGI handler serving STATIC_ROOT in front of the Django application.
+
+    Sends the brotli or gzip file collectstatic wrote when the client accepts
+    it, so no CPU goes into compressing per request, and marks hashed files
+    as immutable for a year. Paths it doesn't know are passed on to
+    `application`.
+    """
+
+    def __init__(self, application, root=None, static_url=None):
+        self.application = application
+        self.root = root or settings.STATIC_ROOT
+        self.prefix = '/' + (static_url or settings.STATIC_URL).strip('/') + '/'
+        self.files = None
+
+    def load(self):
+        # Index of every collected file, built once from the build output
+        immutable = set()
+        manifest = os.path.join(self.root, 'staticfiles.json')
+        if os.path.exists(manifest):
+            with open(manifest, encoding='utf-8') as f:
+                immutable = set(json.load(f).get('paths', {}).values())
+
+        files = {}
+        for directory, _, names in os.walk(self.root):
+            for filename in names:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                    continue
+                content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                if content_type.startswith('text/') or content_type == 'application/javascript':
+                    content_type += '; charset=utf-8'
+                files[name] = StaticFile(
+                    path, content_type,
+                    IMMUTABLE_CACHE_CONTROL if name in immutable else DEFAULT_CACHE_CONTROL,
+                )
+                for encoding, suffix in ENCODINGS:
+                    if os.path.exists(path + suffix):
+                        files[name].variants[encoding] = (path + suffix, os.path.getsize(path + suffix))
+        return files
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            return await self.application(scope, receive, send)
+
+        if self.files is None:
+            self.files = await asyncio.to_thread(self.load)
+
+        static_file = self.files.get(scope['path'][len(self.prefix):])
+        if static_file is None or scope['method'] not in ('GET', 'HEAD'):
+            return await self.application(scope, receive, send)
+
+        headers = {
+            key.decode('latin-1').lower(): value.decode('latin-1')
+            for key, value in scope['headers']
+        }
+        encoding = static_file.variant(headers.get('accept-encoding', ''))
+        path, size = static_file.variants[encoding]
+        etag = f'"{static_file.etag}{"-" + encoding if encoding else ""}"'
+
+        response_headers = [
+            (b'cache-control', static_file.cache_control.encode()),
+            (b'etag', etag.encode()),
+            (b'vary', b'Accept-Encoding'),
+        ]
+
+        if etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+            await send({'type': 'http.response.start', 'status': 304, 'headers': response_headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        response_headers += [
+            (b'content-type', static_file.content_type.encode()),
+            (b'content-length', str(size).encode()),
+        ]
+        if encoding:
+            response_headers.append((b'content-encoding', encoding.encode()))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        with open(path, 'rb') as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, CHUNK_SIZE)
+                more_body = len(chunk) == CHUNK_SIZE
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+                if not more_body:
+                    break
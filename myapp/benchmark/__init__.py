@@ -0,0 +1 @@
+"""Offline load testing: a fake Replicate API and a load generator, see `manage.py loadtest`."""
@@ -0,0 +1,315 @@
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .. import prompts
+
+
+def sample_result():
+    """A complete analysis that passes validation, with every section of the schema."""
+    result = {section: None for section in prompts.SCHEMA}
+    result.update({
+        "product_info": {"serving_size": "1 bar (40 g)", "calories_per_serving": 190, "brand": "Benchmark"},
+        "nutrition_facts": {"total_fat_g": 7, "sodium_mg": 95, "total_sugars_g": 12, "protein_g": 4},
+        "ingredients": ["Oats", "Sugar", "Palm oil", "Salt"],
+        "notable_ingredients": ["Palm oil"],
+        "analysis": {
+            "positive_aspects": ["Whole grain oats"],
+            "negative_aspects": ["Added sugar"],
+            "health_score": 5.5,
+            "summary": "A sweet snack bar with some whole grains.",
+        },
+    })
+    return result
+
+
+def sample_triage():
+    """A triage verdict for a readable label showing both panels."""
+    return {"food_label": True, "legible": True, "panels": ["nutrition_facts", "ingredients"], "ingredient_count": 4}
+
+
+def _timestamp(seconds):
+    if seconds is None:
+        return None
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class FakePrediction:
+    def __init__(self, model, input_data, created, started, completed, failed, chunks, streamable, webhook):
+        self.id = uuid.uuid4().hex[:20]
+        self.model = model
+        self.input = input_data
+        self.created = created
+        self.started = started
+        self.completed = completed
+        self.failed = failed
+        self.chunks = chunks
+        self.streamable = streamable
+        self.webhook = webhook
+        self.canceled_at = None
+
+    def status(self, now):
+        if self.canceled_at is not None:
+            return "canceled"
+        if now < self.started:
+            return "starting"
+        if now < self.completed:
+            return "processing"
+        return "failed" if self.failed else "succeeded"
+
+    def to_json(self, base_url, now):
+        status = self.status(now)
+        finished = status in ("succeeded", "failed", "canceled")
+        completed = self.canceled_at if status == "canceled" else self.completed
+        urls = {
+            "get": f"{base_url}/v1/predictions/{self.id}",
+            "cancel": f"{base_url}/v1/predictions/{self.id}/cancel",
+        }
+        if self.streamable:
+            urls["stream"] = f"{base_url}/stream/{self.id}"
+        return {
+            "id": self.id,
+            "model": self.model,
+            "version": "fake",
+            "status": status,
+            "input": self.input,
+            "output": self.chunks if status == "succeeded" else None,
+            "logs": "",
+            "error": "Fake prediction failure" if status == "failed" else None,
+            "metrics": {
+                "predict_time": round(self.completed - self.started, 3),
+                "output_token_count": len(self.chunks),
+            } if status == "succeeded" else {},
+            "created_at": _timestamp(self.created),
+            "started_at": _timestamp(self.started) if now >= self.started else None,
+            "completed_at": _timestamp(completed) if finished else None,
+            "urls": urls,
+        }
+
+
+class FakeReplicate:
+    """A local stand-in for the Replicate API, for benchmarks and tests.
+
+    Serves what TruView uses: file uploads, model predictions with get,
+    cancel and server-sent event streams, and signed completion webhooks.
+    Predictions wait `queue_delay` seconds in "starting", generate for
+    `latency` seconds (give or take `jitter`), then succeed with a complete
+    analysis or fail at `failure_rate`. Triage predictions answer with
+    sample_triage() instead, generating for the share of `latency` their
+    shorter output takes. Runs in a background thread:
+
+        with FakeReplicate(latency=0.5) as fake:
+            ... REPLICATE_API_BASE_URL=fake.url ...
+    """
+
+    def __init__(self, latency=2.0, jitter=0.5, queue_delay=0.2, failure_rate=0.0, stream=True,
+                 chunk_size=40, webhook_secret=None, port=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.queue_delay = queue_delay
+        self.failure_rate = failure_rate
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.webhook_secret = webhook_secret
+        self.port = port
+        self.random = random.Random(seed)
+        self.output = json.dumps(sample_result())
+        self.triage_output = json.dumps(sample_triage())
+        self.predictions = {}
+        self.stats = {"files": 0, "file_bytes": 0, "predictions": 0, "cancels": 0, "streams": 0, "webhooks": 0}
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        handler = type("Handler", (_Handler,), {"fake": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-replicate", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def create_prediction(self, model, body):
+        now = time.time()
+        latency = max(0.0, self.random.uniform(self.latency - self.jitter, self.latency + self.jitter))
+        output = self.output
+        if body.get("input", {}).get("prompt") == prompts.TRIAGE_PROMPT:
+            output = self.triage_output
+            latency *= len(output) / len(self.output)
+        started = now + self.queue_delay
+        prediction = FakePrediction(
+            model, body.get("input", {}), now, started, started + latency,
+            failed=self.random.random() < self.failure_rate,
+            # Output comes back as a list of tokens, like the language models on Replicate
+            chunks=[output[i:i + self.chunk_size] for i in range(0, len(output), self.chunk_size)],
+            streamable=self.stream and bool(body.get("stream")),
+            webhook=body.get("webhook"),
+        )
+        with self.lock:
+            self.predictions[prediction.id] = prediction
+            self.stats["predictions"] += 1
+
+        if prediction.webhook:
+            timer = threading.Timer(prediction.completed - now, self.send_webhook, [prediction])
+            timer.daemon = True
+            timer.start()
+        return prediction
+
+    def send_webhook(self, prediction):
+        if prediction.canceled_at is not None:
+            return
+        body = json.dumps(prediction.to_json(self.url, time.time())).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.webhook_secret:
+            webhook_id = f"msg_{uuid.uuid4().hex}"
+            timestamp = str(int(time.time()))
+            key = base64.b64decode(self.webhook_secret.split("_", 1)[-1])
+            signed = f"{webhook_id}.{timestamp}.".encode() + body
+            signature = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+            headers.update({
+                "webhook-id": webhook_id,
+                "webhook-timestamp": timestamp,
+                "webhook-signature": f"v1,{signature}",
+            })
+        try:
+            request = urllib.request.Request(prediction.webhook, data=body, headers=headers, method="POST")
+            urllib.request.urlopen(request, timeout=10).close()
+            self.count("webhooks")
+        except OSError:
+            # Like Replicate, a failed delivery is left to the client's polling
+            pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        body = self.read_body()
+
+        if parts == ["v1", "files"]:
+            self.fake.count("files")
+            self.fake.count("file_bytes", len(body))
+            file_id = uuid.uuid4().hex
+            self.send_json(201, {
+                "id": file_id,
+                "name": "upload.jpg",
+                "content_type": "image/jpeg",
+                "size": len(body),
+                "etag": hashlib.md5(body).hexdigest(),
+                "checksums": {},
+                "metadata": {},
+                "created_at": _timestamp(time.time()),
+                "expires_at": None,
+                "urls": {"get": f"{self.fake.url}/v1/files/{file_id}"},
+            })
+        elif len(parts) == 5 and parts[:2] == ["v1", "models"] and parts[4] == "predictions":
+            prediction = self.fake.create_prediction(f"{parts[2]}/{parts[3]}", json.loads(body or b"{}"))
+            self.send_json(201, prediction.to_json(self.fake.url, time.time()))
+        elif len(parts) == 4 and parts[:2] == ["v1", "predictions"] and parts[3] == "cancel":
+            prediction = self.fake.predictions.get(parts[2])
+            if prediction is None:
+                self.send_json(404, {"detail": "Not found"})
+                return
+            if prediction.status(time.time()) in ("starting", "processing"):
+                prediction.canceled_at = time.time()
+                self.fake.count("cancels")
+            self.send_json(200, prediction.to_json(self.fake.url, time.time()))
+        else:
+            self.send_json(404, {"detail": "Not found"})
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+
+        if len(parts) == 3 and parts[:2] == ["v1", "predictions"]:
+            prediction = self.fake.predictions.get(parts[2])
+            if prediction is None:
+                self.send_json(404, {"detail": "Not found"})
+                return
+            self.send_json(200, prediction.to_json(self.fake.url, time.time()))
+        elif len(parts) == 2 and parts[0] == "stream" and parts[1] in self.fake.predictions:
+            prediction = self.fake.predictions[parts[1]]
+            if not prediction.streamable:
+                self.send_json(404, {"detail": "Not found"})
+                return
+            self.send_stream(prediction)
+        else:
+            self.send_json(404, {"detail": "Not found"})
+
+    def send_stream(self, prediction):
+        # Tokens spread evenly over the generation time, the body ends with the connection
+        self.fake.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        event_ids = iter(range(1, 1_000_000))
+
+        def event(name, data):
+            # The SDK drops events without an id
+            self.wfile.write(f"event: {name}\nid: {next(event_ids)}\ndata: {data}\n\n".encode())
+            self.wfile.flush()
+
+        time.sleep(max(0.0, prediction.started - time.time()))
+        step = (prediction.completed - prediction.started) / max(1, len(prediction.chunks))
+        try:
+            for chunk in prediction.chunks:
+                if prediction.canceled_at is not None:
+                    event("done", json.dumps({"reason": "canceled"}))
+                    return
+                time.sleep(step)
+                event("output", chunk)
+            if prediction.failed:
+                event("error", json.dumps({"detail": "Fake prediction failure"}))
+            else:
+                event("done", "{}")
+        except OSError:
+            # The client went away mid-stream
+            pass
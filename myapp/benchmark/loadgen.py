@@ -0,0 +1,257 @@
+import asyncio
+import gc
+import io
+import math
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+import httpx
+from channels.layers import get_channel_layer
+from channels.routing import get_default_application
+from channels.testing import WebsocketCommunicator
+from PIL import Image, ImageDraw
+
+from .. import metrics, predictions, uploads
+
+SOCKET_PATH = "/ws/nutrition-analysis/"
+
+# Seen by a virtual user: the upload request, then from sending the analysis
+# request to its receipt, the first streamed section and the final message
+CLIENT_STAGES = ("upload", "receipt", "first_section", "result")
+
+
+def label_image(seed):
+    """A small JPEG "label", different for every seed so no two uploads are the same photo."""
+    rng = random.Random(seed)
+    img = Image.new("RGB", (640, 480), "white")
+    draw = ImageDraw.Draw(img)
+    for row in range(12):
+        y = 30 + row * 34
+        draw.rectangle([40, y, 40 + rng.randint(150, 550), y + 14], fill="black")
+    for _ in range(400):
+        x, y = rng.randrange(640), rng.randrange(480)
+        draw.point((x, y), fill=(rng.randrange(256),) * 3)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def percentile(values, q):
+    # Nearest rank, exact for the small samples a benchmark run produces
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def open_fds():
+    """Open sockets, files and event loops of this process, None where /proc is missing.
+
+    Pipes are left out: they belong to the preprocessing process pool, which
+    starts workers on demand (up to PREPROCESS_WORKERS) and would look like a leak.
+    """
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            if not os.readlink(f"/proc/self/fd/{fd}").startswith("pipe:"):
+                count += 1
+        except OSError:
+            # Closed since it was listed, like the listing's own descriptor
+            pass
+    return count
+
+
+def temp_files():
+    return set(os.listdir(tempfile.gettempdir()))
+
+
+async def virtual_user(app, seed, iterations, timeout, timings, outcomes):
+    """One browser: loads the page, then uploads and analyzes photos one after another on one socket."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost") as http:
+        # The page sets the client cookie the upload rate limit is keyed on
+        await http.get("/")
+        socket = WebsocketCommunicator(app, SOCKET_PATH)
+        connected, _ = await socket.connect()
+        if not connected:
+            outcomes["socket_refused"] += iterations
+            return
+
+        try:
+            for iteration in range(iterations):
+                started = time.perf_counter()
+                response = await http.post("/upload-image/", files={
+                    "image": ("label.jpg", label_image(f"{seed}-{iteration}"), "image/jpeg"),
+                })
+                timings["upload"].append(time.perf_counter() - started)
+                upload = response.json()
+                if not upload.get("success"):
+                    outcomes[f"upload failed: {upload.get('error')}"] += 1
+                    continue
+
+                request_id = uuid.uuid4().hex
+                sent = time.perf_counter()
+                await socket.send_json_to({"id": request_id, "upload_id": upload["upload_id"]})
+                first_section = True
+                while True:
+                    try:
+                        message = await socket.receive_json_from(timeout=timeout)
+                    except asyncio.TimeoutError:
+                        # The socket is in an unknown state, this user stops here
+                        outcomes["timeout"] += iterations - iteration
+                        return
+                    if message.get("id") != request_id:
+                        continue
+                    elapsed = time.perf_counter() - sent
+                    if "received" in message:
+                        timings["receipt"].append(elapsed)
+                    elif "section" in message and first_section:
+                        timings["first_section"].append(elapsed)
+                        first_section = False
+                    elif "analysis_result" in message:
+                        outcomes["success"] += 1
+                        break
+                    elif "error" in message:
+                        outcomes[f"error: {message['error']}"] += 1
+                        break
+                timings["result"].append(time.perf_counter() - sent)
+        finally:
+            await socket.disconnect()
+
+
+async def socket_memory(app, count):
+    """Python memory held per open, idle analysis socket.
+
+    Includes the in-process test client's side of each connection, so treat
+    it as an upper bound for the consumer.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        sockets = [WebsocketCommunicator(app, SOCKET_PATH) for _ in range(count)]
+        for socket in sockets:
+            await socket.connect()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    for socket in sockets:
+        await socket.disconnect()
+    return round((after - before) / count)
+
+
+async def settle():
+    # Let disconnect handlers and closed connections finish before counting what is left
+    await predictions.close_clients()
+    await asyncio.sleep(0.2)
+    gc.collect()
+
+
+async def run_load(users, iterations, idle_sockets=0, timeout=120):
+    """Drive the upload view and analysis socket with `users` concurrent virtual users.
+
+    Runs the ASGI application in this process, so everything below the
+    socket (views, consumer, scheduler, Replicate client) is the real code
+    path. Point REPLICATE_API_BASE_URL at a FakeReplicate first. Returns the
+    report as a dict, see format_report().
+    """
+    app = get_default_application()
+    # Clients from before may point at another Replicate
+    await predictions.close_clients()
+
+    # One analysis per user first, so pools, threads and database connections
+    # have grown to what this load needs before the baseline for leak checks
+    await asyncio.gather(*(
+        virtual_user(app, f"warmup-{user}", 1, timeout, {stage: [] for stage in CLIENT_STAGES}, Counter())
+        for user in range(users)
+    ))
+    await settle()
+    fds_before = open_fds()
+    temp_before = temp_files()
+    uploads_before = len(uploads.store.uploads)
+
+    timings = {stage: [] for stage in CLIENT_STAGES}
+    outcomes = Counter()
+    started = time.perf_counter()
+    with metrics.recording(metrics.STAGE_SECONDS) as observations:
+        await asyncio.gather(*(
+            virtual_user(app, user, iterations, timeout, timings, outcomes)
+            for user in range(users)
+        ))
+    duration = time.perf_counter() - started
+
+    memory_per_socket = await socket_memory(app, idle_sockets) if idle_sockets else None
+
+    await settle()
+    fds_after = open_fds()
+    layer = get_channel_layer()
+
+    server_stages = {}
+    for stage, seconds in observations:
+        server_stages.setdefault(stage, []).append(seconds)
+
+    return {
+        "users": users,
+        "iterations": iterations,
+        "duration_s": round(duration, 3),
+        "throughput_per_s": round(outcomes["success"] / duration, 3) if duration else 0,
+        "outcomes": dict(outcomes),
+        "client_stages": {stage: summarize(timings[stage]) for stage in CLIENT_STAGES},
+        "server_stages": {stage: summarize(server_stages[stage]) for stage in metrics.STAGES if stage in server_stages},
+        "memory_per_socket_bytes": memory_per_socket,
+        "leaks": {
+            "fds": None if fds_before is None else fds_after - fds_before,
+            "temp_files": len(temp_files() - temp_before),
+            "uploads": len(uploads.store.uploads) - uploads_before,
+            # In-memory layer only: groups a consumer joined and never left
+            "channel_groups": len(getattr(layer, "groups", {})),
+        },
+    }
+
+
+def has_leaks(report):
+    return any(report["leaks"].values())
+
+
+def format_report(report):
+    lines = [
+        f"{report['users']} users x {report['iterations']} analyses in {report['duration_s']:.1f} s: "
+        f"{report['throughput_per_s']:.2f} analyses/s",
+        "Outcomes: " + ", ".join(f"{name} {count}" for name, count in sorted(report["outcomes"].items())),
+        "",
+        f"{'stage':<26}{'p50':>10}{'p95':>10}{'p99':>10}{'count':>8}",
+    ]
+    for title, stages in (("client", report["client_stages"]), ("server", report["server_stages"])):
+        for stage, summary in stages.items():
+            if not summary["count"]:
+                continue
+            cells = "".join(f"{summary[q] * 1000:>8.0f}ms" for q in ("p50", "p95", "p99"))
+            lines.append(f"{title + ' ' + stage:<26}{cells}{summary['count']:>8}")
+    lines.append("")
+    if report["memory_per_socket_bytes"] is not None:
+        lines.append(f"Memory per open socket: {report['memory_per_socket_bytes'] / 1024:.1f} KiB")
+    leaks = report["leaks"]
+    lines.append(
+        f"Left behind: {leaks['fds']} file descriptors, {leaks['temp_files']} temp files, "
+        f"{leaks['uploads']} uploads, {leaks['channel_groups']} channel groups"
+    )
+    return "\n".join(lines)
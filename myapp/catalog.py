@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import os
+import tarfile
+import threading
+import uuid
+import zipfile
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import analysis, log, predictions, triage, uploads
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.heic'}
+MANIFEST_EXTENSIONS = {'.txt', '.csv', '.jsonl', '.ndjson'}
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogItem:
+    """One image of a catalog, or the reason it couldn't be read."""
+
+    def __init__(self, item_id, data=None, error=None):
+        self.id = item_id
+        self.data = data
+        self.error = error
+
+
+def _is_image(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _read_file(item_id, path):
+    try:
+        with open(path, 'rb') as f:
+            return CatalogItem(item_id, f.read())
+    except OSError as e:
+        return CatalogItem(item_id, error=str(e))
+
+
+def iter_catalog(source, skip=frozenset()):
+    """Lazily yield the images of a directory, .zip or .tar archive, or manifest.
+
+    Nothing is listed or read up front, so the size of the catalog doesn't
+    matter. Item ids are paths relative to the catalog, or the manifest's `id`;
+    ids in `skip` are passed over without reading them. Reading is blocking,
+    so pull items from a thread.
+    """
+    if os.path.isdir(source):
+        return _iter_directory(source, skip)
+    if zipfile.is_zipfile(source):
+        return _iter_zip(source, skip)
+    if tarfile.is_tarfile(source):
+        return _iter_tar(source, skip)
+    if os.path.splitext(source)[1].lower() in MANIFEST_EXTENSIONS:
+        return _iter_manifest(source, skip)
+    raise ValueError(f"Not a directory, archive or manifest: {source}")
+
+
+def _iter_directory(root, skip):
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            item_id = os.path.relpath(path, root)
+            if _is_image(name) and item_id not in skip:
+                yield _read_file(item_id, path)
+
+
+def _iter_zip(source, skip):
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            if not info.is_dir() and _is_image(info.filename) and info.filename not in skip:
+                yield CatalogItem(info.filename, archive.read(info))
+
+
+def _iter_tar(source, skip):
+    with tarfile.open(source) as archive:
+        while True:
+            member = archive.next()
+            if member is None:
+                break
+            # TarFile remembers every member it has seen, we don't need them
+            archive.members = []
+            if member.isfile() and _is_image(member.name) and member.name not in skip:
+                yield CatalogItem(member.name, archive.extractfile(member).read())
+
+
+def _iter_manifest(source, skip):
+    # One image per line: a path, or {"id": ..., "path": ...} as JSON.
+    # Relative paths are relative to the manifest. A malformed line becomes an
+    # error item named after its line number, the rest of the run goes on.
+    root = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding='utf-8') as manifest:
+        for number, line in enumerate(manifest, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                if line.startswith('{'):
+                    entry = json.loads(line)
+                    path = os.fspath(entry['path'])
+                    item_id = entry.get('id', path)
+                else:
+                    path = item_id = line
+            except (ValueError, KeyError, TypeError) as e:
+                yield CatalogItem(f"{os.path.basename(source)}:{number}", error=f"Invalid manifest line: {e!r}")
+                continue
+            if str(item_id) not in skip:
+                yield _read_file(str(item_id), os.path.join(root, path))
+
+
+def completed_ids(output_path):
+    """Ids already analyzed successfully in an earlier run's NDJSON output."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding='utf-8') as output:
+        for line in output:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash, that item runs again
+                continue
+            if record.get('status') == 'ok':
+                done.add(record['id'])
+    return done
+
+
+def open_output(output_path):
+    # Append so a resumed run keeps earlier results, starting on a fresh line
+    # in case the last run died halfway through writing one
+    output = open(output_path, 'a+', encoding='utf-8')
+    if output.tell():
+        output.seek(output.tell() - 1)
+        if output.read(1) != '\n':
+            output.write('\n')
+    return output
+
+
+class PollingWaiter:
+    # No consumer to receive webhooks in a management command, poll instead
+    async def wait_for_prediction(self, prediction):
+        return await predictions.wait_for_prediction(prediction)
+
+
+async def analyze_item(item):
+    """Analyze one catalog image the same way the WebSocket consumer does.
+
+    Returns the NDJSON record for it.
+    """
+    if item.error:
+        return {'id': item.id, 'status': 'error', 'error': item.error}
+    upload = uploads.Upload(uuid.uuid4().hex, item.data, None)
+    item.data = None
+
+    cache_key, cached_result = await database_sync_to_async(analysis.lookup_cached)(upload.view)
+    if cached_result is not None:
+        return {'id': item.id, 'status': 'ok', 'cached': True, 'result': cached_result}
+
+    file_url = await uploads.async_prepare(upload)
+    reason = triage.check_photo(upload.preprocess_stats) if settings.ANALYSIS_TRIAGE else None
+    del upload
+    if reason is not None:
+        return {'id': item.id, 'status': 'error', 'error': triage.REJECTIONS[reason]}
+
+    messages = []
+
+    async def emit(message):
+        # Only the final result or error goes in the output, not streamed sections
+        if 'analysis_result' in message or 'error' in message:
+            messages.append(message)
+
+    job = analysis.new_job(item.id, file_url, cache_key)
+    await analysis.run_analysis(job, emit, PollingWaiter())
+
+    if messages and 'analysis_result' in messages[-1]:
+        return {'id': item.id, 'status': 'ok', 'cached': False, 'result': messages[-1]['analysis_result']}
+    error = messages[-1]['error'] if messages else "Analysis produced no result"
+    return {'id': item.id, 'status': 'error', 'error': error}
+
+
+async def run_catalog(items, write, concurrency):
+    """Analyze catalog items, `concurrency` at a time, passing each record to `write`.
+
+    Workers pull from the item iterator as they free up, so only the images
+    in flight are ever held in memory.
+    """
+    items = iter(items)
+    lock = threading.Lock()
+    totals = {'ok': 0, 'error': 0}
+
+    def next_item():
+        # Reads files in a thread, one worker at a time since generators aren't thread-safe
+        with lock:
+            return next(items, None)
+
+    async def worker():
+        while (item := await asyncio.to_thread(next_item)) is not None:
+            log.request_id.set(item.id)
+            try:
+                record = await analyze_item(item)
+            except Exception as e:
+                logger.exception("Catalog item %s failed", item.id)
+                record = {'id': item.id, 'status': 'error', 'error': str(e)}
+            totals[record['status']] += 1
+            write(record)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return totals
@@ -0,0 +1,24 @@
+from django.core import signing
+
+# Signed cookie identifying a browser, set by the index page without a session
+# write. It keys rate limits and scopes the request ids of its analyses.
+CLIENT_COOKIE = 'client_id'
+CLIENT_COOKIE_SALT = 'myapp.client_id'
+CLIENT_COOKIE_MAX_AGE = 365 * 24 * 60 * 60  # 1 year
+
+
+def from_request(request):
+    """The client id of an HTTP request, '' if it has no valid cookie."""
+    return request.get_signed_cookie(CLIENT_COOKIE, default='', salt=CLIENT_COOKIE_SALT)
+
+
+def from_scope(scope):
+    """The client id of a WebSocket connection, '' if it has no valid cookie."""
+    value = scope.get('cookies', {}).get(CLIENT_COOKIE)
+    if not value:
+        return ''
+    # Same signer as HttpResponse.set_signed_cookie()
+    try:
+        return signing.get_cookie_signer(salt=CLIENT_COOKIE + CLIENT_COOKIE_SALT).unsign(value)
+    except signing.BadSignature:
+        return ''
@@ -1,136 +1,310 @@
-import os
 import json
 import asyncio
-import replicate
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
 from django.conf import settings
+from channels.consumer import AsyncConsumer
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-class NutritionAnalysisConsumer(AsyncWebsocketConsumer):
+from . import analysis, clients, log, metrics, predictions, results, triage, uploads
+
+logger = logging.getLogger(__name__)
+
+# Pending cancellations of analyses whose socket went away, kept so they aren't garbage collected
+_abandoned_checks = set()
+
+
+class PredictionWaiterMixin:
+    """Lets a consumer host analysis jobs: waits for predictions that report
+    completion by webhook, and cancels jobs for sockets on other processes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Futures for predictions waiting on a webhook, keyed by prediction id
+        self.prediction_waiters = {}
+
+    async def wait_for_prediction(self, prediction):
+        if not predictions.webhook_url() or self.channel_layer is None:
+            return await predictions.wait_for_prediction(prediction)
+
+        group = predictions.group_name(prediction.id)
+        completed = asyncio.get_running_loop().create_future()
+        self.prediction_waiters[prediction.id] = completed
+        await self.channel_layer.group_add(group, self.channel_name)
+        try:
+            return await predictions.wait_for_prediction(prediction, completed)
+        finally:
+            self.prediction_waiters.pop(prediction.id, None)
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def prediction_completed(self, event):
+        # Sent by the Replicate webhook view through the channel layer
+        completed = self.prediction_waiters.get(event["prediction_id"])
+        if completed is not None and not completed.done():
+            completed.set_result(event["status"])
+
+    async def analysis_cancel(self, event):
+        # Sent by a socket following a job this consumer hosts
+        analysis.cancel(event["job_id"])
+
+
+class RecentIds:
+    """Request ids seen recently on one socket, bounded in both count and age."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.seen = OrderedDict()
+
+    def add(self, key):
+        """Remember `key`, returns False if it was already seen within the TTL."""
+        now = time.monotonic()
+        while self.seen and now - next(iter(self.seen.values())) > self.ttl:
+            self.seen.popitem(last=False)
+
+        if key in self.seen:
+            return False
+        self.seen[key] = now
+        if len(self.seen) > self.max_size:
+            self.seen.popitem(last=False)
+        return True
+
+
+class NutritionAnalysisConsumer(PredictionWaiterMixin, AsyncWebsocketConsumer):
     async def connect(self):
-        self.request_id_set = set()
+        # Request ids are scoped to the browser's cookie. A socket without one
+        # is a client of its own, its analyses can't be resumed elsewhere.
+        self.client_id = clients.from_scope(self.scope) or uuid.uuid4().hex
+        self.recent_ids = RecentIds(settings.ANALYSIS_DEDUP_MAX_IDS, settings.ANALYSIS_DEDUP_TTL)
+        # Analyses still being prepared (cache lookup, upload), keyed by request id
+        self.analysis_tasks = {}
+        # Unfinished analyses whose messages this socket receives, started here or resumed
+        self.following = set()
+        self.closed = False
         await self.accept()
-        print("Connection established: Nutrition Analysis")
+        metrics.OPEN_SOCKETS.inc()
+        logger.info("Connection established: Nutrition Analysis")
 
     async def disconnect(self, close_code):
-        print(f"Connection closed: {close_code}")
+        self.closed = True
+        metrics.OPEN_SOCKETS.dec()
+        for request_id in self.following:
+            await self.channel_layer.group_discard(results.group_name(self.analysis_key(request_id)),
+                                                   self.channel_name)
+
+        # Keep the analyses running for a while so the client can resume them,
+        # then stop paying for the ones nobody came back for
+        if self.following:
+            task = asyncio.create_task(self.cancel_abandoned(list(self.following)))
+            _abandoned_checks.add(task)
+            task.add_done_callback(_abandoned_checks.discard)
+        logger.info("Connection closed: %s", close_code)
+
+    async def cancel_abandoned(self, request_ids):
+        await asyncio.sleep(settings.ANALYSIS_RESUME_GRACE)
+        for request_id in request_ids:
+            if await results.owner(self.analysis_key(request_id)) == self.channel_name:
+                log.request_id.set(request_id)
+                if await self.cancel_analysis(request_id):
+                    logger.info("Cancelled, nobody resumed it")
 
     async def receive(self, text_data=None, bytes_data=None):
         data = json.loads(text_data)
-        request_id = data.get("id", "none")
-        
+
+        if "cancel" in data:
+            if await self.cancel_analysis(data["cancel"]):
+                await self.send_message(data["cancel"], {"cancelled": True})
+            return
+
+        if "resume" in data:
+            await self.resume(data["resume"])
+            return
+
+        request_id = data.get("id")
+        if not results.valid_request_id(request_id):
+            await self.send(json.dumps({"error": "Invalid request id"}))
+            return
+
         # Prevent duplicate processing
-        if request_id in self.request_id_set:
+        if not self.recent_ids.add(request_id):
+            return
+
+        if len(self.following) >= settings.ANALYSIS_MAX_PER_SOCKET:
+            await self.send_message(request_id, {"error": "Too many analyses in progress, please wait"})
             return
-        self.request_id_set.add(request_id)
-        
+
+        # Ids are never reused, that would wipe an analysis the client may still resume
+        if not await results.start(self.analysis_key(request_id)):
+            await self.send_message(request_id, {"error": "Request id already used"})
+            return
+        await self.follow(request_id)
+
         # Send receipt to client
-        await self.send(json.dumps({"received": "true"}))
-        
-        image_filename = data.get("image_filename")
-        if not image_filename:
-            await self.send(json.dumps({"error": "No image filename provided"}))
+        await self.send_message(request_id, {"received": "true"})
+
+        # Run the analysis as a task so this consumer keeps dispatching other
+        # messages and channel layer events (results, webhook wake-ups) meanwhile
+        task = asyncio.create_task(self.analyze(request_id, data))
+        self.analysis_tasks[request_id] = task
+        task.add_done_callback(lambda _: self.analysis_tasks.pop(request_id, None))
+
+    async def send_message(self, request_id, message):
+        # Every message names its request, several can be in flight on one socket
+        if not self.closed:
+            await self.send(json.dumps({**message, "id": request_id}))
+
+    def analysis_key(self, request_id):
+        return results.analysis_key(self.client_id, request_id)
+
+    async def finish(self, request_id, message):
+        # Final message produced by this consumer rather than the analysis job
+        await results.record_message(self.analysis_key(request_id), message)
+        await self.unfollow(request_id)
+        await self.send_message(request_id, message)
+
+    async def follow(self, request_id):
+        self.following.add(request_id)
+        await results.claim(self.analysis_key(request_id), self.channel_name)
+        await self.channel_layer.group_add(results.group_name(self.analysis_key(request_id)), self.channel_name)
+
+    async def unfollow(self, request_id):
+        self.following.discard(request_id)
+        await self.channel_layer.group_discard(results.group_name(self.analysis_key(request_id)), self.channel_name)
+
+    async def resume(self, request_id):
+        """Re-attach to an analysis this client started on an earlier socket, or replay its result."""
+        if not results.valid_request_id(request_id):
+            await self.send(json.dumps({"error": "Invalid request id"}))
+            return
+
+        record = await results.get(self.analysis_key(request_id))
+        if record is None:
+            await self.send_message(request_id, {"error": "Analysis not found or expired, please try again"})
             return
-            
-        # Construct full path to uploaded image
-        image_path = os.path.join(settings.MEDIA_ROOT, 'temp', image_filename)
-        
+
+        if record["status"] not in results.FINISHED_STATUSES:
+            await self.follow(request_id)
+            # It may have finished before we joined its group
+            record = await results.get(self.analysis_key(request_id)) or record
+
+        if record["status"] in results.FINISHED_STATUSES:
+            await self.unfollow(request_id)
+            await self.send_message(request_id, record["final"])
+            return
+
+        await self.send_message(request_id, {
+            "resumed": True,
+            "status": record["status"],
+            "sections": record["sections"],
+        })
+
+    async def cancel_analysis(self, request_id):
+        """Cancel an analysis this socket follows, wherever it runs. Returns True if it was found."""
+        if not results.valid_request_id(request_id) or request_id not in self.following:
+            return False
+
+        task = self.analysis_tasks.pop(request_id, None)
+        if task is not None:
+            task.cancel()
+
+        await self.unfollow(request_id)
+        record = await results.summary(self.analysis_key(request_id)) or {"status": "preparing"}
+        if record["status"] in results.FINISHED_STATUSES:
+            return False
+
+        job_id = record.get("job_id")
+        if job_id:
+            # Inline jobs run on this process's scheduler, worker jobs on their host
+            if not analysis.cancel(job_id) and record["host_channel"] != self.channel_name:
+                await self.channel_layer.send(record["host_channel"], {
+                    "type": "analysis.cancel",
+                    "job_id": job_id,
+                })
+
+        await results.record_message(self.analysis_key(request_id), {"cancelled": True})
+        return True
+
+    async def analyze(self, request_id, data):
+        # Runs as its own task, so this tags every log line of the analysis
+        log.request_id.set(request_id)
+        logger.info("Analysis requested for upload %s", data.get("upload_id"))
+        upload_id = data.get("upload_id")
+        if not upload_id:
+            await self.finish(request_id, {"error": "No upload id provided"})
+            return
+
+        upload = await uploads.claim(upload_id)
+        if upload is None:
+            await self.finish(request_id, {"error": "Upload expired, please upload the image again"})
+            return
+
         try:
+            # Serve repeat photos straight from the analysis cache
+            cache_key, cached_result = await database_sync_to_async(analysis.lookup_cached)(upload.view)
+            if cached_result is not None:
+                await self.finish(request_id, {
+                    "analysis_result": cached_result,
+                    "cached": True
+                })
+                return
+
             # Upload image to Replicate
-            file_url = await self.upload_to_replicate(image_path, filename=image_filename)
-            
-            # Prepare input for nutrition analysis model
-            input_data={
-                "top_p": 1,
-                "prompt": "**Comprehensive Food Analysis Requirements:**\n\n1.  **Data Extraction:**\n    * Extract all visible **nutrition facts** (values and % Daily Values, if present) based on the stated serving size.\n    * Extract the complete **ingredient list**.\n    * If crucial information (like the ingredient list or full nutrition panel) is not visible, you must note this in the summary and make the best possible analysis based on what *is* visible.\n\n2.  **Deep Ingredient Assessment:**\n    * Identify **notable or concerning ingredients** such as: added sugars (e.g., corn syrup, dextrose), artificial sweeteners (aspartame, sucralose), artificial colors (Red 40, Yellow 5, Blue 1), artificial flavors, chemical preservatives (BHA, BHT, sodium nitrite), high levels of sodium or saturated fat, and highly refined oils (palm oil, hydrogenated oils).\n    * For each concerning ingredient, provide:\n        - **Purpose**: Why manufacturers use this ingredient\n        - **Health Concerns**: Documented health risks and controversies\n        - **Industry Context**: Why it's controversial (e.g., regulatory status, bans in other countries)\n        - **Hidden Names**: Alternative names the ingredient might be listed under\n\n3.  **Processing Level Analysis:**\n    * Assess the **processing level** of the product (minimally processed, processed, ultra-processed)\n    * Explain **why processing matters** for health (nutrient loss, added chemicals, calorie density)\n    * Identify **processing indicators** in the ingredient list (e.g., isolated proteins, refined flours, modified starches)\n\n4.  **Hidden Sugar Analysis:**\n    * Identify **all forms of added sugar** in the product\n    * Calculate **total sugar equivalents** (including all hidden sugars)\n    * List **alternative names for sugar** used in the product\n    * Compare sugar content to **daily recommended limits**\n\n5.  **Additive Impact Assessment:**\n    * For each **food additive** (preservatives, colors, flavors, emulsifiers, etc.):\n        - **Function**: What the additive does in the product\n        - **Health Impact**: Known or suspected health effects\n        - **Regulatory Status**: Approved levels, bans in other countries\n        - **Natural Alternatives**: What could be used instead\n\n6.  **GMO Information:**\n    * Assess likelihood of **GMO ingredients** (corn, soy, canola, sugar beets, etc.)\n    * Explain **GMO concerns** (environmental impact, health questions)\n    * Note if product is **Non-GMO Project Verified** or organic\n\n7.  **Environmental Impact:**\n    * Assess **environmental footprint** of key ingredients\n    * Note **sustainability concerns** (palm oil, overfishing, water usage)\n    * Identify **eco-certifications** if present\n\n8.  **Ethical Considerations:**\n    * Note any **ethical concerns** (child labor, unfair trade, animal welfare)\n    * Identify **ethical certifications** (Fair Trade, Rainforest Alliance, etc.)\n\n9.  **Allergen Information:**\n    * Identify **major allergens** beyond the top 8 (milk, eggs, fish, crustacean shellfish, tree nuts, peanuts, wheat, soybeans)\n    * Note **cross-contamination risks** if mentioned\n    * Identify **hidden allergens** (e.g., natural flavors, spices)\n\n10. **Microplastic Contamination Risk:**\n    * Assess **microplastic risk** based on packaging type and processing method\n    * Explain **health concerns** related to microplastic consumption\n\n11. **Pesticide Residue Risk:**\n    * Assess **pesticide risk** based on ingredients (especially if not organic)\n    * Note **high-risk crops** (strawberries, spinach, kale, etc.)\n    * Explain **health implications** of pesticide exposure\n\n12. **Nutrient Density Analysis:**\n    * Calculate **nutrient density** (nutrients per calorie)\n    * Identify **empty calories** (calories without significant nutrients)\n    * Note **fortified nutrients** vs. naturally occurring nutrients\n\n13. **Nutritional Quality Assessment & Scoring:**\n    * Assess the food's **nutritional quality** based on general dietary guidelines (prioritizing protein/fiber, low content of saturated fat, added sugar, and sodium).\n    * Provide a **numerical health score (0–100)**.\n        * **0-25:** Highly processed, high in added sugar/sodium/saturated fat, and poor ingredient profile.\n        * **26-50:** Processed, moderate to high in concerning nutrients, but may offer some macro-nutritional benefit.\n        * **51-75:** Moderately healthy, reasonable balance of macros, generally lower in concerning nutrients.\n        * **76-100:** Minimal ingredients, rich in fiber/protein, very low in saturated fat/sodium/added sugar.\n    * Formulate detailed, user-friendly **positive and negative observations**.\n    * Conclude with a **comprehensive summary** that includes:\n        - Overall health assessment\n        - Potential long-term health implications\n        - Recommendations for consumption frequency\n        - Healthier alternatives when possible\n\n14. **Industry Insights & Controversies:**\n    * Highlight any **industry practices** related to this product category that consumers should be aware of\n    * Note any **regulatory differences** between countries (e.g., ingredients banned elsewhere but allowed here)\n    * Expose **marketing tactics** that might mislead consumers (e.g., \"natural\" claims on highly processed products)\n\n15. **Practical Consumer Guidance:**\n    * **Storage & Safety**: How to properly store the product and safety considerations\n    * **Preparation Tips**: Best ways to prepare/consume for maximum nutrition\n    * **Label Reading Tricks**: How to identify misleading claims and marketing tactics\n    * **Cost vs. Nutrition**: Is the product worth its price from a nutritional standpoint?\n    * **Serving Size Reality Check**: How realistic the serving size is and what people actually consume\n\n**Output Requirement:**\n\nReturn your entire response **only** in the following strict JSON format. Use `null` for any data point that is not visible in the image and cannot be reasonably calculated.\n\n```json\n{\n  \"product_info\": {\n    \"serving_size\": \"string\",\n    \"calories_per_serving\": \"number | null\",\n    \"brand\": \"string | null\",\n    \"claims\": [\"string\"]\n  },\n  \"nutrition_facts\": {\n    \"total_fat_g\": \"number | null\",\n    \"saturated_fat_g\": \"number | null\",\n    \"trans_fat_g\": \"number | null\",\n    \"cholesterol_mg\": \"number | null\",\n    \"sodium_mg\": \"number | null\",\n    \"total_carbohydrates_g\": \"number | null\",\n    \"dietary_fiber_g\": \"number | null\",\n    \"total_sugars_g\": \"number | null\",\n    \"added_sugars_g\": \"number | null\",\n    \"protein_g\": \"number | null\"\n  },\n  \"ingredients\": [\"string\"],\n  \"notable_ingredients\": [\"string\"],\n  \"detailed_ingredient_analysis\": [\n    {\n      \"ingredient\": \"string\",\n      \"purpose\": \"string\",\n      \"health_concerns\": [\"string\"],\n      \"industry_context\": \"string\",\n      \"hidden_names\": [\"string\"]\n    }\n  ],\n  \"processing_analysis\": {\n    \"level\": \"string\",\n    \"indicators\": [\"string\"],\n    \"health_implications\": \"string\"\n  },\n  \"sugar_analysis\": {\n    \"total_sugar_equivalents\": \"string\",\n    \"hidden_sugars\": [\"string\"],\n    \"percent_of_daily_limit\": \"number\"\n  },\n  \"additive_impact\": [\n    {\n      \"additive\": \"string\",\n      \"function\": \"string\",\n      \"health_impact\": \"string\",\n      \"regulatory_status\": \"string\",\n      \"natural_alternatives\": [\"string\"]\n    }\n  ],\n  \"gmo_analysis\": {\n    \"likelihood\": \"string\",\n    \"concerns\": \"string\",\n    \"certifications\": [\"string\"]\n  },\n  \"environmental_impact\": {\n    \"footprint\": \"string\",\n    \"sustainability_concerns\": [\"string\"],\n    \"certifications\": [\"string\"]\n  },\n  \"ethical_considerations\": {\n    \"concerns\": [\"string\"],\n    \"certifications\": [\"string\"]\n  },\n  \"allergen_information\": {\n    \"major_allergens\": [\"string\"],\n    \"cross_contamination_risks\": [\"string\"],\n    \"hidden_allergens\": [\"string\"]\n  },\n  \"contamination_risks\": {\n    \"microplastic_risk\": \"string\",\n    \"pesticide_risk\": \"string\",\n    \"high_risk_ingredients\": [\"string\"]\n  },\n  \"nutrient_density\": {\n    \"score\": \"string\",\n    \"empty_calories\": \"boolean\",\n    \"fortified_vs_natural\": {\n      \"fortified\": [\"string\"],\n      \"natural\": [\"string\"]\n    }\n  },\n  \"practical_guidance\": {\n    \"storage_safety\": \"string\",\n    \"preparation_tips\": [\"string\"],\n    \"label_reading_tricks\": [\"string\"],\n    \"cost_vs_nutrition\": \"string\",\n    \"serving_size_reality\": \"string\"\n  },\n  \"industry_insights\": {\n    \"controversial_practices\": [\"string\"],\n    \"regulatory_differences\": \"string\",\n    \"marketing_tactics\": [\"string\"]\n  },\n  \"analysis\": {\n    \"positive_aspects\": [\"string\"],\n    \"negative_aspects\": [\"string\"],\n    \"health_score\": \"number\",\n    \"summary\": \"string\",\n    \"recommendations\": {\n      \"consumption_frequency\": \"string\",\n      \"healthier_alternatives\": [\"string\"]\n    }\n  }\n}",
-                "messages": [],
-                "image_input": [file_url],
-                "temperature": 1,
-                "system_prompt": "You are an **Investigative Nutrition Analyst** for a consumer advocacy mobile application. Your task is to provide a comprehensive, educational, and transparent analysis of food products based *only* on the provided image(s) of their packaging. Uncover both obvious and hidden concerns about ingredients, processing methods, and industry practices. Present factual information with appropriate context to help consumers make truly informed decisions. Be thorough in explaining potential health implications without spreading misinformation.",
-                "presence_penalty": 0,
-                "frequency_penalty": 0,
-                "max_completion_tokens": 4096
-            }
-            
-            # Run prediction on Replicate
-            prediction = await asyncio.to_thread(
-                replicate.predictions.create,
-                model="openai/gpt-4o-mini", 
-                input=input_data
-            )
-            
-            # Poll for results
-            POLL_INTERVAL = 3  # Seconds
-            while prediction.status not in ["succeeded", "failed", "canceled"]:
-                prediction = await asyncio.to_thread(
-                    replicate.predictions.get,
-                    prediction.id
-                )
-                if prediction.status in ["succeeded", "failed", "canceled"]:
-                    break
-                await asyncio.sleep(POLL_INTERVAL)
-            
-            if prediction.status == "succeeded":
-                # Parse the output
-                try:
-                    # Check if output is a list of strings
-                    if isinstance(prediction.output, list):
-                        # Join the list of strings into a single string
-                        output_str = ''.join(prediction.output)
-                        
-                        # Check if the string is wrapped in markdown code blocks
-                        if output_str.startswith('```json') and output_str.endswith('```'):
-                            # Extract the JSON part by removing the markdown code block markers
-                            json_str = output_str[7:-3].strip()
-                            result = json.loads(json_str)
-                        else:
-                            # Try to parse the string directly as JSON
-                            result = json.loads(output_str)
-                    else:
-                        # If output is a string, check for markdown code blocks
-                        if prediction.output.startswith('```json') and prediction.output.endswith('```'):
-                            json_str = prediction.output[7:-3].strip()
-                            result = json.loads(json_str)
-                        else:
-                            # Try to parse the string directly as JSON
-                            result = json.loads(prediction.output)
-                    
-                    await self.send(json.dumps({
-                        "analysis_result": result
-                    }))
-                except json.JSONDecodeError as e:
-                    print("JSON parsing error:", e)
-                    print("Raw output:", prediction.output)
-                    await self.send(json.dumps({
-                        "error": "Failed to parse the response as JSON"
-                    }))
-                except Exception as e:
-                    print("Unexpected error:", e)
-                    print("Raw output:", prediction.output)
-                    await self.send(json.dumps({
-                        "error": "An unexpected error occurred while processing the response"
-                    }))
+            with metrics.span("upload_wait"):
+                file_url = await self.upload_to_replicate(upload)
+
+            # Blank and blurry photos are turned away before any prediction
+            reason = triage.check_photo(upload.preprocess_stats) if settings.ANALYSIS_TRIAGE else None
+            if reason is not None:
+                logger.info("Photo rejected: %s", reason)
+                await self.finish(request_id, triage.rejection(reason))
+                return
+
+            # Hand the prediction to the scheduler, results come back as
+            # analysis.message events to the request's group
+            job = analysis.new_job(request_id, file_url, cache_key, key=self.analysis_key(request_id))
+            if settings.ANALYSIS_USE_WORKER:
+                # Cancellable through the shared worker channel until a worker takes it
+                await results.update(job["key"], job_id=job["id"], host_channel=settings.ANALYSIS_WORKER_CHANNEL)
+                await self.channel_layer.send(settings.ANALYSIS_WORKER_CHANNEL, {
+                    "type": "analysis.submit",
+                    "job": job,
+                })
             else:
-                print("Prediction failed:", prediction.status, prediction.error)
-                await self.send(json.dumps({"error": "Analysis failed"}))
-                
-        except Exception as e:
-            print(f"Error: {e}")
-            await self.send(json.dumps({"error": "An unexpected error occurred"}))
-            
+                await analysis.submit(job, waiter=self)
+
+        except Exception:
+            logger.exception("Analysis failed")
+            await self.finish(request_id, {"error": "An unexpected error occurred"})
+
         finally:
-            # Clean up temporary image
+            # Release the uploaded image, the prediction only needs the Replicate URL
+            await uploads.release(upload)
+
+    async def analysis_message(self, event):
+        # Client message from a running analysis job
+        message = event["message"]
+        if "analysis_result" in message or "error" in message:
+            await self.unfollow(event["request_id"])
+        await self.send_message(event["request_id"], message)
+
+    async def upload_to_replicate(self, upload):
+        # Usually the upload view already started this while the socket was opening
+        if upload.prepared is not None:
             try:
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+                return await asyncio.wrap_future(upload.prepared)
             except Exception as e:
-                print(f"Failed to delete image: {e}")
-
-    async def upload_to_replicate(self, image_path, filename="input.jpg"):
-        # Upload image to Replicate's file service
-        file_response = await asyncio.to_thread(
-            replicate.files.create,
-            file=open(image_path, "rb"),
-            filename=filename
-        )
-        return file_response.urls['get']
-    
\ No newline at end of file
+                logger.warning("Eager upload failed, retrying: %s", e)
+
+        return await uploads.async_prepare(upload)
+
+
+class AnalysisWorker(PredictionWaiterMixin, AsyncConsumer):
+    """Runs analysis jobs outside the web processes (`manage.py runworker analysis-worker`)."""
+
+    async def analysis_submit(self, event):
+        await analysis.submit(event["job"], waiter=self)
@@ -0,0 +1,27 @@
+from django.core.cache import cache
+
+COUNTER_PREFIX = "counter:"
+
+
+def incr(name, amount=1):
+    # Counters live in the default cache so every worker sharing it sees the same totals
+    key = COUNTER_PREFIX + name
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        if not cache.add(key, amount, timeout=None):
+            cache.incr(key, amount)
+
+
+def get(name):
+    return cache.get(COUNTER_PREFIX + name, 0)
+
+
+def snapshot(*names):
+    return {name: get(name) for name in names}
+
+
+def get_many(names):
+    # One round trip for a whole set of counters, missing ones are 0
+    found = cache.get_many([COUNTER_PREFIX + name for name in names])
+    return {name: found.get(COUNTER_PREFIX + name, 0) for name in names}
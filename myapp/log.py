@@ -0,0 +1,15 @@
+import contextvars
+import logging
+
+# Request id of the analysis the current task works on. asyncio tasks copy the
+# context they are created in, so everything an analysis spawns logs its id.
+request_id = contextvars.ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds `request_id` to every record so one request can be traced through the logs."""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id.get()
+        return True
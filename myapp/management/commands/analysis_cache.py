@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from myapp import analysis, analysis_cache, prompts
+
+
+class Command(BaseCommand):
+    help = "Show analysis cache and output repair statistics or invalidate cached analyses"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--invalidate-stale', action='store_true',
+            help="Delete entries produced by an older prompt version",
+        )
+        parser.add_argument(
+            '--clear', action='store_true',
+            help="Delete every cached analysis",
+        )
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            deleted = analysis_cache.invalidate()
+            self.stdout.write(f"Deleted {deleted} cached analyses")
+        elif options['invalidate_stale']:
+            deleted = analysis_cache.invalidate(keep_prompt_version=prompts.PROMPT_VERSION)
+            self.stdout.write(f"Deleted {deleted} stale cached analyses")
+
+        self.stdout.write(f"Prompt version: {prompts.PROMPT_VERSION}")
+        for name, value in analysis_cache.stats().items():
+            self.stdout.write(f"{name}: {value}")
+
+        repairs = analysis.repair_stats()
+        for name, value in repairs.items():
+            self.stdout.write(f"{name}: {value}")
+        if repairs[analysis.OUTPUTS]:
+            self.stdout.write(f"repair rate: {repairs[analysis.REPAIRS] / repairs[analysis.OUTPUTS]:.1%}")
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp import catalog, predictions
+
+
+class Command(BaseCommand):
+    help = "Analyze every image of a directory, archive or manifest, writing results as NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'source',
+            help="Directory of images, .zip or .tar archive, or manifest (.txt/.csv/.jsonl, one path per line)",
+        )
+        parser.add_argument(
+            '--output', '-o', default='-',
+            help="NDJSON file to append results to, rerunning skips items already in it (default: stdout)",
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.ANALYSIS_MAX_CONCURRENCY,
+            help="Images analyzed at once",
+        )
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency must be at least 1")
+
+        done = set()
+        if options['output'] != '-':
+            done = catalog.completed_ids(options['output'])
+            if done:
+                self.stderr.write(f"Resuming, skipping {len(done)} items already done")
+
+        try:
+            items = catalog.iter_catalog(options['source'], skip=done)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if options['output'] == '-':
+            output = sys.stdout
+        else:
+            output = catalog.open_output(options['output'])
+
+        def write(record):
+            # One flushed line per finished item, so a crash loses nothing that completed
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+            self.stderr.write(f"{record['status']}: {record['id']}")
+
+        async def run():
+            try:
+                return await catalog.run_catalog(items, write, options['concurrency'])
+            finally:
+                # The pooled connections belong to this loop, close them before it ends
+                await predictions.close_clients()
+
+        try:
+            totals = asyncio.run(run())
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        self.stderr.write(f"Done: {totals['ok']} analyzed, {totals['error']} failed")
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from myapp import predictions
+from myapp.benchmark import loadgen
+from myapp.benchmark.fake_replicate import FakeReplicate
+
+
+class Command(BaseCommand):
+    help = "Load test the upload and analysis flow against a local fake Replicate API, fully offline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help="Concurrent virtual users")
+        parser.add_argument('--iterations', type=int, default=5, help="Analyses each user runs, one after another")
+        parser.add_argument('--latency', type=float, default=2.0, help="Seconds the fake model generates for")
+        parser.add_argument('--jitter', type=float, default=0.5, help="Random +/- seconds on the latency")
+        parser.add_argument('--queue-delay', type=float, default=0.2, help="Seconds predictions wait in 'starting'")
+        parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of predictions that fail, 0 to 1")
+        parser.add_argument('--no-stream', action='store_true', help="Fake model without streaming support")
+        parser.add_argument('--idle-sockets', type=int, default=50,
+                            help="Idle sockets opened to measure memory per socket, 0 skips it")
+        parser.add_argument('--timeout', type=float, default=120, help="Seconds to wait for any one message")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+        parser.add_argument('--fail-on-leak', action='store_true',
+                            help="Exit with an error if anything is left behind, for CI")
+        parser.add_argument('--serve', type=int, metavar='PORT',
+                            help="Only run the fake Replicate API on PORT, to point a running server at it")
+
+    def handle(self, *args, **options):
+        fake = FakeReplicate(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            queue_delay=options['queue_delay'],
+            failure_rate=options['failure_rate'],
+            stream=not options['no_stream'],
+        )
+
+        if options['serve'] is not None:
+            self.serve(fake, options['serve'])
+            return
+
+        if options['users'] < 1 or options['iterations'] < 1:
+            raise CommandError("--users and --iterations must be at least 1")
+
+        # Everything the analysis touches stays in this process and the fake:
+        # no webhooks (nothing listens for them), no worker, nothing cached
+        # and no rate limit in the way
+        with fake, override_settings(
+            REPLICATE_API_BASE_URL=fake.url,
+            REPLICATE_API_TOKEN='fake',
+            REPLICATE_WEBHOOK_BASE_URL='',
+            ANALYSIS_USE_WORKER=False,
+            ANALYSIS_CACHE_ENABLED=False,
+            UPLOAD_RATE_LIMIT='1000000/s',
+        ):
+            report = asyncio.run(loadgen.run_load(
+                options['users'], options['iterations'],
+                idle_sockets=options['idle_sockets'],
+                timeout=options['timeout'],
+            ))
+            report['replicate'] = dict(fake.stats)
+        # The shared Replicate client pointed at the fake
+        predictions._client = None
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(loadgen.format_report(report))
+
+        if options['fail_on_leak'] and loadgen.has_leaks(report):
+            raise CommandError(f"Resources left behind: {report['leaks']}")
+
+    def serve(self, fake, port):
+        fake.port = port
+        with fake:
+            self.stderr.write(f"Fake Replicate API at {fake.url}, Ctrl-C to stop")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
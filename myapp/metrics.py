@@ -0,0 +1,366 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import counters
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cache lookup up to a slow model run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# Stages of an analysis, in the order a request goes through them
+STAGES = (
+    "upload_read",       # Upload view: reading the image into the upload store
+    "preprocess",        # Resizing and re-encoding before the Replicate upload
+    "replicate_upload",  # replicate.files.create
+    "cache_lookup",      # Analysis cache lookup
+    "upload_wait",       # Consumer waiting for the (eager) Replicate upload
+    "scheduler_queue",   # Waiting for a free slot in the scheduler
+    "triage",            # Quick prediction checking the photo before the analysis
+    "replicate_queue",   # Prediction created to started, queued at Replicate
+    "generation",        # Prediction started to completed
+    "poll_lag",          # Prediction completed to us noticing
+    "parse",             # Extracting and validating the JSON output
+    "repair",            # Follow-up prediction for invalid sections
+    "total",             # Receiving the request to its final message
+)
+
+OUTCOMES = ("success", "cached", "rejected", "parse_failed", "failed", "cancelled")
+
+# What triage made of a photo: analyzed in full, with sections left out,
+# turned away, or no usable answer so the full analysis ran anyway
+TRIAGE_VERDICTS = ("full", "reduced", "rejected", "escalated")
+
+# Error sent to the client when no JSON can be recovered from the model output
+PARSE_ERROR = "Failed to parse the response as JSON"
+
+# Processes whose gauges are live, and each one's gauge values
+PROCESSES_KEY = "metric-processes"
+GAUGES_KEY = "metric-gauges:{}"
+
+_registry = []
+
+# Updates only touch process memory, a background thread flushes them to the
+# cache; see flush()
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_pending = defaultdict(int)
+_gauges = defaultdict(int)
+_flusher_pid = None
+
+
+def _add(values, key, amount):
+    global _flusher_pid
+    with _lock:
+        values[key] += amount
+    if _flusher_pid != os.getpid():
+        # First update in this process (or since a fork)
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_flush_periodically, name="metrics-flush", daemon=True).start()
+
+
+def _process_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logger.warning("Failed to flush metrics: %s", e)
+
+
+def flush():
+    """Add this process's counts to the shared cache and publish its gauges.
+
+    Counts add up across processes and outlive them. Gauges are a snapshot
+    per process that expires a few flushes after the process stops, so they
+    don't drift when one dies mid-prediction.
+    """
+    with _flush_lock:
+        with _lock:
+            pending = dict(_pending)
+            _pending.clear()
+            gauges = dict(_gauges)
+        for key, amount in pending.items():
+            if amount:
+                counters.incr(key, amount)
+
+        process = _process_id()
+        cache.set(GAUGES_KEY.format(process), gauges, settings.METRICS_FLUSH_INTERVAL * 3)
+        # Forget processes whose snapshot expired; one lost in a concurrent
+        # write adds itself back on its next flush
+        known = cache.get(PROCESSES_KEY) or []
+        live = cache.get_many([GAUGES_KEY.format(p) for p in known])
+        processes = [p for p in known if GAUGES_KEY.format(p) in live and p != process] + [process]
+        if processes != known:
+            cache.set(PROCESSES_KEY, processes, None)
+
+
+def _gauge_totals():
+    totals = defaultdict(int)
+    snapshots = cache.get_many([GAUGES_KEY.format(p) for p in cache.get(PROCESSES_KEY) or []])
+    for gauges in snapshots.values():
+        for key, value in gauges.items():
+            totals[key] += value
+    return totals
+
+
+class Metric:
+    """A metric with at most one label, whose values are declared up front.
+
+    Updates are kept in process memory and flushed to the default cache, so
+    the web processes and analysis workers add to the same series and any of
+    them can serve /metrics.
+    """
+
+    type = None
+
+    def __init__(self, name, help, label=None, values=()):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = tuple(values) if label else (None,)
+        _registry.append(self)
+
+    def _label_value(self, labels):
+        if self.label is None:
+            return None
+        value = labels[self.label]
+        if value not in self.values:
+            raise ValueError(f"Unknown {self.label} {value!r} for {self.name}")
+        return value
+
+    def _key(self, value, suffix=""):
+        return f"metric:{self.name}{suffix}:{value or ''}"
+
+    def _labels(self, value, **extra):
+        labels = {self.label: value} if self.label else {}
+        labels.update(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+    def keys(self):
+        return []
+
+    def samples(self, values):
+        return []
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        _add(_pending, self._key(self._label_value(labels)), amount)
+
+    def total(self, **labels):
+        # Across processes, as of their last flush; this one's counts included
+        flush()
+        return counters.get(self._key(self._label_value(labels)))
+
+    def keys(self):
+        return [self._key(value) for value in self.values]
+
+    def samples(self, values):
+        for value in self.values:
+            yield f"{self.name}{self._labels(value)} {values.get(self._key(value), 0)}"
+
+
+class Gauge(Counter):
+    """Summed over the live processes, see flush()."""
+
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        _add(_gauges, self._key(self._label_value(labels)), amount)
+
+    def keys(self):
+        return []
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        # Up for as long as the block runs
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """Counts observations per bucket; cumulative counts are only worked out for /metrics.
+
+    That keeps an observation at two increments whatever the number of
+    buckets. Sums are stored in microseconds since the cache only adds integers.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, label=None, values=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, label, values)
+        self.buckets = tuple(buckets)
+        # Lists also collecting raw observations, see recording()
+        self.recorders = []
+
+    def observe(self, seconds, **labels):
+        value = self._label_value(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        _add(_pending, self._key(value, f":{index}"), 1)
+        _add(_pending, self._key(value, ":sum_us"), round(seconds * 1_000_000))
+        for recorder in self.recorders:
+            recorder.append((value, seconds))
+
+    def keys(self):
+        return [
+            self._key(value, suffix)
+            for value in self.values
+            for suffix in [f":{i}" for i in range(len(self.buckets) + 1)] + [":sum_us"]
+        ]
+
+    def samples(self, values):
+        for value in self.values:
+            count = 0
+            for i, bound in enumerate(self.buckets + (float("inf"),)):
+                count += values.get(self._key(value, f":{i}"), 0)
+                le = "+Inf" if i == len(self.buckets) else f"{bound:g}"
+                yield f"{self.name}_bucket{self._labels(value, le=le)} {count}"
+            yield f"{self.name}_sum{self._labels(value)} {values.get(self._key(value, ':sum_us'), 0) / 1_000_000}"
+            yield f"{self.name}_count{self._labels(value)} {count}"
+
+
+STAGE_SECONDS = Histogram(
+    "truview_stage_seconds", "Time spent in each stage of an analysis",
+    label="stage", values=STAGES,
+)
+ANALYSES = Counter(
+    "truview_analyses_total", "Finished analyses by outcome",
+    label="outcome", values=OUTCOMES,
+)
+PREDICTIONS_IN_FLIGHT = Gauge(
+    "truview_predictions_in_flight", "Replicate predictions created and not yet finished",
+)
+TRIAGES = Counter(
+    "truview_triage_total", "Triage predictions by verdict",
+    label="verdict", values=TRIAGE_VERDICTS,
+)
+MODEL_OUTPUTS = Counter(
+    "truview_model_outputs_total", "Analysis outputs parsed and validated, repairs not included",
+)
+REPAIRS = Counter(
+    "truview_repairs_total", "Repair predictions run for sections that failed validation",
+)
+REPAIR_FAILURES = Counter(
+    "truview_repair_failures_total", "Repairs that left sections invalid",
+)
+REPAIR_TOKENS_SAVED = Counter(
+    "truview_repair_tokens_saved_total", "Output tokens saved by repairing sections instead of rerunning the analysis",
+)
+PREPROCESSED_IMAGES = Counter(
+    "truview_preprocessed_images_total", "Images resized and re-encoded before the Replicate upload",
+)
+PREPROCESS_BYTES = Counter(
+    "truview_preprocess_bytes_total", "Image bytes going into and coming out of preprocessing",
+    label="direction", values=("in", "out"),
+)
+PREPROCESS_CPU_MS = Counter(
+    "truview_preprocess_cpu_milliseconds_total", "CPU time spent preprocessing images",
+)
+OPEN_SOCKETS = Gauge(
+    "truview_open_sockets", "Open analysis WebSocket connections",
+)
+
+
+@contextmanager
+def recording(histogram):
+    """Collect the raw (label, seconds) observations of `histogram` made in this
+    process while the block runs, for exact percentiles in benchmarks."""
+    observations = []
+    histogram.recorders.append(observations)
+    try:
+        yield observations
+    finally:
+        histogram.recorders.remove(observations)
+
+
+@contextmanager
+def span(stage):
+    """Time a stage of the request being handled, logging and recording how long it took."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    logger.info("%s took %.0f ms", stage, seconds * 1000)
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def observe_prediction(prediction):
+    """Split a finished prediction's time into queueing, generation and poll lag.
+
+    Uses the timestamps Replicate reports, so queueing at Replicate and our
+    own delay in noticing completion can be told apart from the model itself.
+    """
+    created = _timestamp(getattr(prediction, "created_at", None))
+    started = _timestamp(getattr(prediction, "started_at", None))
+    completed = _timestamp(getattr(prediction, "completed_at", None))
+
+    if created and started:
+        observe_stage("replicate_queue", max(0.0, started - created))
+    if started and completed:
+        observe_stage("generation", max(0.0, completed - started))
+    if completed:
+        # Clocks differ a little between us and Replicate, never report less than zero
+        observe_stage("poll_lag", max(0.0, datetime.now(timezone.utc).timestamp() - completed))
+
+
+def outcome(message):
+    """The outcome label for a final client message."""
+    if "analysis_result" in message:
+        return "cached" if message.get("cached") else "success"
+    if "cancelled" in message:
+        return "cancelled"
+    if "rejected" in message:
+        return "rejected"
+    if message.get("error") == PARSE_ERROR:
+        return "parse_failed"
+    return "failed"
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    flush()
+    values = counters.get_many([key for metric in _registry for key in metric.keys()])
+    values.update(_gauge_totals())
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples(values))
+    return "\n".join(lines) + "\n"
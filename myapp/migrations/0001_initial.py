@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-17 09:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('prompt_version', models.CharField(max_length=16)),
+                ('phash', models.CharField(blank=True, max_length=16)),
+                ('phash_band0', models.PositiveIntegerField(db_index=True, null=True)),
+                ('phash_band1', models.PositiveIntegerField(db_index=True, null=True)),
+                ('phash_band2', models.PositiveIntegerField(db_index=True, null=True)),
+                ('phash_band3', models.PositiveIntegerField(db_index=True, null=True)),
+                ('analysis_result', models.JSONField()),
+                ('image_size', models.PositiveIntegerField(default=0)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('last_hit_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('content_hash', 'prompt_version'), name='unique_analysis_per_prompt')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-17 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysiscacheentry',
+            name='fingerprint',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+    ]
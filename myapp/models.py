@@ -1,3 +1,37 @@
 from django.db import models
 
-# Create your models here.
+
+class AnalysisCacheEntry(models.Model):
+    """A finished analysis, keyed by the uploaded image and the prompt that produced it."""
+
+    content_hash = models.CharField(max_length=64)
+    prompt_version = models.CharField(max_length=16)
+
+    # 64-bit difference hash split into four 16-bit bands. Two hashes within
+    # a Hamming distance of 3 always share at least one band, so the bands
+    # give an indexed candidate lookup for near-duplicate photos.
+    phash = models.CharField(max_length=16, blank=True)
+    phash_band0 = models.PositiveIntegerField(null=True, db_index=True)
+    phash_band1 = models.PositiveIntegerField(null=True, db_index=True)
+    phash_band2 = models.PositiveIntegerField(null=True, db_index=True)
+    phash_band3 = models.PositiveIntegerField(null=True, db_index=True)
+    # Compressed greyscale pixels confirming a near-duplicate match, see
+    # analysis_cache.same_pixels(). Empty unless near matching is enabled.
+    fingerprint = models.BinaryField(blank=True, default=b'')
+
+    analysis_result = models.JSONField()
+    image_size = models.PositiveIntegerField(default=0)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    last_hit_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['content_hash', 'prompt_version'],
+                name='unique_analysis_per_prompt',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({self.prompt_version})"
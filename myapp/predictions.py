@@ -0,0 +1,229 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import io
+import logging
+import time
+import weakref
+
+import replicate
+from replicate.__about__ import __version__ as replicate_version
+from django.conf import settings
+from django.urls import reverse
+from replicate.exceptions import ReplicateError
+from replicate.stream import ServerSentEvent
+
+from . import metrics, prompts, transport
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+# Reject webhook deliveries whose timestamp is further than this from now
+WEBHOOK_TOLERANCE = 5 * 60  # Seconds
+
+_client = None
+# httpx connections belong to the event loop that opened them, so each loop
+# (Daphne's, a management command's) gets its own pooled client
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    # Shared blocking Replicate client, for code running in threads.
+    # REPLICATE_API_BASE_URL points it at a fake server in tests
+    global _client
+    if _client is None:
+        _client = replicate.Client(
+            api_token=settings.REPLICATE_API_TOKEN or None,
+            base_url=settings.REPLICATE_API_BASE_URL,
+        )
+    return _client
+
+
+class AsyncReplicateClient(replicate.Client):
+    """Replicate client whose async methods use our pooled, retrying httpx client.
+
+    The SDK builds its own AsyncClient with no pool limits or HTTP/2, and only
+    retries GETs. Its async methods all go through `_async_client`, so that is
+    the one thing we swap out.
+    """
+
+    def __init__(self, http_client, **kwargs):
+        super().__init__(**kwargs)
+        self.http_client = http_client
+
+    @property
+    def _async_client(self):
+        return self.http_client
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        base_url = settings.REPLICATE_API_BASE_URL or "https://api.replicate.com"
+        headers = {"User-Agent": f"replicate-python/{replicate_version}"}
+        if settings.REPLICATE_API_TOKEN:
+            headers["Authorization"] = f"Bearer {settings.REPLICATE_API_TOKEN}"
+        client = AsyncReplicateClient(
+            transport.build_async_client(base_url=base_url, headers=headers),
+            api_token=settings.REPLICATE_API_TOKEN or None,
+            base_url=base_url,
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_clients():
+    """Close the pooled clients and their connections, before an event loop is shut down."""
+    global _client
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.http_client.aclose()
+    if _client is not None:
+        _client._client.close()
+        _client = None
+
+
+def group_name(prediction_id):
+    # Channel layer group the webhook view notifies when a prediction finishes
+    return f"prediction.{prediction_id}"
+
+
+def webhook_url():
+    if not settings.REPLICATE_WEBHOOK_BASE_URL:
+        return None
+    return settings.REPLICATE_WEBHOOK_BASE_URL.rstrip('/') + reverse('replicate_webhook')
+
+
+def upload_file(data, filename):
+    # Upload image bytes to Replicate's file service, returns the file URL
+    with metrics.span("replicate_upload"):
+        file_response = get_client().files.create(
+            file=io.BytesIO(data),
+            filename=filename
+        )
+    return file_response.urls['get']
+
+
+async def async_upload_file(data, filename):
+    with metrics.span("replicate_upload"):
+        file_response = await get_async_client().files.async_create(
+            file=io.BytesIO(data),
+            filename=filename
+        )
+    return file_response.urls['get']
+
+
+async def create_prediction(input_data, stream=False):
+    params = {}
+    if stream:
+        params["stream"] = True
+    url = webhook_url()
+    if url:
+        params["webhook"] = url
+        params["webhook_events_filter"] = ["completed"]
+
+    return await get_async_client().predictions.async_create(
+        model=prompts.MODEL,
+        input=input_data,
+        **params
+    )
+
+
+async def cancel_prediction(prediction_id):
+    # Stop a prediction we no longer need so it doesn't keep generating tokens
+    try:
+        await get_async_client().predictions.async_cancel(prediction_id)
+    except Exception as e:
+        logger.warning("Failed to cancel prediction %s: %s", prediction_id, e)
+
+
+async def wait_for_prediction(prediction, completed=None):
+    """Wait for a prediction to reach a terminal status.
+
+    `completed` is an optional future resolved when the webhook reports the
+    prediction as finished. Polling with exponential backoff runs alongside it
+    as a fallback, at a much slower pace when a webhook is expected. The
+    webhook only wakes us once; if the prediction then still isn't finished,
+    normal polling takes over.
+    """
+    if completed is None:
+        interval = settings.PREDICTION_POLL_INITIAL
+    else:
+        interval = settings.PREDICTION_WEBHOOK_FALLBACK_POLL
+
+    while prediction.status not in TERMINAL_STATUSES:
+        if completed is None:
+            await asyncio.sleep(interval)
+        else:
+            try:
+                await asyncio.wait_for(asyncio.shield(completed), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+        # Fetch the prediction rather than trusting the webhook body, so an
+        # unsigned or forged delivery can at worst cause one extra request
+        prediction = await get_async_client().predictions.async_get(prediction.id)
+        if completed is not None and completed.done():
+            # A resolved future returns at once, waiting on it again would
+            # fetch back to back while the read is stale or the delivery forged
+            completed = None
+            interval = settings.PREDICTION_POLL_INITIAL
+        else:
+            interval = min(interval * settings.PREDICTION_POLL_BACKOFF, settings.PREDICTION_POLL_MAX)
+
+    return prediction
+
+
+async def stream_output(prediction, on_text):
+    """Feed the prediction's output tokens to `on_text` as they are generated.
+
+    Returns the full streamed text. Raises ReplicateError if the model does
+    not support streaming or the stream reports an error.
+    """
+    chunks = []
+    async for event in prediction.async_stream():
+        if event.event == ServerSentEvent.EventType.OUTPUT:
+            chunks.append(event.data)
+            await on_text(event.data)
+        elif event.event == ServerSentEvent.EventType.ERROR:
+            raise ReplicateError(event.data)
+        elif event.event == ServerSentEvent.EventType.DONE:
+            break
+    return "".join(chunks)
+
+
+def verify_webhook(headers, body):
+    """Check a webhook delivery against REPLICATE_WEBHOOK_SECRET.
+
+    Replicate signs `{webhook-id}.{webhook-timestamp}.{body}` with HMAC-SHA256
+    using the base64 part of the `whsec_...` secret. Without a configured
+    secret every delivery is accepted.
+    """
+    secret = settings.REPLICATE_WEBHOOK_SECRET
+    if not secret:
+        return True
+
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not (webhook_id and timestamp and signatures):
+        return False
+
+    try:
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE:
+            return False
+        key = base64.b64decode(secret.split("_", 1)[-1])
+    except ValueError:
+        return False
+
+    signed_content = f"{webhook_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(key, signed_content, hashlib.sha256).digest()).decode()
+
+    for signature in signatures.split():
+        _, _, value = signature.partition(",")
+        if hmac.compare_digest(value, expected):
+            return True
+    return False
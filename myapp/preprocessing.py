@@ -0,0 +1,135 @@
+import asyncio
+import io
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageFilter, ImageOps, ImageStat
+
+# Share of the busiest row/column an edge profile needs to count as label content
+LABEL_EDGE_DENSITY = 0.15
+# Crops that keep more than this share of the image aren't worth doing
+LABEL_MIN_SAVING = 0.85
+# Crops smaller than this share of the image are more likely noise than a label
+LABEL_MIN_AREA = 0.1
+
+# Laplacian for the sharpness measure, offset so negative responses survive in an 8-bit image
+LAPLACIAN = ImageFilter.Kernel((3, 3), (0, 1, 0, 1, -4, 1, 0, 1, 0), scale=1, offset=128)
+# Longest edge the quality measures are taken at, so they don't depend on the camera
+QUALITY_PROBE_EDGE = 512
+
+_pool = None
+
+
+def get_pool(workers):
+    # Spawned rather than forked, the web process runs threads that fork would copy mid-flight
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def find_label_box(img):
+    """Bounding box of the densest text/edge region, or None if nothing clearly stands out."""
+    probe = img.convert('L')
+    probe.thumbnail((256, 256))
+    edges = probe.filter(ImageFilter.FIND_EDGES).point(lambda value: 255 if value > 40 else 0)
+
+    width, height = edges.size
+    pixels = edges.load()
+    # The edge filter always lights up the outermost pixel ring, so skip it
+    rows = [sum(1 for x in range(1, width - 1) if pixels[x, y]) for y in range(1, height - 1)]
+    cols = [sum(1 for y in range(1, height - 1) if pixels[x, y]) for x in range(1, width - 1)]
+    if not any(rows):
+        return None
+
+    def span(profile):
+        threshold = max(profile) * LABEL_EDGE_DENSITY
+        dense = [i + 1 for i, count in enumerate(profile) if count >= threshold]
+        return dense[0], dense[-1] + 1
+
+    top, bottom = span(rows)
+    left, right = span(cols)
+
+    margin_x = int(width * 0.03)
+    margin_y = int(height * 0.03)
+    left, top = max(0, left - margin_x), max(0, top - margin_y)
+    right, bottom = min(width, right + margin_x), min(height, bottom + margin_y)
+
+    share = ((right - left) * (bottom - top)) / (width * height)
+    if share > LABEL_MIN_SAVING or share < LABEL_MIN_AREA:
+        return None
+
+    scale_x = img.width / width
+    scale_y = img.height / height
+    return (
+        int(left * scale_x), int(top * scale_y),
+        int(right * scale_x), int(bottom * scale_y),
+    )
+
+
+def photo_quality(img):
+    """Sharpness (variance of the Laplacian) and contrast (grey level deviation) of a photo.
+
+    Both are taken at QUALITY_PROBE_EDGE. Sharp label text scores in the
+    hundreds or more; text too blurred to read scores in the single digits,
+    a blank or black frame has almost no contrast.
+    """
+    probe = img.convert('L')
+    probe.thumbnail((QUALITY_PROBE_EDGE, QUALITY_PROBE_EDGE))
+    edges = probe.filter(LAPLACIAN)
+    # The kernel filter leaves the outermost pixel ring as it was
+    edges = edges.crop((1, 1, edges.width - 1, edges.height - 1))
+    return round(ImageStat.Stat(edges).var[0], 1), round(ImageStat.Stat(probe).stddev[0], 1)
+
+
+def preprocess_image(data, max_edge, quality, crop_label=False):
+    """Orient, optionally crop to the label, downscale and recompress an uploaded image.
+
+    Runs in a worker process. Returns the new JPEG bytes and a stats dict; the
+    original bytes are returned unchanged when recompressing would not help.
+    """
+    started = time.process_time()
+    stats = {'bytes_in': len(data), 'cropped': False}
+
+    with Image.open(io.BytesIO(data)) as img:
+        original_size = img.size
+        # Let the JPEG decoder do most of the downscaling
+        img.draft('RGB', (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        stats['sharpness'], stats['contrast'] = photo_quality(img)
+
+        if crop_label:
+            box = find_label_box(img)
+            if box is not None:
+                img = img.crop(box)
+                stats['cropped'] = True
+
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=quality, optimize=True)
+        result = output.getvalue()
+        stats['size'] = img.size
+
+    unchanged = img.size == original_size and not stats['cropped']
+    if unchanged and len(result) >= len(data):
+        result = data
+
+    stats['bytes_out'] = len(result)
+    stats['cpu_ms'] = (time.process_time() - started) * 1000
+    return result, stats
+
+
+def run(data, max_edge, quality, crop_label, workers):
+    # Blocking, call from a thread; the CPU work happens in the process pool
+    future = get_pool(workers).submit(preprocess_image, bytes(data), max_edge, quality, crop_label)
+    return future.result()
+
+
+async def run_async(data, max_edge, quality, crop_label, workers):
+    # Same as run() for event loop code, waits on the pool without a thread
+    future = get_pool(workers).submit(preprocess_image, bytes(data), max_edge, quality, crop_label)
+    return await asyncio.wrap_future(future)
@@ -0,0 +1,376 @@
+import hashlib
+import json
+
+MODEL = "openai/gpt-4o-mini"
+
+SYSTEM_PROMPT = "You are an **Investigative Nutrition Analyst** for a consumer advocacy mobile application. Your task is to provide a comprehensive, educational, and transparent analysis of food products based *only* on the provided image(s) of their packaging. Uncover both obvious and hidden concerns about ingredients, processing methods, and industry practices. Present factual information with appropriate context to help consumers make truly informed decisions. Be thorough in explaining potential health implications without spreading misinformation."
+
+# Analysis requirements, numbered in this order when assembled into a prompt
+REQUIREMENTS = {
+    "data_extraction": """**Data Extraction:**
+    * Extract all visible **nutrition facts** (values and % Daily Values, if present) based on the stated serving size.
+    * Extract the complete **ingredient list**.
+    * If crucial information (like the ingredient list or full nutrition panel) is not visible, you must note this in the summary and make the best possible analysis based on what *is* visible.""",
+    "ingredient_assessment": """**Deep Ingredient Assessment:**
+    * Identify **notable or concerning ingredients** such as: added sugars (e.g., corn syrup, dextrose), artificial sweeteners (aspartame, sucralose), artificial colors (Red 40, Yellow 5, Blue 1), artificial flavors, chemical preservatives (BHA, BHT, sodium nitrite), high levels of sodium or saturated fat, and highly refined oils (palm oil, hydrogenated oils).
+    * For each concerning ingredient, provide:
+        - **Purpose**: Why manufacturers use this ingredient
+        - **Health Concerns**: Documented health risks and controversies
+        - **Industry Context**: Why it's controversial (e.g., regulatory status, bans in other countries)
+        - **Hidden Names**: Alternative names the ingredient might be listed under""",
+    "processing": """**Processing Level Analysis:**
+    * Assess the **processing level** of the product (minimally processed, processed, ultra-processed)
+    * Explain **why processing matters** for health (nutrient loss, added chemicals, calorie density)
+    * Identify **processing indicators** in the ingredient list (e.g., isolated proteins, refined flours, modified starches)""",
+    "hidden_sugar": """**Hidden Sugar Analysis:**
+    * Identify **all forms of added sugar** in the product
+    * Calculate **total sugar equivalents** (including all hidden sugars)
+    * List **alternative names for sugar** used in the product
+    * Compare sugar content to **daily recommended limits**""",
+    "additive_impact": """**Additive Impact Assessment:**
+    * For each **food additive** (preservatives, colors, flavors, emulsifiers, etc.):
+        - **Function**: What the additive does in the product
+        - **Health Impact**: Known or suspected health effects
+        - **Regulatory Status**: Approved levels, bans in other countries
+        - **Natural Alternatives**: What could be used instead""",
+    "gmo": """**GMO Information:**
+    * Assess likelihood of **GMO ingredients** (corn, soy, canola, sugar beets, etc.)
+    * Explain **GMO concerns** (environmental impact, health questions)
+    * Note if product is **Non-GMO Project Verified** or organic""",
+    "environmental": """**Environmental Impact:**
+    * Assess **environmental footprint** of key ingredients
+    * Note **sustainability concerns** (palm oil, overfishing, water usage)
+    * Identify **eco-certifications** if present""",
+    "ethical": """**Ethical Considerations:**
+    * Note any **ethical concerns** (child labor, unfair trade, animal welfare)
+    * Identify **ethical certifications** (Fair Trade, Rainforest Alliance, etc.)""",
+    "allergens": """**Allergen Information:**
+    * Identify **major allergens** beyond the top 8 (milk, eggs, fish, crustacean shellfish, tree nuts, peanuts, wheat, soybeans)
+    * Note **cross-contamination risks** if mentioned
+    * Identify **hidden allergens** (e.g., natural flavors, spices)""",
+    "microplastics": """**Microplastic Contamination Risk:**
+    * Assess **microplastic risk** based on packaging type and processing method
+    * Explain **health concerns** related to microplastic consumption""",
+    "pesticides": """**Pesticide Residue Risk:**
+    * Assess **pesticide risk** based on ingredients (especially if not organic)
+    * Note **high-risk crops** (strawberries, spinach, kale, etc.)
+    * Explain **health implications** of pesticide exposure""",
+    "nutrient_density": """**Nutrient Density Analysis:**
+    * Calculate **nutrient density** (nutrients per calorie)
+    * Identify **empty calories** (calories without significant nutrients)
+    * Note **fortified nutrients** vs. naturally occurring nutrients""",
+    "scoring": """**Nutritional Quality Assessment & Scoring:**
+    * Assess the food's **nutritional quality** based on general dietary guidelines (prioritizing protein/fiber, low content of saturated fat, added sugar, and sodium).
+    * Provide a **numerical health score (0–100)**.
+        * **0-25:** Highly processed, high in added sugar/sodium/saturated fat, and poor ingredient profile.
+        * **26-50:** Processed, moderate to high in concerning nutrients, but may offer some macro-nutritional benefit.
+        * **51-75:** Moderately healthy, reasonable balance of macros, generally lower in concerning nutrients.
+        * **76-100:** Minimal ingredients, rich in fiber/protein, very low in saturated fat/sodium/added sugar.
+    * Formulate detailed, user-friendly **positive and negative observations**.
+    * Conclude with a **comprehensive summary** that includes:
+        - Overall health assessment
+        - Potential long-term health implications
+        - Recommendations for consumption frequency
+        - Healthier alternatives when possible""",
+    "industry_insights": """**Industry Insights & Controversies:**
+    * Highlight any **industry practices** related to this product category that consumers should be aware of
+    * Note any **regulatory differences** between countries (e.g., ingredients banned elsewhere but allowed here)
+    * Expose **marketing tactics** that might mislead consumers (e.g., "natural" claims on highly processed products)""",
+    "practical_guidance": """**Practical Consumer Guidance:**
+    * **Storage & Safety**: How to properly store the product and safety considerations
+    * **Preparation Tips**: Best ways to prepare/consume for maximum nutrition
+    * **Label Reading Tricks**: How to identify misleading claims and marketing tactics
+    * **Cost vs. Nutrition**: Is the product worth its price from a nutritional standpoint?
+    * **Serving Size Reality Check**: How realistic the serving size is and what people actually consume""",
+}
+
+# Top-level result sections and the JSON shape requested for each, in output order
+SCHEMA = {
+    "product_info": """{
+    "serving_size": "string",
+    "calories_per_serving": "number | null",
+    "brand": "string | null",
+    "claims": ["string"]
+  }""",
+    "nutrition_facts": """{
+    "total_fat_g": "number | null",
+    "saturated_fat_g": "number | null",
+    "trans_fat_g": "number | null",
+    "cholesterol_mg": "number | null",
+    "sodium_mg": "number | null",
+    "total_carbohydrates_g": "number | null",
+    "dietary_fiber_g": "number | null",
+    "total_sugars_g": "number | null",
+    "added_sugars_g": "number | null",
+    "protein_g": "number | null"
+  }""",
+    "ingredients": """["string"]""",
+    "notable_ingredients": """["string"]""",
+    "detailed_ingredient_analysis": """[
+    {
+      "ingredient": "string",
+      "purpose": "string",
+      "health_concerns": ["string"],
+      "industry_context": "string",
+      "hidden_names": ["string"]
+    }
+  ]""",
+    "processing_analysis": """{
+    "level": "string",
+    "indicators": ["string"],
+    "health_implications": "string"
+  }""",
+    "sugar_analysis": """{
+    "total_sugar_equivalents": "string",
+    "hidden_sugars": ["string"],
+    "percent_of_daily_limit": "number"
+  }""",
+    "additive_impact": """[
+    {
+      "additive": "string",
+      "function": "string",
+      "health_impact": "string",
+      "regulatory_status": "string",
+      "natural_alternatives": ["string"]
+    }
+  ]""",
+    "gmo_analysis": """{
+    "likelihood": "string",
+    "concerns": "string",
+    "certifications": ["string"]
+  }""",
+    "environmental_impact": """{
+    "footprint": "string",
+    "sustainability_concerns": ["string"],
+    "certifications": ["string"]
+  }""",
+    "ethical_considerations": """{
+    "concerns": ["string"],
+    "certifications": ["string"]
+  }""",
+    "allergen_information": """{
+    "major_allergens": ["string"],
+    "cross_contamination_risks": ["string"],
+    "hidden_allergens": ["string"]
+  }""",
+    "contamination_risks": """{
+    "microplastic_risk": "string",
+    "pesticide_risk": "string",
+    "high_risk_ingredients": ["string"]
+  }""",
+    "nutrient_density": """{
+    "score": "string",
+    "empty_calories": "boolean",
+    "fortified_vs_natural": {
+      "fortified": ["string"],
+      "natural": ["string"]
+    }
+  }""",
+    "practical_guidance": """{
+    "storage_safety": "string",
+    "preparation_tips": ["string"],
+    "label_reading_tricks": ["string"],
+    "cost_vs_nutrition": "string",
+    "serving_size_reality": "string"
+  }""",
+    "industry_insights": """{
+    "controversial_practices": ["string"],
+    "regulatory_differences": "string",
+    "marketing_tactics": ["string"]
+  }""",
+    "analysis": """{
+    "positive_aspects": ["string"],
+    "negative_aspects": ["string"],
+    "health_score": "number",
+    "summary": "string",
+    "recommendations": {
+      "consumption_frequency": "string",
+      "healthier_alternatives": ["string"]
+    }
+  }""",
+}
+
+PROMPT_TITLE = "**Comprehensive Food Analysis Requirements:**"
+
+OUTPUT_INSTRUCTIONS = "Return your entire response **only** in the following strict JSON format. Use `null` for any data point that is not visible in the image and cannot be reasonably calculated."
+
+# Independent slices of the full analysis that can run as concurrent
+# predictions. Only a failure of a required group fails the analysis,
+# optional groups degrade to null sections.
+ANALYSIS_GROUPS = [
+    {
+        "name": "core",
+        "title": "Core Nutrition & Health Score",
+        "requirements": ["data_extraction", "processing", "hidden_sugar", "nutrient_density", "scoring"],
+        "sections": [
+            "product_info", "nutrition_facts", "ingredients", "notable_ingredients",
+            "processing_analysis", "sugar_analysis", "nutrient_density", "analysis",
+        ],
+        "max_tokens": 1800,
+        "required": True,
+    },
+    {
+        "name": "ingredients",
+        "title": "Ingredients & Additives",
+        "requirements": ["ingredient_assessment", "additive_impact", "gmo", "allergens"],
+        "sections": ["detailed_ingredient_analysis", "additive_impact", "gmo_analysis", "allergen_information"],
+        "max_tokens": 1800,
+        # Mostly one entry per ingredient, so short lists need far less, see triage.plan()
+        "tokens_per_ingredient": 90,
+        "required": False,
+    },
+    {
+        "name": "environmental",
+        "title": "Environmental & Ethical Impact",
+        "requirements": ["environmental", "ethical", "microplastics", "pesticides"],
+        "sections": ["environmental_impact", "ethical_considerations", "contamination_risks"],
+        "max_tokens": 800,
+        "required": False,
+    },
+    {
+        "name": "practical",
+        "title": "Practical Guidance",
+        "requirements": ["industry_insights", "practical_guidance"],
+        "sections": ["industry_insights", "practical_guidance"],
+        "max_tokens": 900,
+        "required": False,
+    },
+]
+
+
+# Sections the analysis can't do without, a result never ships with them null
+REQUIRED_SECTIONS = frozenset(
+    section for group in ANALYSIS_GROUPS if group["required"] for section in group["sections"]
+)
+
+# Sections that can only be filled from one label panel. Triage leaves them
+# out (and groups left without sections) when the panel isn't in the photo.
+PANEL_SECTIONS = {
+    "nutrition_facts": ["nutrition_facts", "nutrient_density"],
+    "ingredients": [
+        "ingredients", "notable_ingredients", "detailed_ingredient_analysis", "processing_analysis",
+        "additive_impact", "gmo_analysis", "allergen_information",
+    ],
+}
+
+# Budget floor for a group whose sections were cut down by triage, and the
+# part of a per-ingredient budget that doesn't depend on the number of ingredients
+MIN_GROUP_TOKENS = 300
+BASE_INGREDIENT_TOKENS = 300
+
+
+def build_prompt(requirements, sections, title=PROMPT_TITLE):
+    # Numbered requirements followed by the JSON schema for the requested sections
+    numbered = [
+        f"{number}.{' ' * (2 if number < 10 else 1)}{REQUIREMENTS[name]}"
+        for number, name in enumerate(requirements, start=1)
+    ]
+    schema = ",\n".join(f'  "{key}": {SCHEMA[key]}' for key in sections)
+    return (
+        f"{title}\n\n"
+        + "\n\n".join(numbered)
+        + "\n\n**Output Requirement:**\n\n"
+        + OUTPUT_INSTRUCTIONS
+        + "\n\n```json\n{\n" + schema + "\n}"
+    )
+
+
+ANALYSIS_PROMPT = build_prompt(list(REQUIREMENTS), list(SCHEMA))
+
+
+def build_input(file_url, prompt=ANALYSIS_PROMPT, max_completion_tokens=4096, temperature=1):
+    # Input payload for the full nutrition analysis prediction
+    return {
+        "top_p": 1,
+        "prompt": prompt,
+        "messages": [],
+        "image_input": [file_url],
+        "temperature": temperature,
+        "system_prompt": SYSTEM_PROMPT,
+        "presence_penalty": 0,
+        "frequency_penalty": 0,
+        "max_completion_tokens": max_completion_tokens
+    }
+
+
+def build_group_input(file_url, group):
+    # Input payload for one slice of the analysis
+    prompt = build_prompt(
+        group["requirements"],
+        group["sections"],
+        title=f"**Food Analysis Requirements ({group['title']}):**",
+    )
+    return build_input(file_url, prompt=prompt, max_completion_tokens=group["max_tokens"])
+
+
+# Completion budget per section when regenerating only the sections that failed validation
+REPAIR_TOKENS_PER_SECTION = 400
+
+
+def build_sections_input(file_url, sections, max_completion_tokens, title=PROMPT_TITLE):
+    # Input payload for just the given sections, with the requirements of the
+    # groups they belong to
+    requirements = []
+    for group in ANALYSIS_GROUPS:
+        if any(section in group["sections"] for section in sections):
+            requirements += [name for name in group["requirements"] if name not in requirements]
+
+    prompt = build_prompt(
+        requirements,
+        [section for section in SCHEMA if section in sections],
+        title=title,
+    )
+    return build_input(file_url, prompt=prompt, max_completion_tokens=max_completion_tokens)
+
+
+def build_repair_input(file_url, sections):
+    # Input payload that regenerates just the given sections
+    return build_sections_input(
+        file_url,
+        sections,
+        min(4096, REPAIR_TOKENS_PER_SECTION * len(sections)),
+        title="**Food Analysis Requirements (Missing Sections):**",
+    )
+
+
+# Quick look at the photo before paying for the analysis, see triage.py
+TRIAGE_PROMPT = """**Photo Check:**
+
+Do not analyze the product yet. Look at the photo and report only what is visible. Return **only** the following JSON:
+
+```json
+{
+  "food_label": "boolean, true if the photo shows the packaging or label of a food or drink product",
+  "legible": "boolean, true if the label text is sharp and complete enough to read",
+  "panels": ["the panels that are visible and readable, of \"nutrition_facts\" and \"ingredients\""],
+  "ingredient_count": "number of ingredients in the ingredient list | null"
+}"""
+
+TRIAGE_MAX_TOKENS = 120
+
+
+def build_triage_input(file_url):
+    # Short, deterministic classification of the photo
+    return build_input(
+        file_url, prompt=TRIAGE_PROMPT, max_completion_tokens=TRIAGE_MAX_TOKENS, temperature=0
+    )
+
+
+def _prompt_version():
+    # Fingerprint of everything that shapes the model output, triage's plan
+    # included. Cached analyses are keyed by it, so editing the prompt
+    # invalidates them automatically.
+    payload = {
+        "model": MODEL,
+        "full": build_input(None),
+        "groups": [build_group_input(None, group) for group in ANALYSIS_GROUPS],
+        "group_budgets": ANALYSIS_GROUPS,
+        "triage": build_triage_input(None),
+        "panels": PANEL_SECTIONS,
+        "plan_budgets": [MIN_GROUP_TOKENS, BASE_INGREDIENT_TOKENS],
+    }
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+PROMPT_VERSION = _prompt_version()
@@ -0,0 +1,130 @@
+import math
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+# Drop full buckets from the in-memory store once it tracks this many clients
+MEMORY_STORE_PRUNE_AT = 10000
+
+# Refill, spend and persist a bucket in one step so concurrent workers can't
+# both take the last token. Uses the Redis clock so node clocks don't matter.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+
+def parse_rate(rate):
+    """'3/m' -> (3 tokens, refilled at 3 per 60 seconds)."""
+    count, _, period = rate.partition('/')
+    count = int(count)
+    seconds = RATE_PERIODS[period[-1]] * int(period[:-1] or 1)
+    return count, count / seconds
+
+
+class InMemoryBucketStore:
+    """Token buckets for a single process. Used in development and tests."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, capacity, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            tokens, ts = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+
+            if tokens >= cost:
+                allowed, retry_after = True, 0.0
+                tokens -= cost
+            else:
+                allowed, retry_after = False, (cost - tokens) / rate
+
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > MEMORY_STORE_PRUNE_AT:
+                self._prune(now, rate, capacity)
+        return allowed, retry_after
+
+    def _prune(self, now, rate, capacity):
+        full = [
+            key for key, (tokens, ts) in self.buckets.items()
+            if tokens + (now - ts) * rate >= capacity
+        ]
+        for key in full:
+            del self.buckets[key]
+
+
+class RedisBucketStore:
+    """Token buckets shared by every process that uses the same Redis."""
+
+    def __init__(self, url, prefix='ratelimit:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, rate, capacity, cost=1):
+        allowed, retry_after = self.script(keys=[self.prefix + key], args=[rate, capacity, cost])
+        return bool(allowed), float(retry_after)
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        config = settings.RATE_LIMIT_STORE
+        _store = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _store
+
+
+def rate_limit(key, rate, group=None):
+    """Token-bucket rate limit for a view.
+
+    Like django_ratelimit with block=False: the view always runs and checks
+    `request.limited`, plus `request.retry_after` in whole seconds. `key` and
+    a callable `rate` are called with (group, request).
+    """
+    def decorator(view):
+        bucket_group = group or f"{view.__module__}.{view.__qualname__}"
+
+        @wraps(view)
+        def _wrapped(request, *args, **kwargs):
+            current_rate = rate(bucket_group, request) if callable(rate) else rate
+            capacity, refill = parse_rate(current_rate)
+            bucket = f"{bucket_group}:{key(bucket_group, request)}"
+            allowed, retry_after = get_store().take(bucket, refill, capacity)
+            request.limited = getattr(request, 'limited', False) or not allowed
+            request.retry_after = math.ceil(retry_after)
+            return view(request, *args, **kwargs)
+        return _wrapped
+    return decorator
@@ -0,0 +1,121 @@
+import hashlib
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics, prompts
+
+# Request ids are picked by the client, unique among its own analyses
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+FINISHED_STATUSES = ("done", "error", "cancelled")
+
+
+def valid_request_id(request_id):
+    return isinstance(request_id, str) and REQUEST_ID_PATTERN.match(request_id) is not None
+
+
+def analysis_key(client_id, request_id):
+    # Request ids are only unique per client, so analyses are stored and
+    # followed under both: no client can reach another's by guessing its id
+    return f"{client_id}:{request_id}"
+
+
+def group_name(key):
+    # Channel layer group of every socket following this analysis. Group
+    # names can't contain ':' and must stay under 100 characters.
+    return "analysis." + hashlib.sha256(key.encode()).hexdigest()[:40]
+
+
+def _key(key):
+    return f"analysis:{key}"
+
+
+def _section_key(key, section):
+    return f"analysis-section:{key}:{section}"
+
+
+def _owner_key(key):
+    return f"analysis-owner:{key}"
+
+
+async def get(key):
+    """The stored state of an analysis, or None if it is unknown or expired.
+
+    A dict with `status` (preparing, queued, running, done, error or
+    cancelled), the `sections` streamed so far and, once finished, the
+    `final` message that was sent to the client.
+    """
+    section_keys = {_section_key(key, section): section for section in prompts.SCHEMA}
+    stored = await cache.aget_many([_key(key), *section_keys])
+    record = stored.pop(_key(key), None)
+    if record is None:
+        return None
+
+    record["sections"] = {section_keys[k]: data for k, data in stored.items()}
+    if record["sections"] and record["status"] not in FINISHED_STATUSES:
+        record["status"] = "running"
+    return record
+
+
+async def summary(key):
+    """The stored state of an analysis without its sections, or None."""
+    return await cache.aget(_key(key))
+
+
+async def start(key):
+    """Store the state of a new analysis, returns False if the id is already taken."""
+    if not await cache.aadd(_key(key), {"status": "preparing", "started_at": time.time()},
+                            settings.ANALYSIS_RESULT_TTL):
+        return False
+    # Sections are written after the record, they can outlive an expired one
+    await cache.adelete_many([_section_key(key, section) for section in prompts.SCHEMA])
+    return True
+
+
+async def update(key, **fields):
+    # Only the small fields live in the record, sections have keys of their own
+    record = await summary(key) or {"status": "preparing"}
+    record.update(fields)
+    await cache.aset(_key(key), record, settings.ANALYSIS_RESULT_TTL)
+    return record
+
+
+async def record_message(key, message):
+    """Fold a client message into the stored state so it can be replayed later."""
+    if "section" in message:
+        # One write per section, sections outside the schema aren't replayed
+        if message["section"] in prompts.SCHEMA:
+            await cache.aset(_section_key(key, message["section"]), message["data"],
+                             settings.ANALYSIS_RESULT_TTL)
+        return
+    # Queue position updates aren't stored, submit() already marked the job queued
+    if "analysis_result" in message:
+        await _finish(key, "done", message)
+    elif "error" in message:
+        await _finish(key, "error", message)
+    elif "cancelled" in message:
+        await _finish(key, "cancelled", message)
+
+
+async def _finish(key, status, message):
+    record = await summary(key) or {}
+    if record.get("status") not in FINISHED_STATUSES:
+        # Counted once, wherever the analysis ended (web process or worker)
+        metrics.ANALYSES.inc(outcome=metrics.outcome(message))
+        if "started_at" in record:
+            metrics.observe_stage("total", max(0.0, time.time() - record["started_at"]))
+    record.update(status=status, final=message)
+    await cache.aset(_key(key), record, settings.ANALYSIS_RESULT_TTL)
+
+
+async def claim(key, channel_name):
+    # The socket currently following the analysis, a dropped socket only
+    # cancels it if nobody has resumed it since
+    await cache.aset(_owner_key(key), channel_name, settings.ANALYSIS_RESULT_TTL)
+
+
+async def owner(key):
+    return await cache.aget(_owner_key(key))
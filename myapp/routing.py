@@ -4,3 +4,8 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r'ws/nutrition-analysis/$', consumers.NutritionAnalysisConsumer.as_asgi()),
 ]
+
+# Background workers, run with `python manage.py runworker analysis-worker`
+channel_routes = {
+    'analysis-worker': consumers.AnalysisWorker.as_asgi(),
+}
@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest run in the moving average used for ETAs
+DURATION_SMOOTHING = 0.2
+
+
+class AnalysisJob:
+    """A queued analysis. `run` is a coroutine function, `emit` sends a message to the client.
+
+    `width` is the most predictions the job runs at once.
+    """
+
+    def __init__(self, job_id, run, emit, priority=0, width=1):
+        self.id = job_id
+        self.run = run
+        self.emit = emit
+        # Lower runs first, equal priorities run in arrival order
+        self.priority = priority
+        self.width = width
+        self.enqueued_at = time.monotonic()
+
+
+class Scheduler:
+    """Admission control for predictions within one process.
+
+    Jobs run while the predictions they may have in flight (their widths)
+    add up to at most `concurrency`, up to `max_queue` more wait in a
+    priority queue and anything beyond that is shed immediately. Waiting jobs
+    get a queue position and ETA every `update_interval` seconds.
+    """
+
+    def __init__(self, concurrency, max_queue, update_interval, expected_duration=20.0):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.update_interval = update_interval
+        self.avg_duration = expected_duration
+        self.queue = []
+        self.running = {}
+        self.in_use = 0
+        self.counter = itertools.count()
+        self.ticker = None
+
+    def submit(self, job):
+        """Queue a job, returns False if the queue is full and the job was shed."""
+        if len(self.queue) >= self.max_queue:
+            return False
+
+        heapq.heappush(self.queue, (job.priority, next(self.counter), job))
+        self._dispatch()
+
+        if self.queue and (self.ticker is None or self.ticker.done()):
+            self.ticker = asyncio.create_task(self._tick())
+        return True
+
+    def cancel(self, job_id):
+        """Drop a queued job or cancel a running one, returns True if it was found."""
+        for index, (_, _, job) in enumerate(self.queue):
+            if job.id == job_id:
+                self.queue.pop(index)
+                heapq.heapify(self.queue)
+                return True
+
+        task = self.running.get(job_id)
+        if task is not None:
+            task.cancel()
+            return True
+        return False
+
+    def eta(self, position, width=1):
+        # Jobs ahead of this one drain `concurrency` predictions at a time
+        rounds = math.ceil(position * width / self.concurrency)
+        return round(rounds * self.avg_duration)
+
+    def retry_after(self, width=1):
+        return self.eta(len(self.queue) + 1, width)
+
+    def _dispatch(self):
+        # Strict priority order; a job wider than the whole limit runs alone
+        while self.queue and (not self.running or self.in_use + self.queue[0][2].width <= self.concurrency):
+            _, _, job = heapq.heappop(self.queue)
+            metrics.STAGE_SECONDS.observe(time.monotonic() - job.enqueued_at, stage="scheduler_queue")
+            self.in_use += job.width
+            self.running[job.id] = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        started = time.monotonic()
+        try:
+            await job.run()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.exception("Analysis job %s crashed: %s", job.id, e)
+            # A final message, so the client stops waiting and frees its slot
+            try:
+                await job.emit({"error": "An unexpected error occurred"})
+            except Exception as e:
+                logger.warning("Failed to report crash of %s: %s", job.id, e)
+        finally:
+            duration = time.monotonic() - started
+            self.avg_duration += DURATION_SMOOTHING * (duration - self.avg_duration)
+            self.running.pop(job.id, None)
+            self.in_use -= job.width
+            self._dispatch()
+
+    async def _tick(self):
+        while self.queue:
+            await self.send_positions()
+            await asyncio.sleep(self.update_interval)
+
+    async def send_positions(self):
+        for position, (_, _, job) in enumerate(sorted(self.queue), start=1):
+            try:
+                await job.emit({
+                    "queue_position": position,
+                    "eta_s": self.eta(position, job.width)
+                })
+            except Exception as e:
+                logger.warning("Failed to send queue position for %s: %s", job.id, e)
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler(
+            concurrency=settings.ANALYSIS_MAX_CONCURRENCY,
+            max_queue=settings.ANALYSIS_MAX_QUEUE,
+            update_interval=settings.ANALYSIS_QUEUE_UPDATE_INTERVAL,
+        )
+    return _scheduler
@@ -0,0 +1,266 @@
+import json
+import logging
+from typing import List, Optional
+
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
+
+logger = logging.getLogger(__name__)
+
+Text = Optional[str]
+Number = Optional[float]
+TextList = Optional[List[str]]
+
+
+class Section(BaseModel):
+    # Models may add fields we don't know about, keep them rather than fail
+    model_config = ConfigDict(extra='allow')
+
+
+class ProductInfo(Section):
+    serving_size: Text = None
+    calories_per_serving: Number = None
+    brand: Text = None
+    claims: TextList = None
+
+
+class NutritionFacts(Section):
+    total_fat_g: Number = None
+    saturated_fat_g: Number = None
+    trans_fat_g: Number = None
+    cholesterol_mg: Number = None
+    sodium_mg: Number = None
+    total_carbohydrates_g: Number = None
+    dietary_fiber_g: Number = None
+    total_sugars_g: Number = None
+    added_sugars_g: Number = None
+    protein_g: Number = None
+
+
+class IngredientDetail(Section):
+    ingredient: Text = None
+    purpose: Text = None
+    health_concerns: TextList = None
+    industry_context: Text = None
+    hidden_names: TextList = None
+
+
+class ProcessingAnalysis(Section):
+    level: Text = None
+    indicators: TextList = None
+    health_implications: Text = None
+
+
+class SugarAnalysis(Section):
+    total_sugar_equivalents: Text = None
+    hidden_sugars: TextList = None
+    percent_of_daily_limit: Number = None
+
+
+class Additive(Section):
+    additive: Text = None
+    function: Text = None
+    health_impact: Text = None
+    regulatory_status: Text = None
+    natural_alternatives: TextList = None
+
+
+class GmoAnalysis(Section):
+    likelihood: Text = None
+    concerns: Text = None
+    certifications: TextList = None
+
+
+class EnvironmentalImpact(Section):
+    footprint: Text = None
+    sustainability_concerns: TextList = None
+    certifications: TextList = None
+
+
+class EthicalConsiderations(Section):
+    concerns: TextList = None
+    certifications: TextList = None
+
+
+class AllergenInformation(Section):
+    major_allergens: TextList = None
+    cross_contamination_risks: TextList = None
+    hidden_allergens: TextList = None
+
+
+class ContaminationRisks(Section):
+    microplastic_risk: Text = None
+    pesticide_risk: Text = None
+    high_risk_ingredients: TextList = None
+
+
+class FortifiedVsNatural(Section):
+    fortified: TextList = None
+    natural: TextList = None
+
+
+class NutrientDensity(Section):
+    score: Text = None
+    empty_calories: Optional[bool] = None
+    fortified_vs_natural: Optional[FortifiedVsNatural] = None
+
+
+class PracticalGuidance(Section):
+    storage_safety: Text = None
+    preparation_tips: TextList = None
+    label_reading_tricks: TextList = None
+    cost_vs_nutrition: Text = None
+    serving_size_reality: Text = None
+
+
+class IndustryInsights(Section):
+    controversial_practices: TextList = None
+    regulatory_differences: Text = None
+    marketing_tactics: TextList = None
+
+
+class Recommendations(Section):
+    consumption_frequency: Text = None
+    healthier_alternatives: TextList = None
+
+
+class Analysis(Section):
+    positive_aspects: TextList = None
+    negative_aspects: TextList = None
+    # The score is the one value the client can't do without
+    health_score: float
+    summary: Text = None
+    recommendations: Optional[Recommendations] = None
+
+
+class TriageVerdict(BaseModel):
+    # What the triage call saw in the photo, see prompts.TRIAGE_PROMPT
+    food_label: bool
+    legible: bool = True
+    panels: List[str] = []
+    ingredient_count: Optional[int] = None
+
+
+# Validator for each top-level key of the result, in prompts.SCHEMA order
+SECTIONS = {
+    'product_info': TypeAdapter(Optional[ProductInfo]),
+    'nutrition_facts': TypeAdapter(Optional[NutritionFacts]),
+    'ingredients': TypeAdapter(TextList),
+    'notable_ingredients': TypeAdapter(TextList),
+    'detailed_ingredient_analysis': TypeAdapter(Optional[List[IngredientDetail]]),
+    'processing_analysis': TypeAdapter(Optional[ProcessingAnalysis]),
+    'sugar_analysis': TypeAdapter(Optional[SugarAnalysis]),
+    'additive_impact': TypeAdapter(Optional[List[Additive]]),
+    'gmo_analysis': TypeAdapter(Optional[GmoAnalysis]),
+    'environmental_impact': TypeAdapter(Optional[EnvironmentalImpact]),
+    'ethical_considerations': TypeAdapter(Optional[EthicalConsiderations]),
+    'allergen_information': TypeAdapter(Optional[AllergenInformation]),
+    'contamination_risks': TypeAdapter(Optional[ContaminationRisks]),
+    'nutrient_density': TypeAdapter(Optional[NutrientDensity]),
+    'practical_guidance': TypeAdapter(Optional[PracticalGuidance]),
+    'industry_insights': TypeAdapter(Optional[IndustryInsights]),
+    'analysis': TypeAdapter(Analysis),
+}
+
+
+def extract_json(output):
+    """Pull the result object out of model output, however it is wrapped.
+
+    Skips prose or code fences before the first `{`, ignores anything after
+    the matching `}`, drops trailing commas and closes an object cut off by
+    the token limit after its last complete member. Raises
+    json.JSONDecodeError if no object can be recovered.
+    """
+    if isinstance(output, list):
+        output = ''.join(output)
+
+    start = output.find('{')
+    if start == -1:
+        # Let json report the error on the original text
+        return json.loads(output)
+
+    chars = []
+    stack = []
+    in_string = False
+    escaped = False
+    # End of the last complete top-level member, where a truncated object can be closed
+    cut_at = 0
+
+    for char in output[start:]:
+        if in_string:
+            chars.append(char)
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            _strip_trailing_comma(chars)
+            stack.pop()
+        elif char == ',' and len(stack) == 1:
+            cut_at = len(chars)
+
+        chars.append(char)
+
+        if not stack:
+            break
+        if len(chars) == 1:
+            cut_at = 1
+
+    if stack:
+        # Truncated: keep the complete sections and close the object, the
+        # section that was cut off is left out so it counts as missing
+        chars = chars[:cut_at]
+        _strip_trailing_comma(chars)
+        chars.append('}')
+
+    return json.loads(''.join(chars))
+
+
+def _strip_trailing_comma(chars):
+    end = len(chars)
+    while end and chars[end - 1].isspace():
+        end -= 1
+    if end and chars[end - 1] == ',':
+        del chars[end - 1:]
+
+
+def validate_sections(data, sections):
+    """Validate each expected section of a parsed result.
+
+    Returns the cleaned sections and the keys that are missing or invalid.
+    Values are coerced where that is unambiguous ("12" -> 12.0) and unknown
+    fields are kept.
+    """
+    if not isinstance(data, dict):
+        return {}, list(sections)
+
+    valid = {}
+    invalid = []
+    for key in sections:
+        if key not in data:
+            invalid.append(key)
+            continue
+        try:
+            value = SECTIONS[key].validate_python(data[key])
+        except ValidationError as e:
+            logger.info("Invalid section %s: %d errors", key, e.error_count())
+            invalid.append(key)
+            continue
+        valid[key] = SECTIONS[key].dump_python(value, mode='json', exclude_unset=True)
+    return valid, invalid
+
+
+def parse_triage(output):
+    """The TriageVerdict in a triage prediction's output.
+
+    Raises json.JSONDecodeError if there is no JSON object in it and
+    pydantic's ValidationError if the object isn't a verdict.
+    """
+    return TriageVerdict.model_validate(extract_json(output))
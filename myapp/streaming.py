@@ -0,0 +1,69 @@
+import json
+
+
+class SectionParser:
+    """Incrementally pulls top-level sections out of a streamed JSON object.
+
+    Feed it chunks of model output as they arrive; every `"key": value` pair
+    of the outermost object is returned as soon as it is complete. Anything
+    before the opening brace (such as a ```json fence, or prose with
+    [brackets] in it) is skipped.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.member_start = None
+        self.finished = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        sections = []
+
+        while self.pos < len(self.text) and not self.finished:
+            char = self.text[self.pos]
+
+            if self.depth == 0:
+                # Brackets and quotes only count once the object has opened
+                if char == "{":
+                    self.depth = 1
+                    self.member_start = self.pos + 1
+            elif self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self._close_member(sections)
+                    self.finished = True
+            elif char == "," and self.depth == 1:
+                self._close_member(sections)
+                self.member_start = self.pos + 1
+
+            self.pos += 1
+
+        return sections
+
+    def _close_member(self, sections):
+        if self.member_start is None:
+            return
+        member = self.text[self.member_start:self.pos].strip()
+        if not member:
+            return
+        try:
+            parsed = json.loads("{" + member + "}")
+        except json.JSONDecodeError:
+            # Malformed section, the final parse will report it
+            return
+        sections.extend(parsed.items())
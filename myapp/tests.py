@@ -1,3 +1,1546 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import brotli
+import httpx
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from PIL import Image, ImageDraw, ImageFilter
+
+from . import (
+    analysis, analysis_cache, assets, catalog, clients, log, metrics, predictions, preprocessing, prompts, ratelimit, results,
+    schema, transport, triage, uploads,
+)
+from .benchmark.fake_replicate import FakeReplicate
+from .consumers import PredictionWaiterMixin, RecentIds
+from .scheduler import AnalysisJob, Scheduler, get_scheduler
+from .streaming import SectionParser
+from .transport import build_async_client
+from .models import AnalysisCacheEntry
+
+
+def make_label_image(size=(400, 300), quality=90, text_offset=0):
+    # Synthetic "label": dark text-like bars on a light background
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    for row in range(8):
+        y = 20 + row * 30
+        draw.rectangle([30 + text_offset, y, 30 + text_offset + 40 * (row % 5 + 3), y + 12], fill='black')
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def make_nutrition_label(values, quality=90):
+    # Text label with one line per nutrient, scaled up like a phone photo
+    img = Image.new('RGB', (400, 300), 'white')
+    draw = ImageDraw.Draw(img)
+    for row, value in enumerate(values):
+        draw.text((30, 20 + row * 30), f"Nutrient {row}", fill='black')
+        draw.text((200, 20 + row * 30), value, fill='black')
+    buffer = io.BytesIO()
+    img.resize((1600, 1200), Image.BICUBIC).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def model_output(sections=None, **values):
+    # JSON the model could return for these sections, null unless given
+    sections = prompts.SCHEMA if sections is None else sections
+    return json.dumps({section: values.get(section) for section in sections})
+
+
+def group_output(name, **values):
+    group = next(g for g in prompts.ANALYSIS_GROUPS if g["name"] == name)
+    return model_output(group["sections"], **values)
+
+
+class AnalysisCacheTests(TestCase):
+    def setUp(self):
+        self.image = analysis_cache.image_key(make_label_image())
+        self.result = {"analysis": {"health_score": 42}}
+
+    def test_exact_hit(self):
+        self.assertIsNone(analysis_cache.lookup(self.image, 'v1'))
+        analysis_cache.store(self.image, 'v1', self.result)
+        self.assertEqual(analysis_cache.lookup(self.image, 'v1'), self.result)
+        self.assertEqual(AnalysisCacheEntry.objects.get().hit_count, 1)
+
+    def test_near_duplicates_are_off_by_default(self):
+        analysis_cache.store(self.image, 'v1', self.result)
+        self.assertIsNone(analysis_cache.lookup(analysis_cache.image_key(make_label_image(quality=60)), 'v1'))
+
+    @override_settings(ANALYSIS_CACHE_PHASH_DISTANCE=3)
+    def test_near_duplicate_hit(self):
+        image = analysis_cache.image_key(make_nutrition_label(["120 kcal", "3 g", "12 mg", "5 g"]))
+        analysis_cache.store(image, 'v1', self.result)
+        recompressed = analysis_cache.image_key(make_nutrition_label(["120 kcal", "3 g", "12 mg", "5 g"], quality=60))
+        self.assertNotEqual(recompressed['content_hash'], image['content_hash'])
+        self.assertEqual(analysis_cache.lookup(recompressed, 'v1'), self.result)
+
+    @override_settings(ANALYSIS_CACHE_PHASH_DISTANCE=3)
+    def test_different_labels_with_close_hashes_do_not_match(self):
+        product_a = analysis_cache.image_key(make_nutrition_label(["120 kcal", "3 g", "12 mg", "5 g"]))
+        product_b = analysis_cache.image_key(make_nutrition_label(["120 kcal", "3 g", "12 mg", "8 g"]))
+        # The perceptual hash alone would take one for the other
+        self.assertLessEqual(analysis_cache._distance(product_a['phash'], product_b['phash']), 3)
+
+        analysis_cache.store(product_a, 'v1', self.result)
+        self.assertIsNone(analysis_cache.lookup(product_b, 'v1'))
+
+    def test_prompt_version_is_part_of_the_key(self):
+        analysis_cache.store(self.image, 'v1', self.result)
+        self.assertIsNone(analysis_cache.lookup(self.image, 'v2'))
+        self.assertEqual(analysis_cache.invalidate(keep_prompt_version='v2'), 1)
+
+    def test_prompt_version_covers_the_triage_plan(self):
+        with mock.patch.object(prompts, "TRIAGE_PROMPT", prompts.TRIAGE_PROMPT + " "):
+            self.assertNotEqual(prompts._prompt_version(), prompts.PROMPT_VERSION)
+        with mock.patch.dict(prompts.PANEL_SECTIONS, {"nutrition_facts": ["nutrition_facts"]}):
+            self.assertNotEqual(prompts._prompt_version(), prompts.PROMPT_VERSION)
+        self.assertEqual(prompts._prompt_version(), prompts.PROMPT_VERSION)
+
+    @override_settings(ANALYSIS_CACHE_MAX_ENTRIES=2)
+    def test_evicts_least_recently_hit(self):
+        for offset in (0, 60, 120):
+            analysis_cache.store(analysis_cache.image_key(make_label_image(text_offset=offset)), 'v1', self.result)
+        self.assertEqual(AnalysisCacheEntry.objects.count(), 2)
+
+
+WEBHOOK_SECRET = "whsec_" + base64.b64encode(b"test-secret").decode()
+
+
+def sign_webhook(body, secret=WEBHOOK_SECRET, timestamp=None):
+    timestamp = str(int(timestamp or time.time()))
+    key = base64.b64decode(secret.split("_", 1)[1])
+    signature = base64.b64encode(
+        hmac.new(key, b"msg_1." + timestamp.encode() + b"." + body, hashlib.sha256).digest()
+    ).decode()
+    return {
+        "HTTP_WEBHOOK_ID": "msg_1",
+        "HTTP_WEBHOOK_TIMESTAMP": timestamp,
+        "HTTP_WEBHOOK_SIGNATURE": f"v1,{signature}",
+    }
+
+
+@override_settings(REPLICATE_WEBHOOK_SECRET=WEBHOOK_SECRET)
+class ReplicateWebhookTests(SimpleTestCase):
+    def post(self, payload, **headers):
+        body = json.dumps(payload).encode()
+        headers = headers or sign_webhook(body)
+        return self.client.post(
+            '/replicate-webhook/', body, content_type='application/json', **headers
+        )
+
+    def test_completion_is_relayed_to_the_prediction_group(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(predictions.group_name("abc123"), channel)
+
+        response = self.post({"id": "abc123", "status": "succeeded"})
+
+        self.assertEqual(response.status_code, 200)
+        message = async_to_sync(layer.receive)(channel)
+        self.assertEqual(message["type"], "prediction.completed")
+        self.assertEqual(message["status"], "succeeded")
+
+    def test_rejects_bad_signature(self):
+        body = json.dumps({"id": "abc123", "status": "succeeded"}).encode()
+        headers = sign_webhook(body, secret="whsec_" + base64.b64encode(b"other").decode())
+        self.assertEqual(self.post({"id": "abc123", "status": "succeeded"}, **headers).status_code, 403)
+
+    def test_rejects_stale_timestamp(self):
+        body = json.dumps({"id": "abc123", "status": "succeeded"}).encode()
+        headers = sign_webhook(body, timestamp=time.time() - 3600)
+        self.assertEqual(self.post({"id": "abc123", "status": "succeeded"}, **headers).status_code, 403)
+
+    async def waiting_consumer(self, prediction_id):
+        # A consumer waiting on a prediction, fed from the channel layer the
+        # way its dispatch loop would; returns it and the waiting task
+        layer = get_channel_layer()
+        waiter = PredictionWaiterMixin()
+        waiter.channel_layer = layer
+        waiter.channel_name = await layer.new_channel()
+
+        async def dispatch():
+            while True:
+                await waiter.prediction_completed(await layer.receive(waiter.channel_name))
+
+        dispatcher = asyncio.create_task(dispatch())
+        waiting = asyncio.create_task(waiter.wait_for_prediction(SimpleNamespace(id=prediction_id, status="starting")))
+        waiting.add_done_callback(lambda _: dispatcher.cancel())
+        for _ in range(100):
+            if prediction_id in waiter.prediction_waiters:
+                break
+            await asyncio.sleep(0.01)
+        return waiter, waiting
+
+    @override_settings(REPLICATE_WEBHOOK_BASE_URL="https://truview.example", PREDICTION_WEBHOOK_FALLBACK_POLL=30)
+    async def test_signed_webhook_wakes_the_waiting_consumer(self):
+        client = mock.Mock()
+        client.predictions.async_get = mock.AsyncMock(return_value=SimpleNamespace(id="abc123", status="succeeded"))
+        started = time.monotonic()
+        with mock.patch.object(predictions, "get_async_client", return_value=client):
+            waiter, waiting = await self.waiting_consumer("abc123")
+            response = await sync_to_async(self.post)({"id": "abc123", "status": "succeeded"})
+            prediction = await asyncio.wait_for(waiting, 5)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(prediction.status, "succeeded")
+        # Woken by the webhook, long before the 30 s fallback poll
+        self.assertLess(time.monotonic() - started, 5)
+        client.predictions.async_get.assert_awaited_once_with("abc123")
+        self.assertEqual(waiter.prediction_waiters, {})
+
+    @override_settings(REPLICATE_WEBHOOK_BASE_URL="https://truview.example", PREDICTION_WEBHOOK_FALLBACK_POLL=30)
+    async def test_badly_signed_webhook_does_not_wake_the_consumer(self):
+        client = mock.Mock()
+        client.predictions.async_get = mock.AsyncMock(return_value=SimpleNamespace(id="abc123", status="succeeded"))
+        body = json.dumps({"id": "abc123", "status": "succeeded"}).encode()
+        forged = sign_webhook(body, secret="whsec_" + base64.b64encode(b"other").decode())
+
+        with mock.patch.object(predictions, "get_async_client", return_value=client):
+            waiter, waiting = await self.waiting_consumer("abc123")
+            responses = [
+                await sync_to_async(self.post)({"id": "abc123", "status": "succeeded"}, **forged),
+                await sync_to_async(self.client.post)('/replicate-webhook/', body, content_type='application/json'),
+            ]
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiter.prediction_waiters["abc123"].done())
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+
+        self.assertEqual([response.status_code for response in responses], [403, 403])
+        client.predictions.async_get.assert_not_called()
+
+
+class WaitForPredictionTests(SimpleTestCase):
+    @override_settings(PREDICTION_WEBHOOK_FALLBACK_POLL=30)
+    def test_webhook_wakes_waiter_before_fallback_poll(self):
+        client = mock.Mock()
+        client.predictions.async_get = mock.AsyncMock(return_value=SimpleNamespace(id="p1", status="succeeded"))
+
+        async def run():
+            completed = asyncio.get_running_loop().create_future()
+            asyncio.get_running_loop().call_later(0.05, completed.set_result, "succeeded")
+            started = time.monotonic()
+            prediction = await predictions.wait_for_prediction(
+                SimpleNamespace(id="p1", status="starting"), completed
+            )
+            return prediction, time.monotonic() - started
+
+        with mock.patch.object(predictions, "get_async_client", return_value=client):
+            prediction, elapsed = async_to_sync(run)()
+
+        self.assertEqual(prediction.status, "succeeded")
+        self.assertLess(elapsed, 1)
+        client.predictions.async_get.assert_awaited_once_with("p1")
+
+    @override_settings(PREDICTION_WEBHOOK_FALLBACK_POLL=30, PREDICTION_POLL_INITIAL=0.05,
+                       PREDICTION_POLL_BACKOFF=2, PREDICTION_POLL_MAX=0.1)
+    def test_webhook_before_the_prediction_reads_finished_goes_back_to_polling(self):
+        # A stale read (or a forged delivery) must not turn into back-to-back fetches
+        client = mock.Mock()
+        client.predictions.async_get = mock.AsyncMock(side_effect=[
+            SimpleNamespace(id="p1", status="processing"),
+            SimpleNamespace(id="p1", status="processing"),
+            SimpleNamespace(id="p1", status="succeeded"),
+        ])
+
+        async def run():
+            completed = asyncio.get_running_loop().create_future()
+            completed.set_result("succeeded")
+            started = time.monotonic()
+            prediction = await predictions.wait_for_prediction(
+                SimpleNamespace(id="p1", status="starting"), completed
+            )
+            return prediction, time.monotonic() - started
+
+        with mock.patch.object(predictions, "get_async_client", return_value=client):
+            prediction, elapsed = async_to_sync(run)()
+
+        self.assertEqual(prediction.status, "succeeded")
+        self.assertEqual(client.predictions.async_get.await_count, 3)
+        # Two polling intervals between the three fetches: 0.05 s, then 0.1 s
+        self.assertGreaterEqual(elapsed, 0.15)
+
+    @override_settings(PREDICTION_POLL_INITIAL=0.01, PREDICTION_POLL_BACKOFF=2, PREDICTION_POLL_MAX=0.02)
+    def test_polls_with_backoff_without_webhook(self):
+        client = mock.Mock()
+        client.predictions.async_get = mock.AsyncMock(side_effect=[
+            SimpleNamespace(id="p1", status="processing"),
+            SimpleNamespace(id="p1", status="processing"),
+            SimpleNamespace(id="p1", status="failed"),
+        ])
+        with mock.patch.object(predictions, "get_async_client", return_value=client):
+            prediction = async_to_sync(predictions.wait_for_prediction)(
+                SimpleNamespace(id="p1", status="starting")
+            )
+        self.assertEqual(prediction.status, "failed")
+        self.assertEqual(client.predictions.async_get.await_count, 3)
+
+
+@override_settings(REPLICATE_HTTP_RETRY_ATTEMPTS=3, REPLICATE_HTTP_RETRY_BACKOFF=0.001)
+class ReplicateTransportTests(SimpleTestCase):
+    def fake_api(self, statuses):
+        # Answers each request with the next status, recording the method
+        calls = []
+
+        def handler(request):
+            calls.append(request.method)
+            status = statuses.pop(0)
+            body = {"id": "p1", "model": "openai/gpt-4o-mini", "version": "v1", "status": "starting",
+                    "urls": {"get": "https://files/f1"}}
+            return httpx.Response(status, json=body if status < 400 else {"detail": "busy"})
+
+        return httpx.MockTransport(handler), calls
+
+    def client_for(self, mock_transport, **kwargs):
+        # Pooled client as built from settings, with the network swapped for the fake API
+        kwargs.setdefault("base_url", "https://api.test")
+        with mock.patch.object(httpx, "AsyncHTTPTransport", return_value=mock_transport):
+            return build_async_client(**kwargs)
+
+    async def test_retries_throttled_and_failing_gets(self):
+        mock_transport, calls = self.fake_api([429, 502, 200])
+        async with self.client_for(mock_transport) as client:
+            response = await client.get("/v1/predictions/p1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, ["GET", "GET", "GET"])
+
+    async def test_post_is_not_retried_after_server_error(self):
+        mock_transport, calls = self.fake_api([500, 201])
+        async with self.client_for(mock_transport) as client:
+            response = await client.post("/v1/predictions", json={})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(calls, ["POST"])
+
+        mock_transport, calls = self.fake_api([429, 201])
+        async with self.client_for(mock_transport) as client:
+            response = await client.post("/v1/predictions", json={})
+        self.assertEqual(response.status_code, 201)
+
+    def test_retry_after_header_is_honoured(self):
+        retry = transport.RetryTransport(None, attempts=3, backoff=0.5, max_backoff=10)
+        self.assertEqual(retry.delay(0, {"Retry-After": "3"}), 3)
+        self.assertEqual(retry.delay(0, {"Retry-After": "120"}), 10)
+        self.assertLessEqual(retry.delay(2, {}), 2)
+
+    async def test_async_client_is_shared_per_event_loop(self):
+        mock_transport, calls = self.fake_api([200])
+        with mock.patch.object(transport, "build_async_client",
+                               side_effect=lambda **kwargs: self.client_for(mock_transport, **kwargs)) as build:
+            client = predictions.get_async_client()
+            self.assertIs(predictions.get_async_client(), client)
+            prediction = await client.predictions.async_get("p1")
+        build.assert_called_once()
+        self.assertEqual(prediction.id, "p1")
+        self.assertIs(prediction._client, client)
+
+
+class SectionParserTests(SimpleTestCase):
+    def test_emits_each_section_once_it_closes(self):
+        output = '```json\n{"product_info": {"brand": "A, \\"B\\" }"}, "ingredients": ["x", "y"], "analysis": {"health_score": 40}}\n```'
+        parser = SectionParser()
+        emitted = []
+        for i in range(0, len(output), 7):
+            emitted.append([key for key, _ in parser.feed(output[i:i + 7])])
+
+        sections = [key for chunk in emitted for key in chunk]
+        self.assertEqual(sections, ["product_info", "ingredients", "analysis"])
+        # The first section is available before the stream is finished
+        self.assertLess(next(i for i, chunk in enumerate(emitted) if chunk), len(emitted) - 2)
+
+    def test_values_are_parsed(self):
+        parser = SectionParser()
+        sections = dict(parser.feed('Here you go: {"nutrition_facts": {"protein_g": 3}, "ingredients": []}'))
+        self.assertEqual(sections, {"nutrition_facts": {"protein_g": 3}, "ingredients": []})
+
+    def test_brackets_in_prose_before_the_object_are_ignored(self):
+        parser = SectionParser()
+        sections = parser.feed('Based on the label [front and back], "here" is the result [1]:\n')
+        sections += parser.feed('```json\n{"ingredients": ["oats"], "analysis": {"health_score": 60}}\n```')
+        self.assertEqual(dict(sections), {"ingredients": ["oats"], "analysis": {"health_score": 60}})
+
+
+class UploadStoreTests(SimpleTestCase):
+    def test_quota_rejects_uploads_until_space_frees_up(self):
+        store = uploads.UploadStore(max_bytes=10, ttl=60, sweep_interval=60)
+        first = store.put(b"x" * 6)
+        with self.assertRaises(uploads.UploadStoreFull):
+            store.put(b"y" * 6)
+        store.discard(first.id)
+        self.assertIsNotNone(store.put(b"y" * 6))
+
+    def test_expired_uploads_are_swept(self):
+        store = uploads.UploadStore(max_bytes=100, ttl=60, sweep_interval=60)
+        upload = store.put(b"data")
+        upload.created_at -= 61
+        self.assertEqual(store.sweep(), 1)
+        self.assertIsNone(store.get(upload.id))
+        self.assertEqual(store.total_bytes, 0)
+
+    def test_consumer_sees_the_uploaded_bytes_without_a_copy(self):
+        store = uploads.UploadStore(max_bytes=100, ttl=60, sweep_interval=60)
+        data = b"image bytes"
+        upload = store.put(data)
+        self.assertIs(store.get(upload.id).data, data)
+        self.assertEqual(bytes(upload.view), data)
+
+
+@override_settings(UPLOAD_EAGER_PREPARE=False)
+class UploadImageViewTests(TestCase):
+    def test_upload_is_kept_in_memory(self):
+        image = make_label_image()
+        response = self.client.post('/upload-image/', {
+            'image': SimpleUploadedFile('label.jpg', image, content_type='image/jpeg'),
+        })
+        body = response.json()
+        self.assertTrue(body['success'])
+        upload = uploads.store.get(body['upload_id'])
+        self.assertEqual(upload.data, image)
+        uploads.store.discard(upload.id)
+
+    @override_settings(UPLOAD_SHARED=True, UPLOAD_EAGER_PREPARE=True)
+    def test_shared_upload_is_claimed_from_another_process(self):
+        image = make_label_image()
+        release_prepare = threading.Event()
+
+        def prepare(upload):
+            release_prepare.wait(5)
+            return 'https://files.example/label.jpg'
+
+        with mock.patch.object(uploads, 'prepare', side_effect=prepare):
+            response = self.client.post('/upload-image/', {
+                'image': SimpleUploadedFile('label.jpg', image, content_type='image/jpeg'),
+            })
+            upload_id = response.json()['upload_id']
+            prepared = uploads.store.get(upload_id).prepared
+            release_prepare.set()
+            prepared.result(timeout=5)
+
+        # Once uploaded to Replicate the image only lives in the shared cache
+        self.assertIsNone(uploads.store.get(upload_id))
+        claimed = async_to_sync(uploads.claim)(upload_id)
+        self.assertEqual(claimed.data, image)
+        self.assertEqual(claimed.prepared.result(), 'https://files.example/label.jpg')
+
+        async_to_sync(uploads.release)(claimed)
+        self.assertIsNone(async_to_sync(uploads.claim)(upload_id))
+
+
+class PreprocessingTests(SimpleTestCase):
+    def test_downscales_and_recompresses(self):
+        data = make_label_image(size=(3000, 2000), quality=95)
+        result, stats = preprocessing.preprocess_image(data, max_edge=1000, quality=80)
+        with Image.open(io.BytesIO(result)) as img:
+            self.assertEqual(max(img.size), 1000)
+        self.assertLess(stats['bytes_out'], stats['bytes_in'])
+        self.assertGreaterEqual(stats['cpu_ms'], 0)
+
+    def test_applies_exif_orientation(self):
+        img = Image.new('RGB', (200, 100), 'white')
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', exif=exif)
+        result, _ = preprocessing.preprocess_image(buffer.getvalue(), max_edge=1000, quality=80)
+        with Image.open(io.BytesIO(result)) as rotated:
+            self.assertEqual(rotated.size, (100, 200))
+
+    def test_crops_to_label_region(self):
+        img = Image.new('RGB', (800, 800), 'white')
+        label = Image.open(io.BytesIO(make_label_image(size=(400, 300))))
+        img.paste(label, (200, 250))
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        result, stats = preprocessing.preprocess_image(
+            buffer.getvalue(), max_edge=2000, quality=80, crop_label=True
+        )
+        self.assertTrue(stats['cropped'])
+        with Image.open(io.BytesIO(result)) as cropped:
+            self.assertLess(cropped.width * cropped.height, 800 * 800 * 0.5)
+
+    def test_measures_sharpness_and_contrast(self):
+        def quality(img):
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=90)
+            return preprocessing.preprocess_image(buffer.getvalue(), max_edge=1000, quality=80)[1]
+
+        label = Image.open(io.BytesIO(make_label_image()))
+        sharp = quality(label)
+        blurred = quality(label.filter(ImageFilter.GaussianBlur(5)))
+        blank = quality(Image.new('RGB', (400, 300), 'white'))
+
+        self.assertGreater(sharp['sharpness'], 100 * blurred['sharpness'])
+        self.assertIsNone(triage.check_photo(sharp))
+        self.assertEqual(triage.check_photo(blurred), 'blurry')
+        self.assertEqual(triage.check_photo(blank), 'blank')
+        self.assertIsNone(triage.check_photo(None))
+
+    def test_runs_in_process_pool(self):
+        data = make_label_image(size=(1200, 800))
+        result, stats = preprocessing.run(data, max_edge=600, quality=80, crop_label=False, workers=1)
+        self.assertEqual(stats['size'][0], 600)
+
+
+class SchedulerTests(SimpleTestCase):
+    def make_job(self, job_id, release, started, messages, priority=0):
+        async def run():
+            started.append(job_id)
+            await release.wait()
+
+        async def emit(message):
+            messages.setdefault(job_id, []).append(message)
+
+        return AnalysisJob(job_id, run=run, emit=emit, priority=priority)
+
+    async def test_limits_concurrency_and_sheds_past_max_queue(self):
+        scheduler = Scheduler(concurrency=2, max_queue=2, update_interval=60)
+        release = asyncio.Event()
+        started, messages = [], {}
+
+        accepted = [scheduler.submit(self.make_job(i, release, started, messages)) for i in range(5)]
+        await asyncio.sleep(0)
+
+        self.assertEqual(accepted, [True, True, True, True, False])
+        self.assertEqual(started, [0, 1])
+        self.assertEqual(messages[2][0]["queue_position"], 1)
+        self.assertEqual(messages[3][0]["queue_position"], 2)
+
+        release.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(started, [0, 1, 2, 3])
+
+    async def test_priority_jumps_the_queue(self):
+        scheduler = Scheduler(concurrency=1, max_queue=10, update_interval=60)
+        release = asyncio.Event()
+        started, messages = [], {}
+
+        scheduler.submit(self.make_job("running", release, started, messages))
+        scheduler.submit(self.make_job("bulk", release, started, messages, priority=10))
+        scheduler.submit(self.make_job("user", release, started, messages, priority=0))
+        await asyncio.sleep(0)
+        self.assertEqual(messages["user"][0]["queue_position"], 1)
+
+        release.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(started, ["running", "user", "bulk"])
+
+    async def test_admits_jobs_by_the_predictions_they_run(self):
+        scheduler = Scheduler(concurrency=8, max_queue=10, update_interval=60)
+        release = asyncio.Event()
+        started, messages = [], {}
+
+        for i in range(3):
+            job = self.make_job(i, release, started, messages)
+            job.width = 4
+            scheduler.submit(job)
+        await asyncio.sleep(0)
+
+        self.assertEqual(started, [0, 1])
+        self.assertEqual(scheduler.in_use, 8)
+        self.assertEqual(messages[2][0]["queue_position"], 1)
+
+        release.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(started, [0, 1, 2])
+        self.assertEqual(scheduler.in_use, 0)
+
+    async def test_crashed_job_sends_a_final_error(self):
+        scheduler = Scheduler(concurrency=1, max_queue=10, update_interval=60)
+        messages = []
+
+        async def run():
+            raise RuntimeError("boom")
+
+        async def emit(message):
+            messages.append(message)
+
+        with self.assertLogs("myapp.scheduler", "ERROR"):
+            scheduler.submit(AnalysisJob("crash", run=run, emit=emit))
+            for _ in range(3):
+                await asyncio.sleep(0)
+
+        self.assertEqual(messages, [{"error": "An unexpected error occurred"}])
+        self.assertEqual(scheduler.running, {})
+
+
+def client_cookie(client_id):
+    # The signed cookie the index page sets
+    return signing.get_cookie_signer(salt=clients.CLIENT_COOKIE + clients.CLIENT_COOKIE_SALT).sign(client_id)
+
+
+@override_settings(ANALYSIS_STREAMING=False, UPLOAD_EAGER_PREPARE=False, PREPROCESS_ENABLED=False,
+                   ANALYSIS_FAN_OUT=False)
+class NutritionAnalysisConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def socket(self, client_id):
+        from TruView.asgi import application
+
+        cookie = f"{clients.CLIENT_COOKIE}={client_cookie(client_id)}"
+        return WebsocketCommunicator(application, "/ws/nutrition-analysis/", headers=[(b"cookie", cookie.encode())])
+
+    async def get_analysis(self, client_id, request_id):
+        self.client.cookies[clients.CLIENT_COOKIE] = client_cookie(client_id)
+        return await database_sync_to_async(self.client.get)(f"/analysis/{request_id}/")
+
+    async def test_runs_analysis_through_the_scheduler(self):
+        from TruView.asgi import application
+
+        output = '```json\n' + model_output(analysis={"health_score": 70}) + '\n```'
+        prediction = SimpleNamespace(id="p1", status="succeeded", output=output, error=None, urls={})
+        upload = uploads.store.put(make_label_image())
+
+        with mock.patch.object(predictions, "async_upload_file", mock.AsyncMock(return_value="https://files/p1")), \
+                mock.patch.object(predictions, "create_prediction", mock.AsyncMock(return_value=prediction)):
+            communicator = WebsocketCommunicator(application, "/ws/nutrition-analysis/")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await communicator.send_json_to({"id": "r1", "upload_id": upload.id})
+            self.assertEqual(await communicator.receive_json_from(), {"received": "true", "id": "r1"})
+            message = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+
+        self.assertEqual(message["id"], "r1")
+        self.assertEqual(message["analysis_result"]["analysis"], {"health_score": 70})
+        self.assertNotIn("degraded", message["analysis_result"])
+        self.assertIsNone(uploads.store.get(upload.id))
+
+
+    @override_settings(PREPROCESS_ENABLED=True)
+    async def test_blurry_photo_is_rejected_before_any_prediction(self):
+        buffer = io.BytesIO()
+        Image.open(io.BytesIO(make_label_image())).filter(ImageFilter.GaussianBlur(5)).save(buffer, format='JPEG')
+        upload = uploads.store.put(buffer.getvalue())
+
+        with mock.patch.object(predictions, "async_upload_file", mock.AsyncMock(return_value="https://files/p1")), \
+                mock.patch.object(predictions, "create_prediction", mock.AsyncMock()) as create:
+            communicator = self.socket("c1")
+            await communicator.connect()
+            await communicator.send_json_to({"id": "r1", "upload_id": upload.id})
+            await communicator.receive_json_from()
+            message = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+
+        self.assertEqual(message, {**triage.rejection("blurry"), "id": "r1"})
+        create.assert_not_called()
+        self.assertEqual((await results.get(results.analysis_key("c1", "r1")))["status"], "error")
+
+    async def start_slow_analyses(self, communicator, request_ids):
+        # Analyses whose predictions never finish, until they are cancelled
+        for request_id in request_ids:
+            upload = uploads.store.put(make_label_image(text_offset=len(request_id)))
+            await communicator.send_json_to({"id": request_id, "upload_id": upload.id})
+            self.assertEqual((await communicator.receive_json_from())["received"], "true")
+
+        # Wait until every prediction has been created
+        for _ in range(100):
+            if len(get_scheduler().running) == len(request_ids):
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(len(get_scheduler().running), len(request_ids))
+
+    def slow_predictions(self, release=None):
+        # Predictions that only finish once `release` is set
+        prediction = SimpleNamespace(id="p1", status="processing", output=None, error=None, urls={})
+        create = mock.AsyncMock(side_effect=lambda *args, **kwargs: SimpleNamespace(**vars(prediction)))
+
+        async def never_finishes(prediction, completed=None):
+            await (release or asyncio.Event()).wait()
+            return SimpleNamespace(id="p1", status="succeeded", error=None,
+                                   output=model_output(analysis={"health_score": 80}))
+
+        return mock.patch.multiple(
+            predictions,
+            async_upload_file=mock.AsyncMock(return_value="https://files/p1"),
+            create_prediction=create,
+            wait_for_prediction=never_finishes,
+            cancel_prediction=mock.DEFAULT,
+        )
+
+    @override_settings(ANALYSIS_RESUME_GRACE=0)
+    async def test_cancel_message_stops_only_that_analysis(self):
+        from TruView.asgi import application
+
+        with self.slow_predictions() as mocks:
+            communicator = WebsocketCommunicator(application, "/ws/nutrition-analysis/")
+            await communicator.connect()
+            await self.start_slow_analyses(communicator, ["r1", "r2"])
+
+            await communicator.send_json_to({"cancel": "r1"})
+            self.assertEqual(await communicator.receive_json_from(), {"cancelled": True, "id": "r1"})
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(get_scheduler().running), 1)
+            mocks["cancel_prediction"].assert_awaited_once_with("p1")
+
+            # A repeated request id is ignored
+            await communicator.send_json_to({"id": "r2", "upload_id": "again"})
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+
+            await communicator.disconnect()
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(get_scheduler().running), 0)
+            self.assertEqual(mocks["cancel_prediction"].await_count, 2)
+
+    async def test_cancel_reaches_a_job_hosted_by_another_socket(self):
+        real_cancel = analysis.cancel
+        attempts = []
+
+        def cancel(job_id):
+            # The follower's process doesn't run the job, its host's does
+            attempts.append(job_id)
+            return len(attempts) > 1 and real_cancel(job_id)
+
+        with self.slow_predictions() as mocks, mock.patch.object(analysis, "cancel", side_effect=cancel):
+            host = self.socket("c1")
+            await host.connect()
+            await self.start_slow_analyses(host, ["r1"])
+
+            follower = self.socket("c1")
+            await follower.connect()
+            await follower.send_json_to({"resume": "r1"})
+            await follower.receive_json_from()
+            await follower.send_json_to({"cancel": "r1"})
+            self.assertEqual(await follower.receive_json_from(), {"cancelled": True, "id": "r1"})
+
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(attempts), 2)
+            self.assertEqual(len(get_scheduler().running), 0)
+            mocks["cancel_prediction"].assert_awaited_once_with("p1")
+            await follower.disconnect()
+            await host.disconnect()
+
+    @override_settings(ANALYSIS_RESUME_GRACE=0.1)
+    async def test_resumes_on_a_new_socket(self):
+        release = asyncio.Event()
+        with self.slow_predictions(release) as mocks:
+            first = self.socket("c1")
+            await first.connect()
+            await self.start_slow_analyses(first, ["r1"])
+            await first.disconnect()
+
+            second = self.socket("c1")
+            await second.connect()
+            await second.send_json_to({"resume": "r1"})
+            self.assertEqual(await second.receive_json_from(), {
+                "resumed": True, "status": "running", "sections": {}, "id": "r1",
+            })
+
+            # Outlives the grace period because another socket picked it up
+            await asyncio.sleep(0.2)
+            mocks["cancel_prediction"].assert_not_called()
+
+            release.set()
+            message = await second.receive_json_from(timeout=5)
+            self.assertEqual(message["analysis_result"]["analysis"], {"health_score": 80})
+            self.assertEqual(message["id"], "r1")
+
+            # Finished analyses are replayed straight away
+            await second.send_json_to({"resume": "r1"})
+            self.assertEqual((await second.receive_json_from())["analysis_result"], message["analysis_result"])
+            await second.send_json_to({"resume": "unknown"})
+            self.assertIn("not found", (await second.receive_json_from())["error"])
+            await second.disconnect()
+
+        response = await self.get_analysis("c1", "r1")
+        self.assertEqual(response.json()["status"], "done")
+        self.assertEqual(response.json()["analysis_result"]["analysis"], {"health_score": 80})
+        response = await self.get_analysis("c1", "unknown")
+        self.assertEqual(response.status_code, 404)
+
+    async def test_request_ids_are_scoped_to_the_client(self):
+        with self.slow_predictions() as mocks:
+            owner = self.socket("c1")
+            await owner.connect()
+            await self.start_slow_analyses(owner, ["r1"])
+
+            # Another browser can neither follow, cancel nor read it
+            other = self.socket("c2")
+            await other.connect()
+            await other.send_json_to({"resume": "r1"})
+            self.assertIn("not found", (await other.receive_json_from())["error"])
+            await other.send_json_to({"cancel": "r1"})
+            self.assertTrue(await other.receive_nothing(timeout=0.1))
+            self.assertEqual((await self.get_analysis("c2", "r1")).status_code, 404)
+            self.client.cookies.clear()
+            response = await database_sync_to_async(self.client.get)("/analysis/r1/")
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual((await self.get_analysis("c1", "r1")).json()["status"], "running")
+
+            # It may start its own analysis under the same id
+            await other.send_json_to({"id": "r1", "upload_id": "missing"})
+            self.assertEqual(await other.receive_json_from(), {"received": "true", "id": "r1"})
+            self.assertIn("expired", (await other.receive_json_from())["error"])
+            await other.send_json_to({"upload_id": "missing"})
+            self.assertEqual(await other.receive_json_from(), {"error": "Invalid request id"})
+            await other.disconnect()
+
+            # An id is never reused, even from a new socket of the same browser
+            again = self.socket("c1")
+            await again.connect()
+            await again.send_json_to({"id": "r1", "upload_id": "missing"})
+            self.assertEqual(await again.receive_json_from(), {"error": "Request id already used", "id": "r1"})
+            await again.disconnect()
+
+            mocks["cancel_prediction"].assert_not_called()
+            await owner.send_json_to({"cancel": "r1"})
+            self.assertEqual(await owner.receive_json_from(), {"cancelled": True, "id": "r1"})
+            await owner.disconnect()
+
+    def test_recent_ids_are_bounded(self):
+        recent = RecentIds(max_size=2, ttl=60)
+        self.assertTrue(recent.add("a"))
+        self.assertFalse(recent.add("a"))
+        recent.add("b")
+        recent.add("c")
+        self.assertEqual(list(recent.seen), ["b", "c"])
+        self.assertTrue(recent.add("a"))
+
+        recent = RecentIds(max_size=10, ttl=0)
+        recent.add("a")
+        time.sleep(0.01)
+        self.assertTrue(recent.add("a"))
+
+
+class AnalysisResultsTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    async def test_sections_are_stored_under_their_own_keys(self):
+        self.assertTrue(await results.start("k1"))
+        self.assertFalse(await results.start("k1"))
+        await results.update("k1", status="queued", job_id="j1")
+
+        with mock.patch.object(cache, "aset", wraps=cache.aset) as aset:
+            await results.record_message("k1", {"section": "product_info", "data": {"brand": "Acme"}})
+            await results.record_message("k1", {"section": "analysis", "data": None})
+            await results.record_message("k1", {"queue_position": 2})
+        # One write per section, none for queue updates, the record is left alone
+        self.assertEqual([call.args[0] for call in aset.call_args_list], [
+            "analysis-section:k1:product_info", "analysis-section:k1:analysis",
+        ])
+
+        record = await results.get("k1")
+        self.assertEqual(record["status"], "running")
+        self.assertEqual(record["job_id"], "j1")
+        self.assertEqual(record["sections"], {"product_info": {"brand": "Acme"}, "analysis": None})
+
+        await results.record_message("k1", {"cancelled": True})
+        self.assertEqual((await results.get("k1"))["status"], "cancelled")
+        self.assertEqual((await results.summary("k1"))["final"], {"cancelled": True})
+
+
+@override_settings(ANALYSIS_STREAMING=False, ANALYSIS_OPTIONAL_GROUP_TIMEOUT=0.2, ANALYSIS_TRIAGE=False)
+class FanOutAnalysisTests(SimpleTestCase):
+    def group_outputs(self, **outputs):
+        # Fake predictions answering each group's prompt, None never finishes
+        def create(input_data, stream=False):
+            group = next(g for g in prompts.ANALYSIS_GROUPS if f"({g['title']})" in input_data["prompt"])
+            output = outputs[group["name"]]
+            status = "processing" if output is None else "succeeded"
+            return SimpleNamespace(id=group["name"], status=status, output=output, error=None)
+
+        async def wait_for_prediction(prediction):
+            while prediction.status == "processing":
+                await asyncio.sleep(1)
+            return prediction
+
+        return mock.AsyncMock(side_effect=create), SimpleNamespace(wait_for_prediction=wait_for_prediction)
+
+    async def run_job(self, create, waiter):
+        messages = []
+
+        async def emit(message):
+            messages.append(message)
+
+        job = analysis.new_job("r1", "https://files/p1", analysis_cache.image_key(b"img"), "reply")
+        with mock.patch.object(predictions, "create_prediction", create), \
+                mock.patch.object(predictions, "cancel_prediction", mock.AsyncMock()) as cancel, \
+                mock.patch.object(analysis_cache, "store") as store:
+            await analysis.run_analysis(job, emit, waiter)
+            await asyncio.sleep(0)
+        return messages, cancel, store
+
+    def test_groups_cover_the_schema_once(self):
+        sections = [section for group in prompts.ANALYSIS_GROUPS for section in group["sections"]]
+        self.assertCountEqual(sections, prompts.SCHEMA)
+
+    async def test_slow_optional_group_degrades_to_null(self):
+        create, waiter = self.group_outputs(
+            core=group_output("core", analysis={"health_score": 70}),
+            ingredients=group_output("ingredients", gmo_analysis={"gmo_risk_level": "low"}),
+            environmental=None,
+            practical='```json\n' + group_output("practical", practical_guidance={"storage_safety": "Keep dry"}) + '\n```',
+        )
+        messages, cancel, store = await self.run_job(create, waiter)
+
+        self.assertEqual(create.await_count, 4)
+        result = messages[-1]["analysis_result"]
+        self.assertEqual(list(result), list(prompts.SCHEMA) + ["degraded"])
+        self.assertEqual(result["analysis"], {"health_score": 70})
+        self.assertEqual(result["gmo_analysis"], {"gmo_risk_level": "low"})
+        self.assertEqual(result["practical_guidance"], {"storage_safety": "Keep dry"})
+        self.assertIsNone(result["environmental_impact"])
+        self.assertEqual(result["degraded"], ["environmental_impact", "ethical_considerations", "contamination_risks"])
+        self.assertIn({"section": "contamination_risks", "data": None}, messages)
+        cancel.assert_awaited_once_with("environmental")
+        store.assert_not_called()
+
+    async def test_failed_required_group_fails_the_analysis(self):
+        create, waiter = self.group_outputs(
+            core="not json", ingredients=group_output("ingredients"), environmental=None,
+            practical=group_output("practical"),
+        )
+        messages, cancel, store = await self.run_job(create, waiter)
+
+        self.assertEqual(messages[-1], {"error": "Failed to parse the response as JSON"})
+        self.assertNotIn("analysis_result", messages[-1])
+        store.assert_not_called()
+
+    async def test_required_group_still_invalid_after_repair_fails_the_analysis(self):
+        # The fake only answers group prompts, so the repair fails too
+        create, waiter = self.group_outputs(
+            core=group_output("core", analysis={"health_score": "great"}),
+            ingredients=group_output("ingredients"), environmental=group_output("environmental"),
+            practical=group_output("practical"),
+        )
+        messages, cancel, store = await self.run_job(create, waiter)
+
+        self.assertEqual(messages[-1], {"error": "Analysis failed"})
+        store.assert_not_called()
+
+    @override_settings(ANALYSIS_MAX_CONCURRENCY=2)
+    async def test_predictions_in_flight_stay_within_the_process_limit(self):
+        create, _ = self.group_outputs(**{group["name"]: group_output(group["name"]) for group in prompts.ANALYSIS_GROUPS})
+        in_flight, peak = 0, 0
+
+        async def wait_for_prediction(prediction):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return prediction
+
+        await self.run_job(create, SimpleNamespace(wait_for_prediction=wait_for_prediction))
+
+        self.assertGreaterEqual(create.await_count, 4)
+        self.assertEqual(peak, 2)
+
+    async def test_prediction_slots_follow_the_setting(self):
+        with override_settings(ANALYSIS_MAX_CONCURRENCY=2):
+            slots = analysis.prediction_slots()
+            self.assertIs(analysis.prediction_slots(), slots)
+        with override_settings(ANALYSIS_MAX_CONCURRENCY=3):
+            self.assertIsNot(analysis.prediction_slots(), slots)
+
+
+class OutputSchemaTests(SimpleTestCase):
+    def test_extracts_object_from_prose_with_trailing_commas(self):
+        output = 'Here is the analysis:\n```json\n{"ingredients": ["sugar", "salt",],}\n```\nLet me know!'
+        self.assertEqual(schema.extract_json(output), {"ingredients": ["sugar", "salt"]})
+
+    def test_truncated_object_keeps_complete_sections(self):
+        output = '{"ingredients": ["sugar"], "analysis": {"health_score": 40, "summary": "Mostly sug'
+        self.assertEqual(schema.extract_json(output), {"ingredients": ["sugar"]})
+
+    def test_reports_missing_and_invalid_sections(self):
+        data = {"analysis": {"health_score": "85"}, "ingredients": "sugar, salt", "product_info": None}
+        valid, invalid = schema.validate_sections(data, ["product_info", "ingredients", "gmo_analysis", "analysis"])
+        self.assertEqual(valid, {"product_info": None, "analysis": {"health_score": 85}})
+        self.assertEqual(invalid, ["ingredients", "gmo_analysis"])
+
+
+@override_settings(ANALYSIS_STREAMING=False, ANALYSIS_FAN_OUT=False, ANALYSIS_TRIAGE=False)
+class OutputRepairTests(SimpleTestCase):
+    def setUp(self):
+        metrics.flush()
+        cache.clear()
+
+    async def test_regenerates_only_broken_sections(self):
+        broken = json.loads(model_output(analysis={"health_score": 55}))
+        broken["ingredients"] = "sugar, salt"
+        del broken["gmo_analysis"]
+        first = SimpleNamespace(id="p1", status="succeeded", output=json.dumps(broken), error=None,
+                                metrics={"output_token_count": 3000})
+        repair = SimpleNamespace(id="p2", status="succeeded", error=None, metrics={"output_token_count": 200},
+                                 output=model_output(["ingredients", "gmo_analysis"], ingredients=["sugar", "salt"]))
+        create = mock.AsyncMock(side_effect=[first, repair])
+        waiter = SimpleNamespace(wait_for_prediction=mock.AsyncMock(side_effect=lambda p: p))
+        messages = []
+
+        async def emit(message):
+            messages.append(message)
+
+        job = analysis.new_job("r1", "https://files/p1", analysis_cache.image_key(b"img"), "reply")
+        with mock.patch.object(predictions, "create_prediction", create), \
+                mock.patch.object(analysis_cache, "store") as store:
+            await analysis.run_analysis(job, emit, waiter)
+
+        repair_input = create.await_args_list[1].args[0]
+        self.assertIn("(Missing Sections)", repair_input["prompt"])
+        self.assertIn('"gmo_analysis"', repair_input["prompt"])
+        self.assertNotIn('"nutrition_facts"', repair_input["prompt"])
+        self.assertEqual(repair_input["max_completion_tokens"], 2 * prompts.REPAIR_TOKENS_PER_SECTION)
+
+        result = messages[-1]["analysis_result"]
+        self.assertEqual(result["ingredients"], ["sugar", "salt"])
+        self.assertEqual(result["analysis"], {"health_score": 55})
+        self.assertNotIn("degraded", result)
+        store.assert_called_once()
+        self.assertEqual(analysis.repair_stats(), {
+            analysis.OUTPUTS: 1,
+            analysis.REPAIRS: 1,
+            analysis.REPAIR_FAILURES: 0,
+            analysis.REPAIR_TOKENS_SAVED: 2800,
+        })
+
+    async def run_with_failed_repair(self, output):
+        # The first prediction returns `output`, its repair nothing usable
+        first = SimpleNamespace(id="p1", status="succeeded", output=output, error=None)
+        repair = SimpleNamespace(id="p2", status="succeeded", output="Sorry, I can't.", error=None)
+        create = mock.AsyncMock(side_effect=[first, repair])
+        waiter = SimpleNamespace(wait_for_prediction=mock.AsyncMock(side_effect=lambda p: p))
+        messages = []
+
+        async def emit(message):
+            messages.append(message)
+
+        job = analysis.new_job("r1", "https://files/p1", analysis_cache.image_key(b"img"), "reply")
+        with mock.patch.object(predictions, "create_prediction", create), \
+                mock.patch.object(analysis_cache, "store") as store:
+            await analysis.run_analysis(job, emit, waiter)
+        return messages, store
+
+    async def test_optional_section_still_invalid_is_degraded(self):
+        broken = json.loads(model_output(analysis={"health_score": 55}))
+        del broken["gmo_analysis"]
+        messages, store = await self.run_with_failed_repair(json.dumps(broken))
+
+        result = messages[-1]["analysis_result"]
+        self.assertIsNone(result["gmo_analysis"])
+        self.assertEqual(result["degraded"], ["gmo_analysis"])
+        store.assert_not_called()
+
+    async def test_required_section_still_invalid_fails_the_analysis(self):
+        messages, store = await self.run_with_failed_repair(model_output(analysis={"health_score": "great"}))
+
+        self.assertEqual(messages[-1], {"error": "Analysis failed"})
+        self.assertEqual(metrics.outcome(messages[-1]), "failed")
+        store.assert_not_called()
+
+
+@override_settings(ANALYSIS_TRIAGE=True, ANALYSIS_STREAMING=False)
+class TriageTests(SimpleTestCase):
+    def setUp(self):
+        metrics.flush()
+        cache.clear()
+
+    def verdict(self, **fields):
+        return schema.TriageVerdict(**{"food_label": True, "legible": True, **fields})
+
+    def test_plan_leaves_out_missing_panels_and_sizes_budgets(self):
+        groups, skipped = triage.plan(self.verdict(panels=["nutrition_facts"]))
+        self.assertEqual([group["name"] for group in groups], ["core", "environmental", "practical"])
+        self.assertEqual(skipped, prompts.PANEL_SECTIONS["ingredients"])
+        core = groups[0]
+        self.assertEqual(core["sections"], ["product_info", "nutrition_facts", "sugar_analysis", "nutrient_density", "analysis"])
+        self.assertEqual(core["max_tokens"], 1800 * 5 // 8)
+        self.assertEqual(groups[1], prompts.ANALYSIS_GROUPS[2])
+
+        groups, skipped = triage.plan(self.verdict(panels=["ingredients", "nutrition_facts"], ingredient_count=4))
+        self.assertEqual(skipped, [])
+        self.assertEqual(groups[1]["max_tokens"], prompts.BASE_INGREDIENT_TOKENS + 4 * 90)
+        self.assertEqual(triage.plan(self.verdict(panels=["ingredients", "nutrition_facts"])), triage.full_plan())
+
+    def test_judge(self):
+        self.assertEqual(triage.judge(self.verdict(food_label=False)), "not_label")
+        self.assertEqual(triage.judge(self.verdict(legible=False, panels=["ingredients"])), "unreadable")
+        self.assertEqual(triage.judge(self.verdict(panels=["front"])), "no_panels")
+        self.assertIsNone(triage.judge(self.verdict(panels=["ingredients"])))
+
+    async def run_job(self, triage_output):
+        # Triage answers with `triage_output`, every group with a valid analysis
+        def create(input_data, stream=False):
+            if input_data["prompt"] == prompts.TRIAGE_PROMPT:
+                return SimpleNamespace(id="triage", status="succeeded", output=triage_output, error=None)
+            return SimpleNamespace(id="group", status="succeeded", error=None,
+                                   output=model_output(analysis={"health_score": 60}))
+
+        create = mock.AsyncMock(side_effect=create)
+        waiter = SimpleNamespace(wait_for_prediction=mock.AsyncMock(side_effect=lambda p: p))
+        messages = []
+
+        async def emit(message):
+            messages.append(message)
+
+        job = analysis.new_job("r1", "https://files/p1", analysis_cache.image_key(b"img"))
+        with mock.patch.object(predictions, "create_prediction", create), \
+                mock.patch.object(analysis_cache, "store") as store:
+            await analysis.run_analysis(job, emit, waiter)
+        inputs = [call.args[0] for call in create.await_args_list]
+        return messages, inputs, store
+
+    async def test_not_a_label_is_rejected_after_triage(self):
+        messages, inputs, store = await self.run_job('{"food_label": false, "legible": true, "panels": []}')
+
+        self.assertEqual(messages, [triage.rejection("not_label")])
+        self.assertEqual(len(inputs), 1)
+        self.assertEqual(inputs[0]["temperature"], 0)
+        self.assertEqual(inputs[0]["max_completion_tokens"], prompts.TRIAGE_MAX_TOKENS)
+        self.assertEqual(metrics.outcome(messages[-1]), "rejected")
+        store.assert_not_called()
+
+    async def test_runs_only_what_the_visible_panels_support(self):
+        messages, inputs, store = await self.run_job(
+            'Sure! {"food_label": true, "legible": true, "panels": ["nutrition_facts"], "ingredient_count": null}'
+        )
+
+        self.assertEqual(len(inputs), 4)
+        self.assertFalse(any("(Ingredients & Additives)" in data["prompt"] for data in inputs))
+        core_input = next(data for data in inputs if "(Core Nutrition & Health Score)" in data["prompt"])
+        self.assertNotIn('"ingredients"', core_input["prompt"])
+        self.assertEqual(core_input["max_completion_tokens"], 1800 * 5 // 8)
+
+        result = messages[-1]["analysis_result"]
+        self.assertEqual(list(result), list(prompts.SCHEMA) + ["skipped"])
+        self.assertEqual(result["analysis"], {"health_score": 60})
+        self.assertIsNone(result["additive_impact"])
+        self.assertEqual(result["skipped"], [s for s in prompts.SCHEMA if s in prompts.PANEL_SECTIONS["ingredients"]])
+        store.assert_called_once()
+
+    @override_settings(ANALYSIS_FAN_OUT=False)
+    async def test_single_prediction_is_planned_too(self):
+        messages, inputs, _ = await self.run_job(
+            '{"food_label": true, "legible": true, "panels": ["ingredients"], "ingredient_count": 3}'
+        )
+
+        self.assertEqual(len(inputs), 2)
+        self.assertNotIn('"nutrition_facts"', inputs[1]["prompt"])
+        self.assertIn('"additive_impact"', inputs[1]["prompt"])
+        self.assertLess(inputs[1]["max_completion_tokens"], 4096)
+        self.assertEqual(messages[-1]["analysis_result"]["skipped"], prompts.PANEL_SECTIONS["nutrition_facts"])
+
+    async def test_unusable_answer_escalates_to_the_full_analysis(self):
+        messages, inputs, store = await self.run_job("I can't tell what this is.")
+
+        self.assertEqual(len(inputs), 1 + len(prompts.ANALYSIS_GROUPS))
+        self.assertEqual(list(messages[-1]["analysis_result"]), list(prompts.SCHEMA))
+        store.assert_called_once()
+        self.assertIn('truview_triage_total{verdict="escalated"} 1', metrics.render())
+
+
+@override_settings(ANALYSIS_STREAMING=False, ANALYSIS_FAN_OUT=False, ANALYSIS_TRIAGE=False, PREPROCESS_ENABLED=False)
+class AnalyzeCatalogTests(TransactionTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.images = os.path.join(self.root, "images")
+        os.makedirs(os.path.join(self.images, "cereal"))
+        for index, name in enumerate(["a.jpg", "b.png", "cereal/c.jpg"]):
+            with open(os.path.join(self.images, name), "wb") as f:
+                f.write(make_label_image(text_offset=index * 40))
+        with open(os.path.join(self.images, "notes.txt"), "w") as f:
+            f.write("not an image")
+        self.output = os.path.join(self.root, "results.ndjson")
+
+    def run_command(self, source):
+        prediction = SimpleNamespace(id="p1", status="succeeded", error=None,
+                                     output=model_output(analysis={"health_score": 60}))
+        create = mock.AsyncMock(return_value=prediction)
+        with mock.patch.object(predictions, "async_upload_file", mock.AsyncMock(return_value="https://files/p1")), \
+                mock.patch.object(predictions, "create_prediction", create), \
+                mock.patch.object(predictions, "close_clients", mock.AsyncMock(wraps=predictions.close_clients)) as close:
+            call_command("analyze_catalog", source, output=self.output, concurrency=2, stderr=io.StringIO())
+        # The run's pooled Replicate connections don't outlive its event loop
+        close.assert_awaited_once()
+        with open(self.output) as f:
+            return [json.loads(line) for line in f if line.endswith("}\n")], create
+
+    def test_streams_ndjson_and_resumes(self):
+        records, create = self.run_command(self.images)
+        self.assertCountEqual([r["id"] for r in records], ["a.jpg", "b.png", os.path.join("cereal", "c.jpg")])
+        self.assertTrue(all(r["status"] == "ok" for r in records))
+        self.assertEqual(records[0]["result"]["analysis"], {"health_score": 60})
+        self.assertEqual(create.await_count, 3)
+
+        # Simulate a crash halfway through writing a line, then add an image
+        with open(self.output, "a") as f:
+            f.write('{"id": "d.jpg", "sta')
+        with open(os.path.join(self.images, "d.jpg"), "wb") as f:
+            f.write(make_label_image(size=(500, 300)))
+
+        records, create = self.run_command(self.images)
+        self.assertEqual(create.await_count, 1)
+        self.assertEqual(records[-1]["id"], "d.jpg")
+        self.assertEqual(len(records), 4)
+
+    def test_reads_archives_and_manifests(self):
+        archive = os.path.join(self.root, "catalog.zip")
+        with zipfile.ZipFile(archive, "w") as f:
+            f.write(os.path.join(self.images, "a.jpg"), "front/a.jpg")
+            f.writestr("readme.md", "skip me")
+        self.assertEqual([item.id for item in catalog.iter_catalog(archive)], ["front/a.jpg"])
+
+        archive = os.path.join(self.root, "catalog.tar.gz")
+        with tarfile.open(archive, "w:gz") as f:
+            f.add(os.path.join(self.images, "b.png"), "b.png")
+        items = list(catalog.iter_catalog(archive))
+        self.assertEqual([item.id for item in items], ["b.png"])
+        self.assertTrue(items[0].data.startswith(b"\xff\xd8"))
+
+        manifest = os.path.join(self.root, "manifest.jsonl")
+        with open(manifest, "w") as f:
+            f.write('{"id": "sku-1", "path": "images/a.jpg"}\nimages/b.png\nimages/missing.jpg\n')
+        items = list(catalog.iter_catalog(manifest))
+        self.assertEqual([item.id for item in items], ["sku-1", "images/b.png", "images/missing.jpg"])
+        self.assertEqual(items[1].data[:2], b"\xff\xd8")
+        self.assertIn("No such file", items[2].error)
+
+    def test_malformed_manifest_lines_become_errors(self):
+        manifest = os.path.join(self.root, "manifest.jsonl")
+        with open(manifest, "w") as f:
+            f.write('{"id": "sku-1", "path": "images/a.jpg"\n{"id": "sku-2"}\n{"path": null}\n{"path": 3}\nimages/b.png\n')
+        items = list(catalog.iter_catalog(manifest))
+        self.assertEqual([item.id for item in items], [f"manifest.jsonl:{n}" for n in range(1, 5)] + ["images/b.png"])
+        self.assertTrue(all(item.error.startswith("Invalid manifest line") for item in items[:4]))
+        self.assertIsNone(items[-1].error)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate('3/m'), (3, 3 / 60))
+        self.assertEqual(ratelimit.parse_rate('10/5s'), (10, 2))
+
+    def test_bucket_empties_and_reports_retry_after(self):
+        store = ratelimit.InMemoryBucketStore()
+        capacity, refill = ratelimit.parse_rate('3/m')
+        results = [store.take('client', refill, capacity) for _ in range(4)]
+        self.assertEqual([allowed for allowed, _ in results], [True, True, True, False])
+        self.assertAlmostEqual(results[-1][1], 20, delta=0.5)
+
+
+@override_settings(UPLOAD_EAGER_PREPARE=False, UPLOAD_RATE_LIMIT='2/m')
+class UploadRateLimitTests(TestCase):
+    def setUp(self):
+        ratelimit._store = ratelimit.InMemoryBucketStore()
+
+    def upload(self):
+        return self.client.post('/upload-image/', {
+            'image': SimpleUploadedFile('label.jpg', make_label_image(), content_type='image/jpeg'),
+        })
+
+    def test_limits_per_client_without_touching_the_session_table(self):
+        from django.contrib.sessions.models import Session
+
+        self.client.get('/')
+        responses = [self.upload() for _ in range(3)]
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429])
+        self.assertGreater(responses[-1].json()['retry_after'], 0)
+        self.assertEqual(Session.objects.count(), 0)
+
+        # A different browser gets its own bucket
+        other = self.client_class()
+        other.get('/')
+        self.client = other
+        self.assertEqual(self.upload().status_code, 200)
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        metrics.flush()
+        cache.clear()
+
+    def test_renders_histograms_counters_and_gauges(self):
+        metrics.STAGE_SECONDS.observe(0.003, stage="parse")
+        metrics.STAGE_SECONDS.observe(0.2, stage="parse")
+        metrics.STAGE_SECONDS.observe(500, stage="parse")
+        with metrics.PREDICTIONS_IN_FLIGHT.track():
+            pass
+        metrics.ANALYSES.inc(outcome="parse_failed")
+
+        with metrics.PREDICTIONS_IN_FLIGHT.track():
+            lines = self.client.get('/metrics').content.decode().splitlines()
+        self.assertIn('truview_stage_seconds_bucket{stage="parse",le="0.005"} 1', lines)
+        self.assertIn('truview_stage_seconds_bucket{stage="parse",le="0.25"} 2', lines)
+        self.assertIn('truview_stage_seconds_bucket{stage="parse",le="120"} 2', lines)
+        self.assertIn('truview_stage_seconds_bucket{stage="parse",le="+Inf"} 3', lines)
+        self.assertIn('truview_stage_seconds_count{stage="parse"} 3', lines)
+        self.assertIn('truview_stage_seconds_sum{stage="parse"} 500.203', lines)
+        self.assertIn('truview_stage_seconds_count{stage="generation"} 0', lines)
+        self.assertIn('truview_predictions_in_flight 1', lines)
+        self.assertIn('truview_analyses_total{outcome="parse_failed"} 1', lines)
+        self.assertIn('# TYPE truview_stage_seconds histogram', lines)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_protects_the_endpoint(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    async def test_outcome_and_total_counted_once_per_analysis(self):
+        await results.start("m1")
+        await results.record_message("m1", {"section": "analysis", "data": {}})
+        await results.record_message("m1", {"error": metrics.PARSE_ERROR})
+        # A late message for an analysis that already ended
+        await results.record_message("m1", {"cancelled": True})
+
+        lines = metrics.render().splitlines()
+        self.assertIn('truview_analyses_total{outcome="parse_failed"} 1', lines)
+        self.assertIn('truview_analyses_total{outcome="cancelled"} 0', lines)
+        self.assertIn('truview_stage_seconds_count{stage="total"} 1', lines)
+
+    def test_preprocessing_totals(self):
+        upload = uploads.Upload("u1", b"", "image/jpeg")
+        uploads._record_preprocess(upload, {"bytes_in": 5000, "bytes_out": 1200, "cpu_ms": 12.4, "cropped": False})
+
+        lines = metrics.render().splitlines()
+        self.assertIn('truview_preprocessed_images_total 1', lines)
+        self.assertIn('truview_preprocess_bytes_total{direction="in"} 5000', lines)
+        self.assertIn('truview_preprocess_bytes_total{direction="out"} 1200', lines)
+        self.assertIn('truview_preprocess_cpu_milliseconds_total 12', lines)
+
+    def test_gauges_of_a_process_that_stopped_flushing_expire(self):
+        with metrics.OPEN_SOCKETS.track():
+            metrics.flush()
+            cache.set(metrics.PROCESSES_KEY, cache.get(metrics.PROCESSES_KEY) + ["dead:1"], None)
+            cache.set(metrics.GAUGES_KEY.format("dead:1"), {metrics.OPEN_SOCKETS._key(None): 5}, 0.05)
+            self.assertIn('truview_open_sockets 6', metrics.render().splitlines())
+            time.sleep(0.1)
+            self.assertIn('truview_open_sockets 1', metrics.render().splitlines())
+        self.assertNotIn("dead:1", cache.get(metrics.PROCESSES_KEY))
+
+    def test_prediction_time_split_into_stages(self):
+        prediction = SimpleNamespace(
+            created_at="2024-01-01T00:00:00.000000Z",
+            started_at="2024-01-01T00:00:03.500000Z",
+            completed_at="2024-01-01T00:00:10.123456789Z",
+        )
+        token = log.request_id.set("r42")
+        try:
+            with self.assertLogs('myapp.metrics', 'INFO') as logs:
+                metrics.observe_prediction(prediction)
+            # Every line names the request it belongs to
+            record = logs.records[0]
+            self.assertTrue(log.RequestIdFilter().filter(record))
+            self.assertEqual(record.request_id, "r42")
+        finally:
+            log.request_id.reset(token)
+
+        lines = metrics.render().splitlines()
+        self.assertIn('truview_stage_seconds_sum{stage="replicate_queue"} 3.5', lines)
+        self.assertIn('truview_stage_seconds_bucket{stage="generation",le="10"} 1', lines)
+        self.assertIn('truview_stage_seconds_count{stage="poll_lag"} 1', lines)
+
+
+class FakeReplicateTests(SimpleTestCase):
+    def run_with_fake(self, fake, coroutine):
+        async def run():
+            try:
+                return await coroutine()
+            finally:
+                await predictions.close_clients()
+
+        with fake, override_settings(REPLICATE_API_BASE_URL=fake.url, REPLICATE_API_TOKEN='fake'):
+            return async_to_sync(run)()
+
+    @override_settings(PREDICTION_POLL_INITIAL=0.01, PREDICTION_POLL_MAX=0.02)
+    def test_streams_a_valid_analysis_through_the_real_client(self):
+        fake = FakeReplicate(latency=0.05, jitter=0, queue_delay=0)
+        chunks = []
+
+        async def on_text(text):
+            chunks.append(text)
+
+        async def analyze():
+            file_url = await predictions.async_upload_file(make_label_image(), "label.jpg")
+            prediction = await predictions.create_prediction(prompts.build_input(file_url), stream=True)
+            await predictions.stream_output(prediction, on_text)
+            return await predictions.wait_for_prediction(prediction)
+
+        prediction = self.run_with_fake(fake, analyze)
+
+        self.assertEqual(prediction.status, "succeeded")
+        self.assertEqual("".join(chunks), "".join(prediction.output))
+        result, invalid = schema.validate_sections(schema.extract_json(prediction.output), list(prompts.SCHEMA))
+        self.assertEqual(invalid, [])
+        self.assertEqual(fake.stats["files"], 1)
+        self.assertEqual(fake.stats["streams"], 1)
+
+    def test_failures_cancels_and_signed_webhooks(self):
+        deliveries = []
+
+        class Receiver(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                deliveries.append((self.headers, body))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        receiver = ThreadingHTTPServer(("127.0.0.1", 0), Receiver)
+        threading.Thread(target=receiver.serve_forever, daemon=True).start()
+        self.addCleanup(receiver.server_close)
+        self.addCleanup(receiver.shutdown)
+
+        fake = FakeReplicate(latency=0.05, jitter=0, queue_delay=0, failure_rate=1, webhook_secret=WEBHOOK_SECRET)
+        webhook = f"http://127.0.0.1:{receiver.server_address[1]}/replicate-webhook/"
+
+        async def run():
+            client = predictions.get_async_client()
+            failing = await client.predictions.async_create(model=prompts.MODEL, input={}, webhook=webhook)
+            fake.latency = 30
+            slow = await client.predictions.async_create(model=prompts.MODEL, input={})
+            await predictions.cancel_prediction(slow.id)
+            for _ in range(100):
+                if deliveries:
+                    break
+                await asyncio.sleep(0.02)
+            return await client.predictions.async_get(failing.id), await client.predictions.async_get(slow.id)
+
+        failing, slow = self.run_with_fake(fake, run)
+
+        self.assertEqual((failing.status, slow.status), ("failed", "canceled"))
+        headers, body = deliveries[0]
+        self.assertEqual(json.loads(body)["status"], "failed")
+        with override_settings(REPLICATE_WEBHOOK_SECRET=WEBHOOK_SECRET):
+            self.assertTrue(predictions.verify_webhook(headers, body))
+
+
+@override_settings(PREDICTION_POLL_INITIAL=0.01, PREDICTION_POLL_MAX=0.05, ANALYSIS_RESUME_GRACE=0)
+class LoadTestCommandTests(TransactionTestCase):
+    def test_runs_offline_and_reports_stages_and_leaks(self):
+        out = io.StringIO()
+        call_command(
+            'loadtest', users=3, iterations=2, latency=0.05, jitter=0, queue_delay=0, idle_sockets=5,
+            json=True, fail_on_leak=True, stdout=out,
+        )
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['outcomes'], {'success': 6})
+        self.assertEqual(report['client_stages']['result']['count'], 6)
+        self.assertEqual(report['server_stages']['total']['count'], 6)
+        self.assertIn('generation', report['server_stages'])
+        self.assertGreater(report['memory_per_socket_bytes'], 0)
+        self.assertEqual(report['leaks']['uploads'], 0)
+        # Three warm-up analyses, then the six measured ones
+        self.assertEqual(report['replicate']['files'], 9)
+
+
+class StaticAssetTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.root)
+        storages = {
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'staticfiles': {'BACKEND': 'myapp.assets.CompressedManifestStaticFilesStorage'},
+        }
+        with override_settings(STATIC_ROOT=cls.root, STORAGES=storages):
+            call_command('collectstatic', interactive=False, verbosity=0)
+        with open(os.path.join(cls.root, 'staticfiles.json')) as f:
+            cls.manifest = json.load(f)['paths']
+
+    def get(self, path, **headers):
+        app = assets.PrecompressedStaticFiles(self.fail, root=self.root, static_url='static/')
+        return async_to_sync(asgi_get)(app, path, headers)
+
+    def test_build_writes_minified_hashed_and_precompressed_files(self):
+        hashed = self.manifest['js/script.js']
+        self.assertRegex(hashed, r'^js/script\.[0-9a-f]{12}\.js$')
+        with open(os.path.join(self.root, hashed), 'rb') as f:
+            minified = f.read()
+        with open(os.path.join(self.root, 'js/script.js'), 'rb') as f:
+            self.assertLess(len(minified), len(f.read()))
+        with open(os.path.join(self.root, hashed + '.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), minified)
+        with open(os.path.join(self.root, hashed + '.br'), 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()), minified)
+        # Already compressed images get no variants
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.manifest['favicons/favicon-16x16.png'] + '.gz')))
+
+    def test_serves_the_accepted_variant_with_immutable_caching(self):
+        path = '/static/' + self.manifest['css/style.css']
+
+        status, headers, body = self.get(path, accept_encoding='gzip, deflate, br')
+        self.assertEqual((status, headers['content-encoding']), (200, 'br'))
+        self.assertEqual(headers['cache-control'], assets.IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(headers['vary'], 'Accept-Encoding')
+        self.assertTrue(headers['content-type'].startswith('text/css'))
+        css = brotli.decompress(body)
+
+        status, headers, body = self.get(path, accept_encoding='gzip, br;q=0')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), css)
+
+        status, headers, body = self.get(path)
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual(body, css)
+
+        # Each variant has its own ETag
+        status, _, _ = self.get(path, accept_encoding='br', if_none_match=headers['etag'])
+        self.assertEqual(status, 200)
+        br_etag = self.get(path, accept_encoding='br')[1]['etag']
+        status, _, body = self.get(path, accept_encoding='br', if_none_match=br_etag)
+        self.assertEqual((status, body), (304, b''))
+
+    def test_unhashed_names_get_short_caching_and_unknown_paths_fall_through(self):
+        status, headers, _ = self.get('/static/js/script.js')
+        self.assertEqual((status, headers['cache-control']), (200, assets.DEFAULT_CACHE_CONTROL))
+
+        passed_on = []
+
+        async def application(scope, receive, send):
+            passed_on.append(scope['path'])
+
+        app = assets.PrecompressedStaticFiles(application, root=self.root, static_url='static/')
+        for path in ('/static/../manage.py', '/static/js/missing.js', '/upload-image/'):
+            async_to_sync(app)({'type': 'http', 'path': path, 'method': 'GET', 'headers': []}, None, None)
+        self.assertEqual(passed_on, ['/static/../manage.py', '/static/js/missing.js', '/upload-image/'])
+
+
+async def asgi_get(app, path, headers):
+    # Status, headers and body of a GET through an ASGI app
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': path,
+        'headers': [(key.replace('_', '-').encode(), value.encode()) for key, value in headers.items()],
+    }
+    await app(scope, None, send)
+    response_headers = {key.decode(): value.decode() for key, value in messages[0]['headers']}
+    return messages[0]['status'], response_headers, b''.join(m.get('body', b'') for m in messages[1:])
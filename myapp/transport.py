@@ -0,0 +1,101 @@
+import asyncio
+import email.utils
+import importlib.util
+import random
+import time
+
+import httpx
+from django.conf import settings
+
+# Safe to retry whatever the status, the request has no side effects or can be repeated
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+# A POST (creating a prediction or a file) is only retried when the server
+# says it didn't act on it, otherwise a retry could start a second prediction
+POST_RETRY_STATUSES = frozenset([429, 503])
+
+
+def is_retryable(method, status_code):
+    if method in IDEMPOTENT_METHODS:
+        return status_code == 429 or status_code >= 500
+    return status_code in POST_RETRY_STATUSES
+
+
+def retry_after(headers):
+    """Seconds the server asked us to wait, or None."""
+    value = (headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """Retries 429 and 5xx responses with exponential backoff and full jitter.
+
+    Full jitter (a random wait between zero and the backoff) keeps a burst of
+    clients that were throttled together from retrying together. A
+    Retry-After header from the server takes precedence, capped at `max_backoff`.
+    """
+
+    def __init__(self, transport, attempts, backoff, max_backoff):
+        self.transport = transport
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt, headers):
+        wait = retry_after(headers)
+        if wait is None:
+            wait = random.uniform(0, self.backoff * 2 ** attempt)
+        return min(wait, self.max_backoff)
+
+    async def handle_async_request(self, request):
+        for attempt in range(self.attempts):
+            response = await self.transport.handle_async_request(request)
+            last_attempt = attempt == self.attempts - 1
+            if last_attempt or not is_retryable(request.method, response.status_code):
+                return response
+
+            await response.aclose()
+            await asyncio.sleep(self.delay(attempt, response.headers))
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def http2_available():
+    # HTTP/2 needs the optional h2 package (`pip install httpx[http2]`)
+    return importlib.util.find_spec("h2") is not None
+
+
+def build_async_client(**kwargs):
+    """Pooled httpx.AsyncClient for the Replicate API, configured from settings."""
+    transport = httpx.AsyncHTTPTransport(
+        http2=settings.REPLICATE_HTTP2 and http2_available(),
+        limits=httpx.Limits(
+            max_connections=settings.REPLICATE_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.REPLICATE_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=settings.REPLICATE_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        # Connection failures never reached the server, retrying them is always safe
+        retries=settings.REPLICATE_HTTP_CONNECT_RETRIES,
+    )
+    return httpx.AsyncClient(
+        transport=RetryTransport(
+            transport,
+            attempts=settings.REPLICATE_HTTP_RETRY_ATTEMPTS,
+            backoff=settings.REPLICATE_HTTP_RETRY_BACKOFF,
+            max_backoff=settings.REPLICATE_HTTP_RETRY_MAX_BACKOFF,
+        ),
+        timeout=httpx.Timeout(
+            settings.REPLICATE_HTTP_TIMEOUT,
+            connect=settings.REPLICATE_HTTP_CONNECT_TIMEOUT,
+            pool=settings.REPLICATE_HTTP_POOL_TIMEOUT,
+        ),
+        **kwargs,
+    )
@@ -0,0 +1,81 @@
+from django.conf import settings
+
+from . import prompts
+
+# Sent to the client when a photo is turned away, by reason
+REJECTIONS = {
+    "blank": "The photo is too dark or too plain to show a label, please take it again",
+    "blurry": "The photo is too blurry to read, please take it again in focus",
+    "not_label": "This doesn't look like a food label, please photograph the product's packaging",
+    "unreadable": "The label can't be read, please take the photo closer and in focus",
+    "no_panels": "Neither the nutrition facts nor the ingredients are visible, please photograph the back of the pack",
+}
+
+def rejection(reason):
+    return {"error": REJECTIONS[reason], "rejected": reason}
+
+
+def check_photo(stats):
+    """Reason to turn a photo away from its preprocessing stats alone, or None.
+
+    Only rejects what is clearly unusable; photos that weren't measured
+    (preprocessing disabled or failed) always pass.
+    """
+    if not stats or "sharpness" not in stats:
+        return None
+    if stats["contrast"] < settings.ANALYSIS_TRIAGE_MIN_CONTRAST:
+        return "blank"
+    if stats["sharpness"] < settings.ANALYSIS_TRIAGE_MIN_SHARPNESS:
+        return "blurry"
+    return None
+
+
+def visible_panels(verdict):
+    return [panel for panel in prompts.PANEL_SECTIONS if panel in verdict.panels]
+
+
+def judge(verdict):
+    """Reason to turn a photo away after triage, None if it is worth analyzing."""
+    if not verdict.food_label:
+        return "not_label"
+    if not verdict.legible:
+        return "unreadable"
+    if not visible_panels(verdict):
+        return "no_panels"
+    return None
+
+
+def full_plan():
+    # Every group at its full budget, for when triage is off or has no answer
+    return list(prompts.ANALYSIS_GROUPS), []
+
+
+def plan(verdict):
+    """The analysis groups to run for an accepted verdict, and the sections left out.
+
+    Sections that need a panel the photo doesn't show are skipped, and groups
+    left without sections aren't run. A group's budget shrinks with the
+    sections it keeps, and for per-ingredient groups with the ingredients
+    actually listed. Output cut short by a tight budget is picked up by the
+    repair prediction like any other invalid section.
+    """
+    panels = visible_panels(verdict)
+    skipped = [
+        section
+        for panel, sections in prompts.PANEL_SECTIONS.items() if panel not in panels
+        for section in sections
+    ]
+
+    groups = []
+    for group in prompts.ANALYSIS_GROUPS:
+        sections = [section for section in group["sections"] if section not in skipped]
+        if not sections:
+            continue
+        max_tokens = group["max_tokens"] * len(sections) // len(group["sections"])
+        if group.get("tokens_per_ingredient") and verdict.ingredient_count:
+            max_tokens = min(
+                max_tokens,
+                prompts.BASE_INGREDIENT_TOKENS + group["tokens_per_ingredient"] * verdict.ingredient_count,
+            )
+        groups.append({**group, "sections": sections, "max_tokens": max(prompts.MIN_GROUP_TOKENS, max_tokens)})
+    return groups, skipped
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics, predictions, preprocessing
+
+logger = logging.getLogger(__name__)
+
+# Eager Replicate uploads started from the upload view
+_prepare_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="upload-prepare")
+
+# How long and how often a socket on another process checks whether the eager
+# upload of a shared image has finished before uploading the image itself
+SHARED_PREPARE_WAIT = 30  # Seconds
+SHARED_PREPARE_POLL = 0.1  # Seconds
+
+
+class UploadStoreFull(Exception):
+    pass
+
+
+class Upload:
+    """An uploaded image held in memory until the consumer picks it up."""
+
+    def __init__(self, upload_id, data, content_type):
+        self.id = upload_id
+        self.data = data
+        self.content_type = content_type
+        self.created_at = time.monotonic()
+        # Future resolving to the Replicate file URL once the eager upload finishes
+        self.prepared = None
+        self.preprocess_stats = None
+
+    @property
+    def view(self):
+        return memoryview(self.data)
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def filename(self):
+        return f"{self.id}.jpg"
+
+
+class UploadStore:
+    """Per-process blob store for uploads, with a TTL and a byte quota.
+
+    Uploads never touch the disk. Entries the consumer never claims (the
+    client went away before opening its socket) are dropped by a background
+    sweeper once they expire.
+    """
+
+    def __init__(self, max_bytes, ttl, sweep_interval):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.uploads = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+    def put(self, data, content_type=None):
+        with self.lock:
+            if self.total_bytes + len(data) > self.max_bytes:
+                self._sweep_locked()
+                if self.total_bytes + len(data) > self.max_bytes:
+                    raise UploadStoreFull()
+
+            upload = Upload(uuid.uuid4().hex, data, content_type)
+            self.uploads[upload.id] = upload
+            self.total_bytes += upload.size
+
+        self._ensure_sweeper()
+        return upload
+
+    def get(self, upload_id):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is not None and self._expired(upload, time.monotonic()):
+                self._remove_locked(upload_id)
+                return None
+            return upload
+
+    def discard(self, upload_id):
+        with self.lock:
+            self._remove_locked(upload_id)
+
+    def sweep(self):
+        with self.lock:
+            return self._sweep_locked()
+
+    def _expired(self, upload, now):
+        return now - upload.created_at > self.ttl
+
+    def _remove_locked(self, upload_id):
+        upload = self.uploads.pop(upload_id, None)
+        if upload is not None:
+            self.total_bytes -= upload.size
+            if upload.prepared is not None:
+                upload.prepared.cancel()
+        return upload
+
+    def _sweep_locked(self):
+        now = time.monotonic()
+        expired = [upload_id for upload_id, upload in self.uploads.items() if self._expired(upload, now)]
+        for upload_id in expired:
+            self._remove_locked(upload_id)
+        return len(expired)
+
+    def _ensure_sweeper(self):
+        if self.sweeper is not None and self.sweeper.is_alive():
+            return
+        with self.lock:
+            if self.sweeper is None or not self.sweeper.is_alive():
+                self.sweeper = threading.Thread(target=self._run_sweeper, name="upload-sweeper", daemon=True)
+                self.sweeper.start()
+
+    def _run_sweeper(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            removed = self.sweep()
+            if removed:
+                logger.info("Upload sweeper dropped %d abandoned uploads", removed)
+
+
+def _preprocess_options():
+    return {
+        'max_edge': settings.PREPROCESS_MAX_EDGE,
+        'quality': settings.PREPROCESS_JPEG_QUALITY,
+        'crop_label': settings.PREPROCESS_CROP_LABEL,
+        'workers': settings.PREPROCESS_WORKERS,
+    }
+
+
+def _record_preprocess(upload, stats):
+    upload.preprocess_stats = stats
+    saved = stats['bytes_in'] - stats['bytes_out']
+    metrics.PREPROCESSED_IMAGES.inc()
+    metrics.PREPROCESS_BYTES.inc(stats['bytes_in'], direction="in")
+    metrics.PREPROCESS_BYTES.inc(stats['bytes_out'], direction="out")
+    metrics.PREPROCESS_CPU_MS.inc(round(stats['cpu_ms']))
+    logger.info(
+        "Preprocessed %s: %d -> %d bytes (%d saved), %.0f ms CPU, cropped=%s",
+        upload.id, stats['bytes_in'], stats['bytes_out'], saved, stats['cpu_ms'], stats['cropped'],
+    )
+
+
+def prepare(upload):
+    """Preprocess the image and upload it to Replicate, returning the file URL.
+
+    Blocking: run it in a thread. The image work itself runs in the
+    preprocessing process pool so it never holds the GIL of the web process.
+    """
+    data = upload.data
+    if settings.PREPROCESS_ENABLED:
+        try:
+            with metrics.span("preprocess"):
+                data, stats = preprocessing.run(upload.data, **_preprocess_options())
+        except Exception as e:
+            logger.warning("Preprocessing failed, uploading the original image: %s", e)
+        else:
+            _record_preprocess(upload, stats)
+
+    return predictions.upload_file(data, upload.filename)
+
+
+async def async_prepare(upload):
+    """prepare() for the event loop: no threads, the upload uses the pooled async client."""
+    data = upload.data
+    if settings.PREPROCESS_ENABLED:
+        try:
+            with metrics.span("preprocess"):
+                data, stats = await preprocessing.run_async(upload.data, **_preprocess_options())
+        except Exception as e:
+            logger.warning("Preprocessing failed, uploading the original image: %s", e)
+        else:
+            _record_preprocess(upload, stats)
+
+    return await predictions.async_upload_file(data, upload.filename)
+
+
+def start_prepare(upload):
+    # Preprocess and upload to Replicate while the client is still opening its WebSocket
+    upload.prepared = _prepare_executor.submit(prepare_shared if settings.UPLOAD_SHARED else prepare, upload)
+
+
+def _shared_key(upload_id, suffix=""):
+    return f"upload:{upload_id}{suffix}"
+
+
+def share(upload):
+    """Put a new upload in the shared cache, for a WebSocket that lands on another process.
+
+    Without an eager upload to run here, the local copy isn't needed at all.
+    """
+    cache.set(
+        _shared_key(upload.id),
+        {"data": upload.data, "content_type": upload.content_type, "eager": settings.UPLOAD_EAGER_PREPARE},
+        settings.UPLOAD_STORE_TTL,
+    )
+    if not settings.UPLOAD_EAGER_PREPARE:
+        store.discard(upload.id)
+
+
+def prepare_shared(upload):
+    # prepare() for a shared upload: its outcome goes to the shared cache for
+    # claim() and the local copy is dropped, whichever process the socket is on
+    file_url = None
+    try:
+        file_url = prepare(upload)
+        return file_url
+    finally:
+        cache.set(
+            _shared_key(upload.id, ":prepared"),
+            {"file_url": file_url, "preprocess_stats": upload.preprocess_stats},
+            settings.UPLOAD_STORE_TTL,
+        )
+        store.discard(upload.id)
+
+
+async def claim(upload_id):
+    """The upload with this id, from this process or, with UPLOAD_SHARED, any other; None if expired.
+
+    A shared upload whose eager upload is still running elsewhere waits for
+    its Replicate URL, so the image isn't uploaded twice.
+    """
+    upload = store.get(upload_id)
+    if upload is not None or not settings.UPLOAD_SHARED:
+        return upload
+
+    shared = await cache.aget(_shared_key(upload_id))
+    if shared is None:
+        return None
+    upload = Upload(upload_id, shared["data"], shared["content_type"])
+    if not shared["eager"]:
+        return upload
+
+    deadline = time.monotonic() + SHARED_PREPARE_WAIT
+    while (prepared := await cache.aget(_shared_key(upload_id, ":prepared"))) is None:
+        if time.monotonic() > deadline:
+            return upload
+        await asyncio.sleep(SHARED_PREPARE_POLL)
+    if prepared["file_url"]:
+        upload.prepared = Future()
+        upload.prepared.set_result(prepared["file_url"])
+        upload.preprocess_stats = prepared["preprocess_stats"]
+    return upload
+
+
+async def release(upload):
+    # The analysis no longer needs the image, only its Replicate URL
+    store.discard(upload.id)
+    if settings.UPLOAD_SHARED:
+        await cache.adelete_many([_shared_key(upload.id), _shared_key(upload.id, ":prepared")])
+
+
+store = UploadStore(
+    max_bytes=settings.UPLOAD_STORE_MAX_BYTES,
+    ttl=settings.UPLOAD_STORE_TTL,
+    sweep_interval=settings.UPLOAD_STORE_SWEEP_INTERVAL,
+)
@@ -4,4 +4,7 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('upload-image/', views.upload_image, name='upload_image'),
+    path('replicate-webhook/', views.replicate_webhook, name='replicate_webhook'),
+    path('analysis/<str:request_id>/', views.analysis_status, name='analysis_status'),
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
\ No newline at end of file
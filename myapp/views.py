@@ -1,18 +1,33 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.conf import settings
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.csrf import csrf_exempt
-from django_ratelimit.decorators import ratelimit
-import os
+from django.views.decorators.http import require_GET, require_POST
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+import hmac
+import re
+import json
 import uuid
 from django.core.cache import cache
 import time
 
+from . import clients, metrics, predictions, results, uploads
+from .clients import CLIENT_COOKIE, CLIENT_COOKIE_SALT, CLIENT_COOKIE_MAX_AGE
+from .ratelimit import rate_limit
+
 MAX_FILE_SIZE = 8 * 1024 * 1024  # 8 MB
 
+
 def index(request):
-    return render(request, 'index.html')
+    response = render(request, 'index.html')
+    if not request.get_signed_cookie(CLIENT_COOKIE, default=None, salt=CLIENT_COOKIE_SALT):
+        response.set_signed_cookie(
+            CLIENT_COOKIE, uuid.uuid4().hex, salt=CLIENT_COOKIE_SALT,
+            max_age=CLIENT_COOKIE_MAX_AGE, httponly=True, samesite='Lax'
+        )
+    return response
 
 # Function to extract real client IP
 def get_client_ip(_, request):
@@ -30,27 +45,24 @@ def get_client_ip(_, request):
 def get_rate_limit_key(_, request):
     ip = get_client_ip(_, request)
     
-    # Try to get session key if available
-    session_key = ''
-    if hasattr(request, 'session') and request.session.session_key:
-        session_key = request.session.session_key
-    else:
-        # Create a session if it doesn't exist
-        request.session.save()
-        session_key = request.session.session_key
+    # The client cookie is set by the index page; clients without one share their IP's bucket
+    client_id = clients.from_request(request)
     
-    # Combine IP and session key for a more specific rate limit key
-    return f"upload_limit:{ip}:{session_key}"
+    # Combine IP and client id for a more specific rate limit key
+    return f"upload_limit:{ip}:{client_id}"
+
+def get_upload_rate(_, request):
+    return settings.UPLOAD_RATE_LIMIT
 
 @csrf_exempt
-@ratelimit(key=get_rate_limit_key, rate='3/m', block=False)  # 3 request per minute
+@rate_limit(key=get_rate_limit_key, rate=get_upload_rate)  # 3 requests per minute by default
 def upload_image(request):
     # Check if rate limit is exceeded
     if getattr(request, 'limited', False):
         return JsonResponse({
             'success': False,
             'error': 'Rate limit exceeded. Please wait before trying again.',
-            'retry_after': 60  # Default retry time
+            'retry_after': request.retry_after
         }, status=429)
     
     if request.method == 'POST' and request.FILES.get('image'):
@@ -59,15 +71,83 @@ def upload_image(request):
         if image.size > MAX_FILE_SIZE:
             return JsonResponse({'success': False, 'error': 'File size exceeds limit'})
 
-        filename = f"{uuid.uuid4()}.jpg"
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        path = os.path.join(temp_dir, filename)
+        try:
+            # Keep the image in memory for the consumer, no temp file
+            with metrics.span("upload_read"):
+                upload = uploads.store.put(image.read(), image.content_type)
+        except uploads.UploadStoreFull:
+            return JsonResponse({
+                'success': False,
+                'error': 'Server is busy. Please try again shortly.',
+                'retry_after': 10
+            }, status=503)
 
-        with open(path, 'wb+') as f:
-            for chunk in image.chunks():
-                f.write(chunk)
+        if settings.UPLOAD_SHARED:
+            uploads.share(upload)
+        if settings.UPLOAD_EAGER_PREPARE:
+            uploads.start_prepare(upload)
 
-        return JsonResponse({'success': True, 'filename': filename})
+        return JsonResponse({'success': True, 'upload_id': upload.id})
 
     return JsonResponse({'success': False, 'error': 'Invalid request'})
+
+
+@csrf_exempt
+@require_POST
+def replicate_webhook(request):
+    # Replicate calls this when a prediction finishes; wake the consumer waiting on it
+    if not predictions.verify_webhook(request.headers, request.body):
+        return HttpResponseForbidden()
+
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    prediction_id = str(payload.get('id', ''))
+    status = payload.get('status')
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,80}', prediction_id):
+        return HttpResponseBadRequest()
+
+    channel_layer = get_channel_layer()
+    if status in predictions.TERMINAL_STATUSES and channel_layer is not None:
+        async_to_sync(channel_layer.group_send)(predictions.group_name(prediction_id), {
+            'type': 'prediction.completed',
+            'prediction_id': prediction_id,
+            'status': status,
+        })
+
+    return JsonResponse({'success': True})
+
+
+@require_GET
+async def analysis_status(request, request_id):
+    # Plain HTTP fallback for clients that can't get a WebSocket back. Only
+    # the browser that started the analysis can read it.
+    client_id = clients.from_request(request)
+    record = None
+    if client_id and results.REQUEST_ID_PATTERN.match(request_id):
+        record = await results.get(results.analysis_key(client_id, request_id))
+    if record is None:
+        return JsonResponse({'error': 'Analysis not found or expired'}, status=404)
+
+    response = {
+        'id': request_id,
+        'status': record['status'],
+        'sections': record['sections'],
+        **record.get('final', {}),
+    }
+    return JsonResponse(response)
+
+
+@require_GET
+def prometheus_metrics(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404()
+
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponseForbidden()
+
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -36,6 +36,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const resultContent = document.getElementById('result-content');
     const submitButton = document.getElementById('submit-button');
     const progressBar = document.querySelector('.progress-bar');
+    const queueStatus = document.getElementById('queue-status');
 
     const cameraBtn = document.getElementById('camera-btn');
     const cameraView = document.getElementById('camera-view');
@@ -52,6 +53,12 @@ document.addEventListener('DOMContentLoaded', () => {
         
     let socket;
     let loadingInterval;
+    let partialResult = {}; // Sections streamed so far for the current analysis
+    let currentRequestId = null; // Messages for older analyses are ignored
+    let analysisInFlight = false; // Resume the analysis if the socket drops meanwhile
+    let reconnectAttempts = 0;
+    let pollTimer;
+    const MAX_RECONNECT_ATTEMPTS = 5; // Then fall back to polling over HTTP
     let timeLeft = 60;
     const ws_scheme = window.location.protocol === "https:" ? "wss" : "ws";
     const ws_route = '/ws/nutrition-analysis/';
@@ -73,6 +80,10 @@ document.addEventListener('DOMContentLoaded', () => {
         };
         
         socket.onerror = () => {
+            // A running analysis is picked up again once we reconnect
+            if (analysisInFlight) {
+                return;
+            }
             showNotification("Connection error. Please try again.", "danger");
             submitButton.disabled = false;
             spinner.style.display = 'none';
@@ -80,9 +91,60 @@ document.addEventListener('DOMContentLoaded', () => {
         
         socket.onclose = () => {
             socket = null;
+            if (analysisInFlight) {
+                scheduleReconnect();
+            }
         };
     }
     
+    // Reconnect with exponential backoff and resume the running analysis
+    function scheduleReconnect() {
+        if (reconnectAttempts >= MAX_RECONNECT_ATTEMPTS) {
+            pollResult();
+            return;
+        }
+        
+        const delay = Math.min(1000 * 2 ** reconnectAttempts, 15000) + Math.random() * 500;
+        reconnectAttempts++;
+        
+        setTimeout(() => {
+            if (!analysisInFlight) {
+                return;
+            }
+            createSocket();
+            socket.addEventListener('open', () => {
+                reconnectAttempts = 0;
+                socket.send(JSON.stringify({ resume: currentRequestId }));
+            }, { once: true });
+        }, delay);
+    }
+    
+    // Last resort when the socket won't come back: ask for the result over HTTP
+    async function pollResult() {
+        clearTimeout(pollTimer);
+        if (!analysisInFlight) {
+            return;
+        }
+        
+        try {
+            const response = await fetch(`/analysis/${currentRequestId}/`);
+            const data = await response.json();
+            
+            if (response.ok && !['done', 'error', 'cancelled'].includes(data.status)) {
+                if (Object.keys(data.sections).length) {
+                    partialResult = data.sections;
+                    displayResult(partialResult, { partial: true });
+                }
+                pollTimer = setTimeout(pollResult, 3000);
+                return;
+            }
+            handleSocketMessage(data);
+        } catch (error) {
+            // Offline, try again shortly
+            pollTimer = setTimeout(pollResult, 3000);
+        }
+    }
+    
     // Initialize WebSocket
     createSocket();
     
@@ -202,8 +264,10 @@ document.addEventListener('DOMContentLoaded', () => {
         submitButton.disabled = true;
         spinner.style.display = 'block';
         resultContainer.style.display = 'none';
+        partialResult = {};
         
         const requestId = generateId();
+        currentRequestId = requestId;
         const formData = new FormData();
         formData.append('image', file);
         formData.append('csrfmiddlewaretoken', getCSRFToken());
@@ -216,11 +280,13 @@ document.addEventListener('DOMContentLoaded', () => {
             
             const data = await response.json();
             
-            if (data.success && data.filename) {
+            if (data.success && data.upload_id) {
                 const payload = {
                     id: requestId,
-                    image_filename: data.filename
+                    upload_id: data.upload_id
                 };
+                analysisInFlight = true;
+                reconnectAttempts = 0;
                 
                 // Send via WebSocket
                 if (socket && socket.readyState === WebSocket.OPEN) {
@@ -277,6 +343,39 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Handle WebSocket messages
     function handleSocketMessage(data) {
+        // Left over from an analysis the user has moved on from
+        if (data.id && data.id !== currentRequestId) {
+            return;
+        }
+        
+        // Back on a new socket: show what was streamed while we were away
+        if (data.resumed) {
+            partialResult = data.sections || {};
+            if (Object.keys(partialResult).length) {
+                displayResult(partialResult, { partial: true });
+            }
+            return;
+        }
+        
+        // Still waiting for a free slot on the server
+        if (data.queue_position) {
+            queueStatus.textContent = `You're #${data.queue_position} in line, about ${data.eta_s}s to go...`;
+            queueStatus.style.display = 'block';
+            return;
+        }
+        
+        // Anything else means the analysis has started or finished
+        if (!data.received) {
+            queueStatus.style.display = 'none';
+        }
+        
+        // Streamed section: render what we have so far and keep waiting
+        if (data.section) {
+            partialResult[data.section] = data.data;
+            displayResult(partialResult, { partial: true });
+            return;
+        }
+        
         clearInterval(loadingInterval);
         
         // Get the progress bar element
@@ -286,6 +385,11 @@ document.addEventListener('DOMContentLoaded', () => {
             progressBar.setAttribute('aria-valuenow', 100);
         }
         
+        if (data.analysis_result || data.error || data.cancelled) {
+            analysisInFlight = false;
+            clearTimeout(pollTimer);
+        }
+        
         if (data.analysis_result) {
             spinner.style.display = 'none';
             displayResult(data.analysis_result);
@@ -370,13 +474,18 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     
     // Display analysis results with enhanced card design
-    function displayResult(result) {
+    function displayResult(result, options = {}) {
         // Safety check for result object
         if (!result) {
             showNotification("No analysis data available", "warning");
             return;
         }
         
+        // Partial results are re-rendered as streamed sections arrive
+        const partial = options.partial === true;
+        const scorePending = partial && !result.analysis;
+        const wasVisible = resultContainer.style.display === 'block';
+        
         resultContainer.style.display = 'block';
         resultContent.innerHTML = '';
         
@@ -392,13 +501,24 @@ document.addEventListener('DOMContentLoaded', () => {
         const additiveImpact = ensureArray(result.additive_impact);
         const environmentalImpact = result.environmental_impact || {};
         
+        // Sections the analysis couldn't fill (degraded) or that need a label
+        // panel the photo doesn't show (skipped) are shown as unavailable, not empty
+        const degraded = ensureArray(result.degraded);
+        const skipped = ensureArray(result.skipped);
+        const isUnavailable = section => degraded.includes(section) || skipped.includes(section);
+        
         // Determine score class and label
-        const healthScore = analysis.health_score || 0;
+        const scoreMissing = !scorePending && typeof analysis.health_score !== 'number';
+        const healthScore = scoreMissing ? 'N/A' : (analysis.health_score || 0);
         let scoreClass = 'score-poor';
         let scoreLabel = 'Poor';
         let takeawayClass = 'takeaway-poor';
         
-        if (healthScore >= 80) {
+        if (scoreMissing) {
+            scoreClass = 'score-unavailable';
+            scoreLabel = 'Unavailable';
+            takeawayClass = 'takeaway-unavailable';
+        } else if (healthScore >= 80) {
             scoreClass = 'score-excellent';
             scoreLabel = 'Excellent';
             takeawayClass = 'takeaway-excellent';
@@ -425,26 +545,38 @@ document.addEventListener('DOMContentLoaded', () => {
                         </div>
                     </div>
                     <div class="health-score-container">
-                        <div class="score-circle ${scoreClass}">${healthScore}</div>
-                        <div class="score-label">Health Score: ${scoreLabel}</div>
+                        <div class="score-circle ${scoreClass}">${scorePending ? '<i class="fas fa-spinner fa-spin"></i>' : healthScore}</div>
+                        <div class="score-label">Health Score: ${scorePending ? 'Analyzing...' : scoreLabel}</div>
                     </div>
                 </div>
                 
                 <!-- Key Takeaways Section -->
                 <div class="key-takeaways ${takeawayClass}">
                     <div class="section-title"><i class="fas fa-lightbulb"></i> Key Takeaways</div>
-                    <p>${analysis.summary || 'No summary available'}</p>
+                    <p>${analysis.summary || (scorePending ? 'Analyzing...' : 'No summary available')}</p>
                 </div>
                 
+                ${generateUnavailableNotice(degraded, skipped)}
+                
                 <!-- Nutrition Highlights Section -->
                 <div class="nutrition-highlights">
                     <div class="section-title"><i class="fas fa-chart-pie"></i> Nutrition Highlights</div>
-                    <div class="nutrition-grid">
-                        ${generateNutritionHighlights(nutritionFacts)}
-                    </div>
+                    ${isUnavailable('nutrition_facts') ? `
+                        <p class="section-unavailable">${unavailableReason('nutrition_facts', skipped)}</p>
+                    ` : `
+                        <div class="nutrition-grid">
+                            ${generateNutritionHighlights(nutritionFacts)}
+                        </div>
+                    `}
                 </div>
                 
                 <!-- Ingredients Section -->
+                ${isUnavailable('ingredients') ? `
+                    <div class="ingredients-section">
+                        <div class="section-title"><i class="fas fa-list-ul"></i> Ingredients</div>
+                        <p class="section-unavailable">${unavailableReason('ingredients', skipped)}</p>
+                    </div>
+                ` : ''}
                 ${result.ingredients && ensureArray(result.ingredients).length > 0 ? `
                     <div class="ingredients-section">
                         <div class="section-title"><i class="fas fa-list-ul"></i> Ingredients</div>
@@ -693,11 +825,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 
 
                 <!-- Share Section -->
-                <div class="share-section">
-                    <button class="download-button" id="download-btn">
-                        <i class="fas fa-download"></i> Download Analysis
-                    </button>
-                </div>
+                ${partial ? '' : `
+                    <div class="share-section">
+                        <button class="download-button" id="download-btn">
+                            <i class="fas fa-download"></i> Download Analysis
+                        </button>
+                    </div>
+                `}
                 <br>
             </div>
         `;
@@ -710,8 +844,39 @@ document.addEventListener('DOMContentLoaded', () => {
             downloadBtn.addEventListener('click', handleDownload);
         }
         
-        // Scroll to results
-        resultContainer.scrollIntoView({ behavior: 'smooth', block: 'start' });
+        // Scroll to results the first time they appear
+        if (!wasVisible) {
+            resultContainer.scrollIntoView({ behavior: 'smooth', block: 'start' });
+        }
+    }
+
+    // Human-readable name of a result section, e.g. "Nutrition facts"
+    function sectionName(section) {
+        const name = section.replace(/_/g, ' ');
+        return name.charAt(0).toUpperCase() + name.slice(1);
+    }
+
+    function unavailableReason(section, skipped) {
+        return skipped.includes(section)
+            ? 'Not visible in this photo'
+            : 'Could not be analyzed this time';
+    }
+
+    // Lists the sections left out of the result and why
+    function generateUnavailableNotice(degraded, skipped) {
+        if (degraded.length === 0 && skipped.length === 0) return '';
+        
+        return `
+            <div class="unavailable-notice">
+                <div class="section-title"><i class="fas fa-info-circle"></i> Not Available</div>
+                ${skipped.length > 0 ? `
+                    <p><strong>Not visible in this photo:</strong> ${skipped.map(sectionName).join(', ')}</p>
+                ` : ''}
+                ${degraded.length > 0 ? `
+                    <p><strong>Could not be analyzed this time:</strong> ${degraded.map(sectionName).join(', ')}</p>
+                ` : ''}
+            </div>
+        `;
     }
 
     // Generate nutrition highlights HTML
@@ -820,6 +985,10 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // Helper functions
     function generateId() {
+        // Unguessable, the id is all it takes to fetch the result later
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
         return Date.now().toString(36) + Math.random().toString(36).substring(2);
     }
     